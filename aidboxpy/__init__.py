@@ -1,4 +1,12 @@
+import asyncio
+import time
 from abc import ABC
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
 
 from fhirpy.base import (
     SyncClient,
@@ -10,8 +18,60 @@ from fhirpy.base import (
     SyncReference,
     AsyncReference,
 )
-from fhirpy.base.resource import BaseResource, BaseReference
+from fhirpy.base.exceptions import InvalidResponse
+from fhirpy.base.resource import AbstractResource, BaseResource, BaseReference
 from fhirpy.base.searchset import AbstractSearchSet
+from fhirpy.base.utils import (
+    AttrDict,
+    SearchList,
+    convert_values,
+    get_by_path,
+    parse_pagination_url,
+)
+
+from .batch import AsyncBatch, SyncBatch, get_current_batch
+from .cache import ResourceCache
+from .codec import JSONCodec, get_json_codec
+from .columns import ColumnBuilder
+from .hooks import (
+    RequestHooks,
+    get_endpoint,
+    get_request_path,
+    finish_stream,
+    get_trace_config,
+    receive_response,
+    start_request,
+)
+from .limiter import OVERLOAD_STATUSES, AdaptiveLimiter
+from .metrics import MetricsCollector
+from .retry import HedgingPolicy, RetryBudget, RetryPolicy
+from .trace import Tracer, bind_trace, trace_span
+from .utils import (
+    BULK_LOAD_HEADERS,
+    GzipNDJSONEncoder,
+    RawResponse,
+    ResourceGraph,
+    attach_resolved_resources,
+    format_cursor_token,
+    format_date_time,
+    get_bulk_load_path,
+    get_etag,
+    get_query_definition,
+    get_query_path,
+    get_request_key,
+    get_response_data,
+    get_sql_body,
+    get_sql_chunk_body,
+    group_references,
+    iter_path_values,
+    iter_reference_chunks,
+    iter_references,
+    parse_cursor_token,
+    parse_date_time,
+    raise_for_response,
+    serialize_data,
+    split_date_time_range,
+)
 
 __title__ = "aidbox-py"
 __version__ = "1.3.0"
@@ -22,18 +82,721 @@ __copyright__ = "Copyright 2021 beda.software"
 # Version synonym
 VERSION = __version__
 
+CURSOR_PAGE_SIZE = 100
+
+# Size of chunks read from `$dump` streams by `SyncAidboxClient`
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Values of lazy resources which are not converted yet
+RAW_CONTAINER_TYPES = frozenset([dict, list])
+
+# Search params for `total()` and `count()` methods
+TOTAL_PARAMS = {
+    "none": ("_total", "none"),
+    "estimate": ("_totalMethod", "estimate"),
+    "exact": ("_totalMethod", "count"),
+}
+
 
 class AidboxSearchSet(AbstractSearchSet, ABC):
+    options = None
+
+    def __init__(self, client, resource_type, params=None, options=None):
+        super().__init__(client, resource_type, params)
+        self.options = dict(options or {})
+
+    def clone(self, override=False, **kwargs):
+        searchset = super().clone(override=override, **kwargs)
+        searchset.options = dict(self.options)
+
+        return searchset
+
+    def _clone_with_options(self, **options):
+        """
+        Returns a copy of the search set with updated client-side options
+        which (unlike params) are not sent to the server
+        """
+        searchset = self.clone()
+        searchset.options.update(options)
+
+        return searchset
+
     def assoc(self, element_path):
         return self.clone(**{"_assoc": element_path})
 
+    def _get_bundle_graph(self, bundle_data):
+        """
+        Returns `ResourceGraph` of the Bundle with references
+        of all its resources attached to the resources from the Bundle
+        """
+        bundle_resource_type = bundle_data.get("resourceType", None)
+        if bundle_resource_type != "Bundle":
+            raise InvalidResponse(
+                "Expected to receive Bundle "
+                "but {0} received".format(bundle_resource_type)
+            )
+
+        # References of lazy resources are created on access,
+        # so the graph is always built of regular resources
+        resources = [
+            AbstractSearchSet._perform_resource(self, entry["resource"])
+            for entry in bundle_data.get("entry", [])
+        ]
+        index = {resource.reference: resource for resource in resources if resource.id}
+        attach_resolved_resources(group_references(iter_references(resources)), index)
+
+        return ResourceGraph(
+            [
+                resource
+                for resource in resources
+                if resource.resource_type == self.resource_type
+            ],
+            index,
+        )
+
+    def total(self, method):
+        """
+        Sets how the server computes Bundle `total`:
+        `none` (not computed), `estimate` (planner estimate) or `exact`
+        """
+        if method not in TOTAL_PARAMS:
+            raise ValueError(
+                "Argument `method` must be one of: {0}".format(", ".join(TOTAL_PARAMS))
+            )
+
+        key, value = TOTAL_PARAMS[method]
+        searchset = self.clone(override=True, **{key: value})
+        searchset.params.pop("_totalMethod" if key == "_total" else "_total", None)
+
+        return searchset
+
+    def _get_count_params(self, method):
+        if method == "none":
+            raise ValueError("Argument `method` must be `exact` or `estimate`")
+
+        params = dict(self.total(method).params)
+        params["_count"] = [0]
+
+        return params
+
+    def _get_iteration_params(self):
+        """
+        Returns params of the first page of iteration.
+        Totals are not computed unless they are requested explicitly
+        """
+        if "_total" in self.params or "_totalMethod" in self.params:
+            return self.params
+
+        return {**self.params, "_total": ["none"]}
+
+    def _get_next_page(self, bundle_data, params):
+        """
+        Returns path and params of the next page or (None, None)
+        """
+        next_link = get_by_path(bundle_data, ["link", {"relation": "next"}, "url"])
+        if next_link:
+            return parse_pagination_url(next_link)
+
+        return None, None
+
+    def cursor(self, after=None):
+        """
+        Returns the search set which is paged with keyset pagination:
+        resources are sorted by `_lastUpdated` and `_id` and every next page
+        is requested with `_lastUpdated=ge<last seen instant>` filter
+        instead of page offset (more resources updated at the same instant
+        than the page size are paged within `_lastUpdated=eq<instant>`).
+        `after` is a token yielded by `iter_pages()` to resume from
+        """
+        if "_sort" in self.params or "page" in self.params:
+            raise TypeError("Cursor pagination does not support `_sort` and `page`")
+
+        return self._clone_with_options(cursor=True, after=after)
+
+    def _get_cursor_params(self, after):
+        """
+        Returns params of the page after the cursor position.
+        Resources updated at the last seen instant are requested again
+        and skipped. When a whole page is updated at the same instant
+        (e.g. by one transaction), the rest of the instant is paged
+        with `_lastUpdated=eq<instant>` sorted by `_id`, so `_count`
+        always stays the page size
+        """
+        params = {
+            key: list(values) for key, values in self._get_iteration_params().items()
+        }
+        count = int(params.get("_count", [CURSOR_PAGE_SIZE])[0])
+        params["_count"] = [count]
+        params["_sort"] = ["_lastUpdated,_id"]
+        if after is None:
+            return params
+
+        last_updated, skip = after
+        instant = format_date_time(last_updated)
+        if skip >= count:
+            params["_sort"] = ["_id"]
+            params["page"] = [skip // count + 1]
+            prefix = "eq"
+        else:
+            # Skip is 0 when all resources of the instant are seen
+            prefix = "ge" if skip else "gt"
+        params.setdefault("_lastUpdated", []).append(prefix + instant)
+
+        return params
+
+    def _get_cursor_page(self, bundle_data, params, after):
+        """
+        Returns the page Bundle without resources seen on previous pages,
+        the new cursor position and whether the page is the last one
+        """
+        count = params["_count"][0]
+        if after is not None and after[1] >= count:
+            return self._get_cursor_instant_page(bundle_data, count, after)
+
+        fresh_entries = []
+        primary_count = 0
+        last_updated = None
+        last_updated_count = 0
+        for entry in bundle_data.get("entry", []):
+            data = entry["resource"]
+            if data.get("resourceType") != self.resource_type:
+                fresh_entries.append(entry)
+                continue
+
+            primary_count += 1
+            updated = parse_date_time(get_by_path(data, ["meta", "lastUpdated"]))
+            if updated == last_updated:
+                last_updated_count += 1
+            else:
+                last_updated, last_updated_count = updated, 1
+            if (
+                after is not None
+                and updated == after[0]
+                and last_updated_count <= after[1]
+            ):
+                continue
+            fresh_entries.append(entry)
+
+        if primary_count:
+            after = (last_updated, last_updated_count)
+        is_last = primary_count < count
+
+        return {**bundle_data, "entry": fresh_entries}, after, is_last
+
+    def _get_cursor_instant_page(self, bundle_data, count, after):
+        """
+        Returns the page of resources updated at the cursor instant.
+        The instant is done when the page isn't full,
+        the search continues after it
+        """
+        last_updated, skip = after
+        # The page starts at a multiple of `count`
+        seen = skip - skip % count
+        fresh_entries = []
+        primary_count = 0
+        for entry in bundle_data.get("entry", []):
+            if entry["resource"].get("resourceType") == self.resource_type:
+                primary_count += 1
+                if seen + primary_count <= skip:
+                    continue
+            fresh_entries.append(entry)
+
+        if primary_count < count:
+            after = (last_updated, 0)
+        else:
+            after = (last_updated, seen + primary_count)
+
+        return {**bundle_data, "entry": fresh_entries}, after, False
+
+    def _get_cached_id(self):
+        """
+        Returns id if the search set is a plain lookup by id
+        which can be served by the client cache
+        """
+        if self.client.cache is None or set(self.params) - {"_id", "id", "_count"}:
+            return None
+
+        ids = self.params.get("_id", []) + self.params.get("id", [])
+        if len(ids) == 1 and "," not in str(ids[0]):
+            return str(ids[0])
+
+        return None
+
+    def _get_dump_path(self):
+        if self.params:
+            raise TypeError(
+                "`$dump` streams the whole resource type "
+                "and does not support search params"
+            )
+
+        return "{0}/$dump".format(self.resource_type)
+
+    def _perform_dump_line(self, line, raw):
+        data = self.client.json_codec.loads(line)
+        if raw:
+            return data
+
+        return self._perform_resource(data)
+
+    def _get_columns_searchset(self, builder):
+        """
+        Returns the search set which requests only the elements
+        needed by the `builder` columns
+        """
+        elements = self.params.get("_elements")
+        if elements and elements[0].startswith("-"):
+            return self
+
+        extra_elements = elements[0].split(",") if elements else []
+        if self.options.get("cursor"):
+            # Cursor pagination is driven by `meta.lastUpdated`
+            extra_elements.append("meta")
+
+        return self.elements(*builder.elements, *extra_elements)
+
+    def _get_bundle_resources(self, bundle_data):
+        with trace_span(
+            self.client, "wrap_resources", resource_type=self.resource_type
+        ):
+            return super()._get_bundle_resources(bundle_data)
+
+    def lazy(self, lazy=True):
+        """
+        Returns search set which creates lazy resources
+        converting nested values only when they are accessed
+        """
+        return self._clone_with_options(lazy=lazy)
+
+    def _perform_resource(self, data):
+        if self.options.get("lazy"):
+            return self.client.lazy_resource_class(
+                self.client, data.get("resourceType", None), **data
+            )
+
+        return super()._perform_resource(data)
+
+    def _get_bounds_searchsets(self):
+        searchset = self.limit(1).elements("meta").total("none")
+
+        return (
+            searchset.sort("_lastUpdated"),
+            searchset.sort("-_lastUpdated"),
+        )
+
+    def _get_partitions(self, oldest, newest, parts):
+        """
+        Splits the search set into `parts` disjoint `_lastUpdated` windows
+        between `oldest` and `newest` resources.
+        The first and the last windows are open-ended
+        so resources updated during fetching are not lost
+        """
+        oldest_date = get_by_path(oldest or {}, ["meta", "lastUpdated"])
+        newest_date = get_by_path(newest or {}, ["meta", "lastUpdated"])
+        if parts <= 1 or not oldest_date or not newest_date:
+            return [self]
+
+        boundaries = split_date_time_range(
+            parse_date_time(oldest_date), parse_date_time(newest_date), parts
+        )
+        partitions = []
+        lower = None
+        for upper in boundaries + [None]:
+            window = []
+            if lower:
+                window.append("ge{0}".format(format_date_time(lower)))
+            if upper:
+                window.append("lt{0}".format(format_date_time(upper)))
+            partitions.append(self.clone(_lastUpdated=window) if window else self)
+            lower = upper
+
+        return partitions
+
+    @staticmethod
+    def _merge_partitions(partitions_resources):
+        """
+        Merges resources of partitions skipping duplicates (a resource
+        can move to another window if it's updated during fetching)
+        """
+        seen = set()
+        resources = []
+        for partition_resources in partitions_resources:
+            for resource in partition_resources:
+                if resource.id not in seen:
+                    seen.add(resource.id)
+                    resources.append(resource)
+
+        return resources
+
 
 class SyncAidboxSearchSet(SyncSearchSet, AidboxSearchSet):
-    pass
+    def fetch(self):
+        with trace_span(self.client, "fetch", resource_type=self.resource_type):
+            bundle_data = self.client._fetch_bundle(self.resource_type, self.params)
+
+            return self._get_bundle_resources(bundle_data)
+
+    def fetch_graph(self):
+        """
+        Makes query to the server and returns `ResourceGraph` of the primary
+        resources and the index of all resources of the Bundle
+        (including `_include`/`_revinclude`/`_assoc` ones) by reference.
+        References to the resources of the graph are resolved without requests
+        """
+        bundle_data = self.client._fetch_bundle(self.resource_type, self.params)
+
+        return self._get_bundle_graph(bundle_data)
+
+    def _iter_cursor_bundles(self):
+        after = parse_cursor_token(self.options.get("after"))
+        is_last = False
+        while not is_last:
+            params = self._get_cursor_params(after)
+            bundle_data = self.client._fetch_bundle(self.resource_type, params)
+            bundle_data, after, is_last = self._get_cursor_page(
+                bundle_data, params, after
+            )
+            yield bundle_data, format_cursor_token(after)
+
+    def iter_pages(self):
+        """
+        Yields pages of the cursor search set as tuples of
+        (resources, token) where `token` is passed to `cursor(after=token)`
+        to resume the iteration after this page
+        """
+        if not self.options.get("cursor"):
+            raise TypeError("Pages are iterated only by `cursor()` search sets")
+
+        for bundle_data, token in self._iter_cursor_bundles():
+            resources = self._get_bundle_resources(bundle_data)
+            if resources:
+                yield resources, token
+
+    def to_columns(self, paths, format="dict", dtypes=None):
+        """
+        Fetches all resources requesting only the elements of `paths`
+        and returns values of the paths as columns without creating
+        resources (see `ColumnBuilder` for `format` and `dtypes`)
+        """
+        builder = ColumnBuilder(self.resource_type, paths, format, dtypes)
+        for bundle_data in self._get_columns_searchset(builder)._iter_bundles():
+            builder.add_bundle(bundle_data)
+
+        return builder.build()
+
+    def iter_columns(self, paths, format="dict", dtypes=None, batch_size=None):
+        """
+        Same as `to_columns()` but yields columns of every page
+        or, with `batch_size`, of at least `batch_size` resources
+        """
+        builder = ColumnBuilder(self.resource_type, paths, format, dtypes)
+        for bundle_data in self._get_columns_searchset(builder)._iter_bundles():
+            builder.add_bundle(bundle_data)
+            if len(builder) >= (batch_size or 1):
+                yield builder.build()
+
+        if len(builder):
+            yield builder.build()
+
+    def _iter_bundles(self):
+        if self.options.get("cursor"):
+            for bundle_data, _ in self._iter_cursor_bundles():
+                yield bundle_data
+            return
+
+        path, params = self.resource_type, self._get_iteration_params()
+        while path:
+            bundle_data = self.client._fetch_bundle(path, params)
+            yield bundle_data
+
+            path, params = self._get_next_page(bundle_data, params)
+
+    def count(self, method="exact"):
+        """
+        Returns the total number of resources that match the search set
+        counted by the server with `method` (`exact` or `estimate`)
+        """
+        bundle_data = self.client._fetch_bundle(
+            self.resource_type, self._get_count_params(method)
+        )
+
+        return bundle_data["total"]
+
+    def get(self, id=None):
+        cached_id = None if id else self._get_cached_id()
+        if cached_id:
+            return self.client._read_resource(self.resource_type, cached_id)
+
+        return super().get(id)
+
+    def resolve(self, *paths, chunk_size=100):
+        """
+        Fetches all resources and resolves their references by `paths`
+        with `client.resolve()`. Returns the list of resources
+        """
+        resources = self.fetch_all()
+        self.client.resolve(iter_path_values(resources, paths), chunk_size=chunk_size)
+
+        return resources
+
+    def stream(self, raw=False):
+        """
+        Streams all resources of the resource type one by one
+        using Aidbox `$dump` operation (NDJSON) without paging.
+        Yields raw dicts instead of resources if `raw` is True
+        """
+        for line in self.client._iter_lines(self._get_dump_path()):
+            yield self._perform_dump_line(line, raw)
+
+    def iter_partitions(self, parts):
+        """
+        Yields `parts` search sets over disjoint `_lastUpdated` windows
+        which together cover the current search set
+        """
+        oldest_searchset, newest_searchset = self._get_bounds_searchsets()
+        yield from self._get_partitions(
+            oldest_searchset.first(), newest_searchset.first(), parts
+        )
+
+    def fetch_all(self, parallel=None):
+        """
+        Returns all resources of the search set.
+        With `parallel=N` the search set is split into N `_lastUpdated`
+        windows which are fetched concurrently in a thread pool
+        """
+        with trace_span(self.client, "fetch_all", resource_type=self.resource_type):
+            if not parallel or parallel <= 1:
+                return super().fetch_all()
+
+            partitions = list(self.iter_partitions(parallel))
+            fetch_all = bind_trace(lambda partition: partition.fetch_all())
+            with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+                return self._merge_partitions(executor.map(fetch_all, partitions))
+
+    def __iter__(self):
+        for bundle_data in self._iter_bundles():
+            for item in self._get_bundle_resources(bundle_data):
+                yield item
 
 
 class AsyncAidboxSearchSet(AsyncSearchSet, AidboxSearchSet):
-    pass
+    async def fetch(self):
+        with trace_span(self.client, "fetch", resource_type=self.resource_type):
+            bundle_data = await self.client._fetch_bundle(
+                self.resource_type, self.params
+            )
+
+            return self._get_bundle_resources(bundle_data)
+
+    async def fetch_graph(self):
+        """
+        Makes query to the server and returns `ResourceGraph` of the primary
+        resources and the index of all resources of the Bundle
+        (including `_include`/`_revinclude`/`_assoc` ones) by reference.
+        References to the resources of the graph are resolved without requests
+        """
+        bundle_data = await self.client._fetch_bundle(self.resource_type, self.params)
+
+        return self._get_bundle_graph(bundle_data)
+
+    def prefetch(self, depth=2):
+        """
+        Fetches up to `depth` next pages in background
+        while the current page is being processed.
+        `depth=0` disables prefetching
+        """
+        return self._clone_with_options(prefetch=depth)
+
+    async def _fetch_cursor_bundles(self):
+        after = parse_cursor_token(self.options.get("after"))
+        is_last = False
+        while not is_last:
+            params = self._get_cursor_params(after)
+            bundle_data = await self.client._fetch_bundle(self.resource_type, params)
+            bundle_data, after, is_last = self._get_cursor_page(
+                bundle_data, params, after
+            )
+            yield bundle_data, format_cursor_token(after)
+
+    async def iter_pages(self):
+        """
+        Yields pages of the cursor search set as tuples of
+        (resources, token) where `token` is passed to `cursor(after=token)`
+        to resume the iteration after this page
+        """
+        if not self.options.get("cursor"):
+            raise TypeError("Pages are iterated only by `cursor()` search sets")
+
+        async for bundle_data, token in self._fetch_cursor_bundles():
+            resources = self._get_bundle_resources(bundle_data)
+            if resources:
+                yield resources, token
+
+    async def to_columns(self, paths, format="dict", dtypes=None):
+        """
+        Fetches all resources requesting only the elements of `paths`
+        and returns values of the paths as columns without creating
+        resources (see `ColumnBuilder` for `format` and `dtypes`)
+        """
+        builder = ColumnBuilder(self.resource_type, paths, format, dtypes)
+        searchset = self._get_columns_searchset(builder)
+        async for bundle_data in searchset._iter_bundles():
+            builder.add_bundle(bundle_data)
+
+        return builder.build()
+
+    async def iter_columns(self, paths, format="dict", dtypes=None, batch_size=None):
+        """
+        Same as `to_columns()` but yields columns of every page
+        or, with `batch_size`, of at least `batch_size` resources
+        """
+        builder = ColumnBuilder(self.resource_type, paths, format, dtypes)
+        searchset = self._get_columns_searchset(builder)
+        async for bundle_data in searchset._iter_bundles():
+            builder.add_bundle(bundle_data)
+            if len(builder) >= (batch_size or 1):
+                yield builder.build()
+
+        if len(builder):
+            yield builder.build()
+
+    async def _fetch_bundles(self):
+        if self.options.get("cursor"):
+            async for bundle_data, _ in self._fetch_cursor_bundles():
+                yield bundle_data
+            return
+
+        path, params = self.resource_type, self._get_iteration_params()
+        while path:
+            bundle_data = await self.client._fetch_bundle(path, params)
+            yield bundle_data
+
+            path, params = self._get_next_page(bundle_data, params)
+
+    async def _iter_bundles(self):
+        depth = self.options.get("prefetch", 0)
+        if not depth:
+            async for bundle_data in self._fetch_bundles():
+                yield bundle_data
+            return
+
+        # The semaphore is released as soon as the page is taken from
+        # the queue, so at most `depth` pages wait for the consumer
+        semaphore = asyncio.Semaphore(depth)
+        queue = asyncio.Queue()
+
+        async def produce():
+            try:
+                await semaphore.acquire()
+                async for bundle_data in self._fetch_bundles():
+                    queue.put_nowait((bundle_data, None))
+                    await semaphore.acquire()
+            except Exception as exc:
+                queue.put_nowait((None, exc))
+            else:
+                queue.put_nowait((None, None))
+
+        producer = asyncio.ensure_future(produce())
+        try:
+            while True:
+                bundle_data, exc = await queue.get()
+                semaphore.release()
+                if exc is not None:
+                    raise exc
+                if bundle_data is None:
+                    break
+                yield bundle_data
+        finally:
+            producer.cancel()
+
+    async def count(self, method="exact"):
+        """
+        Returns the total number of resources that match the search set
+        counted by the server with `method` (`exact` or `estimate`)
+        """
+        bundle_data = await self.client._fetch_bundle(
+            self.resource_type, self._get_count_params(method)
+        )
+
+        return bundle_data["total"]
+
+    async def get(self, id=None):
+        cached_id = None if id else self._get_cached_id()
+        if cached_id:
+            return await self.client._read_resource(self.resource_type, cached_id)
+
+        return await super().get(id)
+
+    async def resolve(self, *paths, chunk_size=100):
+        """
+        Fetches all resources and resolves their references by `paths`
+        with `client.resolve()`. Returns the list of resources
+        """
+        resources = await self.fetch_all()
+        await self.client.resolve(
+            iter_path_values(resources, paths), chunk_size=chunk_size
+        )
+
+        return resources
+
+    async def stream(self, raw=False):
+        """
+        Streams all resources of the resource type one by one
+        using Aidbox `$dump` operation (NDJSON) without paging.
+        Yields raw dicts instead of resources if `raw` is True
+        """
+        async for line in self.client._iter_lines(self._get_dump_path()):
+            yield self._perform_dump_line(line, raw)
+
+    async def iter_partitions(self, parts):
+        """
+        Yields `parts` search sets over disjoint `_lastUpdated` windows
+        which together cover the current search set
+        """
+        oldest_searchset, newest_searchset = self._get_bounds_searchsets()
+        oldest, newest = await asyncio.gather(
+            oldest_searchset.first(), newest_searchset.first()
+        )
+        for partition in self._get_partitions(oldest, newest, parts):
+            yield partition
+
+    async def fetch_all(self, parallel=None):
+        """
+        Returns all resources of the search set.
+        With `parallel=N` the search set is split into N `_lastUpdated`
+        windows which are fetched concurrently
+        """
+        with trace_span(self.client, "fetch_all", resource_type=self.resource_type):
+            if not parallel or parallel <= 1:
+                return await super().fetch_all()
+
+            partitions = [
+                partition async for partition in self.iter_partitions(parallel)
+            ]
+            return self._merge_partitions(
+                await asyncio.gather(
+                    *[partition.fetch_all() for partition in partitions]
+                )
+            )
+
+    async def __aiter__(self):
+        async for bundle_data in self._iter_bundles():
+            for item in self._get_bundle_resources(bundle_data):
+                yield item
+
+
+REFERENCE_KEYS = frozenset(
+    [
+        "resourceType",
+        "id",
+        "_id",
+        "resource",
+        "display",
+        "uri",
+        "localRef",
+        "identifier",
+        "extension",
+    ]
+)
 
 
 class BaseAidboxResource(BaseResource, ABC):
@@ -44,32 +807,178 @@ class BaseAidboxResource(BaseResource, ABC):
         return (
             "resourceType" in value
             and ("id" in value or "url" in value)
-            and not (
-                set(value.keys())
-                - {
-                    "resourceType",
-                    "id",
-                    "_id",
-                    "resource",
-                    "display",
-                    "uri",
-                    "localRef",
-                    "identifier",
-                    "extension",
-                }
-            )
+            and value.keys() <= REFERENCE_KEYS
+        )
+
+    def serialize(self, encode=False):
+        """
+        Returns resource data with nested resources replaced by references.
+        With `encode=True` returns the data encoded to JSON bytes
+        by the client codec
+        """
+        with trace_span(self.client, "serialize", resource_type=self.resource_type):
+            if encode:
+                return self.client.json_codec.dumps(serialize_data(self))
+
+            return serialize_data(self, AttrDict, SearchList)
+
+    def _serialize_for_request(self):
+        """
+        Returns data of the request body. Plain dicts are enough for it,
+        `serialize()` is called only if a subclass overrides it
+        """
+        if type(self).serialize is not BaseAidboxResource.serialize:
+            return self.serialize()
+
+        with trace_span(self.client, "serialize", resource_type=self.resource_type):
+            return serialize_data(self)
+
+    def _get_save_request(self, fields=None):
+        data = self._serialize_for_request()
+        if fields:
+            if not self.id:
+                raise TypeError("Resource `id` is required for update operation")
+            return "patch", {key: data[key] for key in fields}
+
+        return "put" if self.id else "post", data
+
+    def _update_from_response(self, data):
+        super(BaseResource, self).clear()
+        super(BaseResource, self).update(
+            **self.client.resource(self.resource_type, **data)
         )
 
 
 class SyncAidboxResource(BaseAidboxResource, SyncResource):
-    pass
+    def save(self, fields=None):
+        """
+        Creates or updates the resource.
+        Inside `client.batch()` the request is queued
+        and the resource is updated when the batch is flushed
+        """
+        with trace_span(self.client, "save", resource_type=self.resource_type):
+            method, data = self._get_save_request(fields)
+            batch = get_current_batch(self.client)
+            if batch is not None:
+                batch.add(self, method, self._get_path(), data)
+                return
+
+            response_data = self.client._do_request(method, self._get_path(), data=data)
+            self.client._invalidate_cached(self)
+            if response_data:
+                self._update_from_response(response_data)
+
+    def delete(self):
+        """
+        Deletes the resource.
+        Inside `client.batch()` the request is queued
+        """
+        batch = get_current_batch(self.client)
+        if batch is not None:
+            batch.add(self, "delete", self._get_path())
+            return
+
+        response_data = self.client._do_request("delete", self._get_path())
+        self.client._invalidate_cached(self)
+
+        return response_data
 
 
 class AsyncAidboxResource(BaseAidboxResource, AsyncResource):
+    async def save(self, fields=None):
+        """
+        Creates or updates the resource.
+        Inside `client.batch()` the request is queued
+        and the resource is updated when the batch is flushed
+        """
+        with trace_span(self.client, "save", resource_type=self.resource_type):
+            method, data = self._get_save_request(fields)
+            batch = get_current_batch(self.client)
+            if batch is not None:
+                await batch.add(self, method, self._get_path(), data)
+                return
+
+            response_data = await self.client._do_request(
+                method, self._get_path(), data=data
+            )
+            self.client._invalidate_cached(self)
+            if response_data:
+                self._update_from_response(response_data)
+
+    async def delete(self):
+        """
+        Deletes the resource.
+        Inside `client.batch()` the request is queued
+        """
+        batch = get_current_batch(self.client)
+        if batch is not None:
+            await batch.add(self, "delete", self._get_path())
+            return
+
+        response_data = await self.client._do_request("delete", self._get_path())
+        self.client._invalidate_cached(self)
+
+        return response_data
+
+
+class LazyAidboxResourceMixin:
+    """
+    Resource which keeps values as they are decoded from JSON
+    and converts a top-level value (wraps dicts into `AttrDict`
+    and replaces references with reference instances) on the first access.
+    Serialization and saving don't convert values at all
+    """
+
+    def __init__(self, client, resource_type, **kwargs):
+        self.resource_type = resource_type
+        kwargs["resourceType"] = resource_type
+        AbstractResource.__init__(self, client, **kwargs)
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if type(value) in RAW_CONTAINER_TYPES:
+            value = self._convert_value(value)
+            dict.__setitem__(self, key, value)
+
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key, default=None):
+        return self[key] if key in self else super().setdefault(key, default)
+
+    def _convert_value(self, value):
+        client = self.client
+
+        def convert_fn(item):
+            if isinstance(item, AbstractResource):
+                return item, True
+            if self.is_reference(item):
+                return client.reference(**item), True
+
+            return item, False
+
+        return convert_values(value, convert_fn)
+
+    def _update_from_response(self, data):
+        dict.clear(self)
+        dict.update(self, data)
+        dict.__setitem__(self, "resourceType", self.resource_type)
+
+
+class SyncAidboxLazyResource(LazyAidboxResourceMixin, SyncAidboxResource):
+    pass
+
+
+class AsyncAidboxLazyResource(LazyAidboxResourceMixin, AsyncAidboxResource):
     pass
 
 
 class BaseAidboxReference(BaseReference, ABC):
+    # Resource attached by `client.resolve()`
+    _resolved = None
+
     @property
     def reference(self):
         """
@@ -96,18 +1005,437 @@ class BaseAidboxReference(BaseReference, ABC):
     def is_local(self):
         return not self.get("url")
 
+    def serialize(self):
+        return serialize_data(self, AttrDict, SearchList)
+
 
 class SyncAidboxReference(BaseAidboxReference, SyncReference):
-    pass
+    def to_resource(self):
+        """
+        Returns Resource instance for this reference
+        (the attached one if the reference was resolved)
+        """
+        if self._resolved is not None:
+            return self._resolved
+        if self.client.cache is not None and self.is_local:
+            return self.client._read_resource(self.resource_type, self.id)
+
+        return super().to_resource()
 
 
 class AsyncAidboxReference(BaseAidboxReference, AsyncReference):
-    pass
+    async def to_resource(self):
+        """
+        Returns Resource instance for this reference
+        (the attached one if the reference was resolved)
+        """
+        if self._resolved is not None:
+            return self._resolved
+        if self.client.cache is not None and self.is_local:
+            return await self.client._read_resource(self.resource_type, self.id)
+
+        return await super().to_resource()
 
 
 class SyncAidboxClient(SyncClient):
     searchset_class = SyncAidboxSearchSet
     resource_class = SyncAidboxResource
+    lazy_resource_class = SyncAidboxLazyResource
+    retry_exceptions = (requests.ConnectionError, requests.Timeout)
+
+    def __init__(
+        self,
+        url,
+        authorization=None,
+        extra_headers=None,
+        *,
+        session=None,
+        pool_size=10,
+        limit_per_host=0,
+        keep_alive=True,
+        cache=None,
+        json_codec=None,
+        retry_policy=None,
+        hooks=None,
+    ):
+        """
+        All requests go through one pooled `requests.Session`.
+        `pool_size` is the maximum number of connections kept for reuse
+        per host, `limit_per_host` lowers it (0 means `pool_size`).
+        It isn't a limit: extra connections are opened when all pooled ones
+        are busy and closed after use.
+        The session passed via `session` is used as is and is not closed
+        by the client.
+        Resources read by reference or id are kept in `cache`
+        (`ResourceCache` instance) if it's passed.
+        Bodies are encoded and decoded with `json_codec`: `json` (default),
+        `orjson`, `ujson`, `auto` (the fastest installed one)
+        or a `JSONCodec` instance.
+        Failed idempotent requests are retried with `retry_policy`
+        (`RetryPolicy` instance) if it's passed.
+        `hooks` (`RequestHooks` instances, e.g. `MetricsCollector`)
+        are called for every sent request
+        """
+        super().__init__(url, authorization, extra_headers)
+        self.json_codec = get_json_codec(json_codec)
+        self.keep_alive = keep_alive
+        self.cache = cache
+        self.retry_policy = retry_policy
+        self.hooks = list(hooks or [])
+        self.pool_size = pool_size
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            # `pool_connections` is the number of cached per-host pools
+            adapter = HTTPAdapter(
+                pool_maxsize=min(pool_size, limit_per_host or pool_size)
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Closes all pooled connections of the owned session
+        """
+        if self._owns_session:
+            self.session.close()
+
+    def _build_request_headers(self):
+        headers = {
+            key: value
+            for key, value in super()._build_request_headers().items()
+            if value is not None
+        }
+        if not self.keep_alive:
+            headers["Connection"] = "close"
+
+        return headers
+
+    def _do_request(self, method, path, data=None, params=None, attrdict=True):
+        headers = self._build_request_headers()
+        with trace_span(self, "build_query"):
+            url = self._build_request_url(path, params)
+
+        kwargs = {}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            with trace_span(self, "encode"):
+                kwargs["data"] = self.json_codec.dumps(data)
+        response = self._send(method, url, headers, **kwargs)
+
+        return get_response_data(
+            response,
+            self.json_codec.loads_attrdict if attrdict else self.json_codec.loads,
+        )
+
+    def _fetch_bundle(self, path, params=None):
+        return self._do_request("get", path, params=params, attrdict=False)
+
+    def _send(self, method, url, headers, **kwargs):
+        if self.retry_policy is None:
+            return self._send_request(method, url, headers, **kwargs)
+
+        return self.retry_policy.call(
+            method,
+            lambda: self._send_request(method, url, headers, **kwargs),
+            self.retry_exceptions,
+        )
+
+    def _send_request(self, method, url, headers, **kwargs):
+        request = start_request(self.hooks, self.url, method, url)
+        if request is None:
+            r = self.session.request(method, url, headers=headers, **kwargs)
+
+            return RawResponse(r.status_code, r.headers, r.content)
+
+        try:
+            # The body is streamed to measure the time to the headers
+            r = self.session.request(
+                method, url, headers=headers, stream=True, **kwargs
+            )
+            request.timings.ttfb = request.elapsed()
+            content = r.content
+        except Exception as exc:
+            request.fail(exc)
+            raise
+
+        return receive_response(request, r.status_code, r.headers, content)
+
+    def _read_resource(self, resource_type, id):
+        """
+        Reads the resource by id using the cache.
+        Stale cache entries are revalidated with `If-None-Match`
+        """
+        key = "{0}/{1}".format(resource_type, id)
+        entry = self.cache.get(key)
+        if entry is not None and entry.is_fresh:
+            return self.resource(resource_type, **entry.data)
+
+        headers = self._build_request_headers()
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        response = self._send("get", self._build_request_url(key, None), headers)
+        if response.status == 304 and entry is not None:
+            self.cache.touch(key)
+            return self.resource(resource_type, **entry.data)
+
+        data = get_response_data(response, self.json_codec.loads)
+        self.cache.set(key, data, get_etag(response, data))
+
+        return self.resource(resource_type, **data)
+
+    def _invalidate_cached(self, resource):
+        if self.cache is not None and resource.id:
+            self.cache.invalidate(resource.reference)
+
+    def bulk_load(self, resource_type, resources):
+        """
+        Loads resources (or dicts, or encoded NDJSON lines) from the
+        iterable in one request with gzip-compressed NDJSON body
+        which is streamed while the iterable is consumed.
+        Pass `resource_type=None` to load resources of different types.
+        Returns Aidbox report with per-type counts and errors
+        """
+        headers = {
+            **self._build_request_headers(),
+            **BULK_LOAD_HEADERS,
+        }
+        url = self._build_request_url(get_bulk_load_path(resource_type), None)
+
+        def iter_body():
+            encoder = GzipNDJSONEncoder(dumps=self.json_codec.dumps)
+            for resource in resources:
+                chunk = encoder.encode(resource)
+                if chunk:
+                    yield chunk
+            yield encoder.close()
+
+        return get_response_data(
+            self._send("post", url, headers, data=iter_body()),
+            self.json_codec.loads_attrdict,
+        )
+
+    def resolve(self, references, chunk_size=100):
+        """
+        Fetches resources of local references with one `_id` search
+        per resource type and chunk of `chunk_size` ids, attaches them
+        to the references (so `to_resource()` doesn't make requests)
+        and returns a dict of resources by reference string
+        """
+        grouped_references = group_references(references)
+        resources = {}
+        for resource_type, ids in iter_reference_chunks(grouped_references, chunk_size):
+            for resource in self._get_ids_searchset(resource_type, ids):
+                resources[resource.reference] = resource
+        attach_resolved_resources(grouped_references, resources)
+
+        return resources
+
+    def _get_ids_searchset(self, resource_type, ids):
+        return self.resources(resource_type).search(_id=",".join(ids)).limit(len(ids))
+
+    def trace(self, path=None, sample_rate=1.0, max_events=1000000):
+        """
+        Returns context manager which records spans of the client
+        operations and requests made in the current context
+        and writes them to `path` in Chrome trace format on exit.
+        Only `sample_rate` share of root operations is recorded
+        (see `Tracer`)
+        """
+        return Tracer(self, path, sample_rate, max_events)
+
+    def batch(self, size=500, mode="batch"):
+        """
+        Returns context manager which queues `save()` and `delete()`
+        of the client resources and sends them as Bundles of `size` entries
+        """
+        return SyncBatch(self, size=size, mode=mode)
+
+    def imap(self, fn, items, workers=None, return_exceptions=False):
+        """
+        Yields results of `fn(item)` for `items` in order running up to
+        `workers` (`pool_size` by default) calls concurrently in a thread pool.
+        At most `2 * workers` items are taken from `items` ahead,
+        so it can be used with long iterables.
+        With `return_exceptions` errors are yielded instead of being raised
+        """
+        workers = workers or self.pool_size
+        # Calls are traced if the iteration is started inside `trace()`
+        bound_fn = bind_trace(fn)
+        pending = deque()
+        items = iter(items)
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while True:
+                for item in items:
+                    pending.append(executor.submit(bound_fn, item))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    return
+
+                future = pending.popleft()
+                try:
+                    yield future.result()
+                except Exception as exc:
+                    if not return_exceptions:
+                        raise
+                    yield exc
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def map_fetch(self, searchsets, workers=None, return_exceptions=False):
+        """
+        Fetches search sets concurrently and returns the list
+        of their `fetch()` results in order
+        """
+        return list(
+            self.imap(
+                lambda searchset: searchset.fetch(),
+                searchsets,
+                workers=workers,
+                return_exceptions=return_exceptions,
+            )
+        )
+
+    def map_save(self, resources, workers=None, return_exceptions=False):
+        """
+        Saves resources concurrently and returns the list of saved resources
+        """
+
+        def save(resource):
+            resource.save()
+            return resource
+
+        return list(
+            self.imap(
+                save, resources, workers=workers, return_exceptions=return_exceptions
+            )
+        )
+
+    def define_query(self, name, sql, params=None, count_query=None):
+        """
+        Creates or updates `AidboxQuery` resource `name`.
+        `params` describes parameters of the `sql` query
+        (e.g. `{'org': {'type': 'string'}}` used as `{{params.org}}`)
+        """
+        query = self.resource(
+            "AidboxQuery", **get_query_definition(name, sql, params, count_query)
+        )
+        query.save()
+
+        return query
+
+    def query(self, name, **params):
+        """
+        Runs `AidboxQuery` `name` and returns rows as `AttrDict`s
+        """
+        response_data = self._do_request("get", get_query_path(name), params=params)
+
+        return (response_data or {}).get("data", [])
+
+    def iter_query(self, name, page_size=100, **params):
+        """
+        Yields rows of `AidboxQuery` `name` requesting them page by page.
+        The query must declare `limit` and `offset` params
+        """
+        offset = 0
+        while True:
+            rows = self.query(name, limit=page_size, offset=offset, **params)
+            yield from rows
+            if len(rows) < page_size:
+                return
+            offset += page_size
+
+    def sql(self, query, params=None, resource_type=None):
+        """
+        Runs parameterised SQL `query` (with `?` placeholders for `params`)
+        via `$sql` and returns rows as `AttrDict`s.
+        With `resource_type` rows of Aidbox resource tables
+        (with `id` and `resource` columns) are returned as resources
+        """
+        rows = self._do_request("post", "$sql", data=get_sql_body(query, params))
+
+        return self._decode_sql_rows(rows or [], resource_type)
+
+    def iter_sql(
+        self, query, params=None, key="id", chunk_size=1000, resource_type=None
+    ):
+        """
+        Yields rows of SQL `query` fetching them in chunks of `chunk_size`
+        rows ordered by the unique `key` column (keyset pagination)
+        """
+        after = None
+        while True:
+            body = get_sql_chunk_body(query, params, key, chunk_size, after)
+            rows = self._do_request("post", "$sql", data=body) or []
+            yield from self._decode_sql_rows(rows, resource_type)
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][key]
+
+    def _decode_sql_rows(self, rows, resource_type):
+        if resource_type is None:
+            return rows
+
+        return [
+            self.resource(resource_type, **{**row["resource"], "id": row["id"]})
+            for row in rows
+        ]
+
+    def _iter_lines(self, path, params=None):
+        """
+        Yields non-empty lines of the chunked response (e.g. NDJSON).
+        The request is reported to the hooks when the response is consumed
+        or closed, it isn't retried or limited because the stream
+        can't be repeated after its lines are yielded
+        """
+        headers = self._build_request_headers()
+        url = self._build_request_url(path, params)
+        request = start_request(self.hooks, self.url, "get", url)
+        size = 0
+        r = None
+        try:
+            with self.session.get(url, headers=headers, stream=True) as r:
+                if request is not None:
+                    request.timings.ttfb = request.elapsed()
+                if not 200 <= r.status_code < 300:
+                    content = r.content
+                    if request is not None:
+                        receive_response(request, r.status_code, r.headers, content)
+                    raise_for_response(r.status_code, content.decode())
+
+                tail = b""
+                for chunk in r.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                    size += len(chunk)
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            yield line
+                if tail.strip():
+                    yield tail
+        except GeneratorExit:
+            # The caller stopped reading the stream
+            if request is not None:
+                finish_stream(request, r.status_code, r.headers, size)
+            raise
+        except Exception as exc:
+            if request is not None:
+                request.fail(exc)
+            raise
+
+        if request is not None:
+            finish_stream(request, r.status_code, r.headers, size)
 
     def reference(self, resource_type=None, id=None, reference=None, **kwargs):
         resource_type = kwargs.pop("resourceType", resource_type)
@@ -125,6 +1453,503 @@ class SyncAidboxClient(SyncClient):
 class AsyncAidboxClient(AsyncClient):
     searchset_class = AsyncAidboxSearchSet
     resource_class = AsyncAidboxResource
+    lazy_resource_class = AsyncAidboxLazyResource
+    retry_exceptions = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+    def __init__(
+        self,
+        url,
+        authorization=None,
+        extra_headers=None,
+        *,
+        session=None,
+        pool_size=100,
+        limit_per_host=0,
+        keep_alive=True,
+        keepalive_timeout=15,
+        cache=None,
+        json_codec=None,
+        limiter=None,
+        retry_policy=None,
+        hedging_policy=None,
+        coalesce_reads=False,
+        hooks=None,
+    ):
+        """
+        All requests go through one pooled `aiohttp.ClientSession`.
+        The session is created lazily inside the running event loop
+        (and re-created if the loop changes), so the client can be
+        instantiated at import time.
+        `pool_size` is the maximum number of simultaneous connections,
+        `limit_per_host` caps it for a single host (0 means no limit).
+        The session passed via `session` is used as is and is not closed
+        by the client.
+        Resources read by reference or id are kept in `cache`
+        (`ResourceCache` instance) if it's passed.
+        Bodies are encoded and decoded with `json_codec`: `json` (default),
+        `orjson`, `ujson`, `auto` (the fastest installed one)
+        or a `JSONCodec` instance.
+        The number of in-flight requests is limited by `limiter`
+        (`AdaptiveLimiter` instance) if it's passed.
+        Failed idempotent requests are retried with `retry_policy`
+        (`RetryPolicy` instance) and slow GET requests are duplicated
+        with `hedging_policy` (`HedgingPolicy` instance) if they're passed.
+        With `coalesce_reads` identical concurrent GET requests share
+        one request and its response.
+        `hooks` (`RequestHooks` instances, e.g. `MetricsCollector`)
+        are called for every sent request, connect time is measured
+        only with the owned session
+        """
+        super().__init__(url, authorization, extra_headers)
+        self.json_codec = get_json_codec(json_codec)
+        self.cache = cache
+        self.limiter = limiter
+        self.retry_policy = retry_policy
+        self.hedging_policy = hedging_policy
+        self.coalesce_reads = coalesce_reads
+        self.hooks = list(hooks or [])
+        self._inflight_reads = {}
+        self.pool_size = pool_size
+        self.limit_per_host = limit_per_host
+        self.keep_alive = keep_alive
+        self.keepalive_timeout = keepalive_timeout
+        self._owns_session = session is None
+        self._session = session
+        self._session_loop = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    @property
+    def session(self):
+        if not self._owns_session:
+            return self._session
+
+        loop = asyncio.get_event_loop()
+        if (
+            self._session is None
+            or self._session.closed
+            or self._session_loop is not loop
+        ):
+            if self._session is not None and not self._session.closed:
+                self._close_stale_session()
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout if self.keep_alive else None,
+                force_close=not self.keep_alive,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                trace_configs=[get_trace_config()] if self.hooks else None,
+            )
+            self._session_loop = loop
+
+        return self._session
+
+    def _close_stale_session(self):
+        """
+        Closes the owned session of another event loop
+        which can't be awaited in the current one
+        """
+        session, loop = self._session, self._session_loop
+        if loop.is_running():
+            # The loop runs in another thread
+            asyncio.run_coroutine_threadsafe(session.close(), loop)
+            return
+
+        # Connections of the stopped loop are closed without waiting
+        connector = session.connector
+        session.detach()
+        connector._close()
+
+    async def close(self):
+        """
+        Closes all pooled connections of the owned session
+        """
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+            self._session_loop = None
+
+    def _build_request_headers(self):
+        return {
+            key: value
+            for key, value in super()._build_request_headers().items()
+            if value is not None
+        }
+
+    async def _do_request(self, method, path, data=None, params=None, attrdict=True):
+        headers = self._build_request_headers()
+        with trace_span(self, "build_query"):
+            url = self._build_request_url(path, params)
+
+        kwargs = {}
+        if data is not None:
+            headers["Content-Type"] = "application/json"
+            with trace_span(self, "encode"):
+                kwargs["data"] = self.json_codec.dumps(data)
+        response = await self._send(method, url, headers, **kwargs)
+
+        return get_response_data(
+            response,
+            self.json_codec.loads_attrdict if attrdict else self.json_codec.loads,
+        )
+
+    async def _fetch_bundle(self, path, params=None):
+        return await self._do_request("get", path, params=params, attrdict=False)
+
+    async def _send(self, method, url, headers, **kwargs):
+        if not self.coalesce_reads or method.upper() != "GET" or kwargs:
+            return await self._send_with_policies(method, url, headers, **kwargs)
+
+        # The raw response is shared, so every caller decodes its own copy
+        key = (asyncio.get_event_loop(), *get_request_key(method, url, headers))
+        future = self._inflight_reads.get(key)
+        if future is None:
+            future = asyncio.ensure_future(
+                self._send_with_policies(method, url, headers)
+            )
+            self._inflight_reads[key] = future
+
+            def forget(done_future):
+                if self._inflight_reads.get(key) is done_future:
+                    del self._inflight_reads[key]
+                if not done_future.cancelled():
+                    # Mark the error as retrieved if all callers are cancelled
+                    done_future.exception()
+
+            future.add_done_callback(forget)
+
+        # A cancelled caller doesn't cancel the request of other callers
+        return await asyncio.shield(future)
+
+    async def _send_with_policies(self, method, url, headers, **kwargs):
+        def send():
+            return self._send_limited(method, url, headers, **kwargs)
+
+        if self.hedging_policy is not None and method.upper() == "GET":
+            send_once = send
+
+            def send():
+                return self.hedging_policy.call(send_once)
+
+        if self.retry_policy is None:
+            return await send()
+
+        return await self.retry_policy.call_async(method, send, self.retry_exceptions)
+
+    async def _send_limited(self, method, url, headers, **kwargs):
+        if self.limiter is None:
+            return await self._send_request(method, url, headers, **kwargs)
+
+        await self.limiter.acquire()
+        started_at = time.monotonic()
+        overloaded = False
+        cancelled = False
+        try:
+            response = await self._send_request(method, url, headers, **kwargs)
+            overloaded = response.status in OVERLOAD_STATUSES
+
+            return response
+        except asyncio.TimeoutError:
+            overloaded = True
+            raise
+        except asyncio.CancelledError:
+            # Cancelled requests (e.g. losing hedged duplicates)
+            # say nothing about the server
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                endpoint, _ = get_endpoint(method, get_request_path(self.url, url))
+                self.limiter.on_response(
+                    time.monotonic() - started_at, overloaded, endpoint
+                )
+            self.limiter.release()
+
+    async def _send_request(self, method, url, headers, **kwargs):
+        request = start_request(self.hooks, self.url, method, url)
+        if request is None:
+            async with self.session.request(
+                method, url, headers=headers, **kwargs
+            ) as r:
+                return RawResponse(r.status, r.headers, await r.read())
+
+        try:
+            async with self.session.request(
+                method,
+                url,
+                headers=headers,
+                trace_request_ctx=request.timings,
+                **kwargs,
+            ) as r:
+                request.timings.ttfb = request.elapsed()
+                content = await r.read()
+        except BaseException as exc:
+            # Cancelled hedged duplicates are reported too
+            request.fail(exc)
+            raise
+
+        return receive_response(request, r.status, r.headers, content)
+
+    async def _read_resource(self, resource_type, id):
+        """
+        Reads the resource by id using the cache.
+        Stale cache entries are revalidated with `If-None-Match`
+        """
+        key = "{0}/{1}".format(resource_type, id)
+        entry = self.cache.get(key)
+        if entry is not None and entry.is_fresh:
+            return self.resource(resource_type, **entry.data)
+
+        headers = self._build_request_headers()
+        if entry is not None and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        response = await self._send("get", self._build_request_url(key, None), headers)
+        if response.status == 304 and entry is not None:
+            self.cache.touch(key)
+            return self.resource(resource_type, **entry.data)
+
+        data = get_response_data(response, self.json_codec.loads)
+        self.cache.set(key, data, get_etag(response, data))
+
+        return self.resource(resource_type, **data)
+
+    def _invalidate_cached(self, resource):
+        if self.cache is not None and resource.id:
+            self.cache.invalidate(resource.reference)
+
+    async def bulk_load(self, resource_type, resources):
+        """
+        Loads resources (or dicts, or encoded NDJSON lines) from the
+        iterable or async iterable in one request with gzip-compressed
+        NDJSON body which is streamed while the iterable is consumed.
+        Pass `resource_type=None` to load resources of different types.
+        Returns Aidbox report with per-type counts and errors
+        """
+        headers = {
+            **self._build_request_headers(),
+            **BULK_LOAD_HEADERS,
+        }
+        url = self._build_request_url(get_bulk_load_path(resource_type), None)
+
+        async def iter_resources():
+            if hasattr(resources, "__aiter__"):
+                async for resource in resources:
+                    yield resource
+            else:
+                for resource in resources:
+                    yield resource
+
+        async def iter_body():
+            encoder = GzipNDJSONEncoder(dumps=self.json_codec.dumps)
+            async for resource in iter_resources():
+                chunk = encoder.encode(resource)
+                if chunk:
+                    yield chunk
+            yield encoder.close()
+
+        return get_response_data(
+            await self._send("post", url, headers, data=iter_body()),
+            self.json_codec.loads_attrdict,
+        )
+
+    async def resolve(self, references, chunk_size=100):
+        """
+        Fetches resources of local references with concurrent `_id`
+        searches per resource type and chunk of `chunk_size` ids, attaches
+        them to the references (so `to_resource()` doesn't make requests)
+        and returns a dict of resources by reference string
+        """
+        grouped_references = group_references(references)
+        chunks_resources = await asyncio.gather(
+            *[
+                self._get_ids_searchset(resource_type, ids).fetch_all()
+                for resource_type, ids in iter_reference_chunks(
+                    grouped_references, chunk_size
+                )
+            ]
+        )
+        resources = {
+            resource.reference: resource
+            for chunk_resources in chunks_resources
+            for resource in chunk_resources
+        }
+        attach_resolved_resources(grouped_references, resources)
+
+        return resources
+
+    def _get_ids_searchset(self, resource_type, ids):
+        return self.resources(resource_type).search(_id=",".join(ids)).limit(len(ids))
+
+    def trace(self, path=None, sample_rate=1.0, max_events=1000000):
+        """
+        Returns context manager which records spans of the client
+        operations and requests made in the current context
+        and writes them to `path` in Chrome trace format on exit.
+        Only `sample_rate` share of root operations is recorded
+        (see `Tracer`)
+        """
+        return Tracer(self, path, sample_rate, max_events)
+
+    async def export(
+        self,
+        searchsets,
+        directory,
+        format="ndjson",
+        shard_size=None,
+        workers=None,
+        resume=True,
+    ):
+        """
+        Exports resources of `searchsets` (search sets or resource types)
+        to gzip NDJSON or Parquet shards in `directory`
+        and returns paths of the shards by resource type
+        (see `aidboxpy.export.Exporter`)
+        """
+        # Imported here to keep `python -m aidboxpy.export` runnable
+        from .export import Exporter
+
+        exporter = Exporter(self, directory, format, shard_size, workers, resume)
+
+        return await exporter.run(searchsets)
+
+    def batch(self, size=500, mode="batch", concurrency=4):
+        """
+        Returns async context manager which queues `save()` and `delete()`
+        of the client resources and sends them as Bundles of `size` entries.
+        Up to `concurrency` Bundles are sent simultaneously
+        """
+        return AsyncBatch(self, size=size, mode=mode, concurrency=concurrency)
+
+    async def define_query(self, name, sql, params=None, count_query=None):
+        """
+        Creates or updates `AidboxQuery` resource `name`.
+        `params` describes parameters of the `sql` query
+        (e.g. `{'org': {'type': 'string'}}` used as `{{params.org}}`)
+        """
+        query = self.resource(
+            "AidboxQuery", **get_query_definition(name, sql, params, count_query)
+        )
+        await query.save()
+
+        return query
+
+    async def query(self, name, **params):
+        """
+        Runs `AidboxQuery` `name` and returns rows as `AttrDict`s
+        """
+        response_data = await self._do_request(
+            "get", get_query_path(name), params=params
+        )
+
+        return (response_data or {}).get("data", [])
+
+    async def iter_query(self, name, page_size=100, **params):
+        """
+        Yields rows of `AidboxQuery` `name` requesting them page by page.
+        The query must declare `limit` and `offset` params
+        """
+        offset = 0
+        while True:
+            rows = await self.query(name, limit=page_size, offset=offset, **params)
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                return
+            offset += page_size
+
+    async def sql(self, query, params=None, resource_type=None):
+        """
+        Runs parameterised SQL `query` (with `?` placeholders for `params`)
+        via `$sql` and returns rows as `AttrDict`s.
+        With `resource_type` rows of Aidbox resource tables
+        (with `id` and `resource` columns) are returned as resources
+        """
+        rows = await self._do_request("post", "$sql", data=get_sql_body(query, params))
+
+        return self._decode_sql_rows(rows or [], resource_type)
+
+    async def iter_sql(
+        self, query, params=None, key="id", chunk_size=1000, resource_type=None
+    ):
+        """
+        Yields rows of SQL `query` fetching them in chunks of `chunk_size`
+        rows ordered by the unique `key` column (keyset pagination)
+        """
+        after = None
+        while True:
+            body = get_sql_chunk_body(query, params, key, chunk_size, after)
+            rows = await self._do_request("post", "$sql", data=body) or []
+            for row in self._decode_sql_rows(rows, resource_type):
+                yield row
+            if len(rows) < chunk_size:
+                return
+            after = rows[-1][key]
+
+    def _decode_sql_rows(self, rows, resource_type):
+        if resource_type is None:
+            return rows
+
+        return [
+            self.resource(resource_type, **{**row["resource"], "id": row["id"]})
+            for row in rows
+        ]
+
+    async def _iter_lines(self, path, params=None):
+        """
+        Yields non-empty lines of the chunked response (e.g. NDJSON).
+        The request is reported to the hooks when the response is consumed
+        or closed, it isn't retried or limited because the stream
+        can't be repeated after its lines are yielded
+        """
+        headers = self._build_request_headers()
+        url = self._build_request_url(path, params)
+        request = start_request(self.hooks, self.url, "get", url)
+        size = 0
+        r = None
+        try:
+            async with self.session.get(
+                url,
+                headers=headers,
+                trace_request_ctx=request.timings if request is not None else None,
+            ) as r:
+                if request is not None:
+                    request.timings.ttfb = request.elapsed()
+                if not 200 <= r.status < 300:
+                    content = await r.read()
+                    if request is not None:
+                        receive_response(request, r.status, r.headers, content)
+                    raise_for_response(r.status, content.decode())
+
+                # StreamReader.readline() limits the line length,
+                # so lines are split manually
+                tail = b""
+                async for chunk in r.content.iter_any():
+                    size += len(chunk)
+                    lines = (tail + chunk).split(b"\n")
+                    tail = lines.pop()
+                    for line in lines:
+                        if line.strip():
+                            yield line
+                if tail.strip():
+                    yield tail
+        except GeneratorExit:
+            # The caller stopped reading the stream
+            if request is not None:
+                finish_stream(request, r.status, r.headers, size)
+            raise
+        except BaseException as exc:
+            if request is not None:
+                request.fail(exc)
+            raise
+
+        if request is not None:
+            finish_stream(request, r.status, r.headers, size)
 
     def reference(self, resource_type=None, id=None, reference=None, **kwargs):
         resource_type = kwargs.pop("resourceType", resource_type)
@@ -0,0 +1,219 @@
+import asyncio
+from contextvars import ContextVar
+
+from fhirpy.base.exceptions import OperationOutcome
+
+from .trace import trace_span
+
+current_batch = ContextVar("current_batch", default=None)
+
+
+def get_current_batch(client):
+    """
+    Returns the batch opened for the `client` in the current context
+    """
+    batch = current_batch.get()
+    if batch is not None and batch.client is client:
+        return batch
+
+    return None
+
+
+class AbstractBatch:
+    """
+    Collects save/delete requests of resources and sends them
+    as Bundles of `size` entries.
+    In `transaction` mode every Bundle is a separate transaction
+    """
+
+    def __init__(self, client, size=500, mode="batch"):
+        if mode not in ("batch", "transaction"):
+            raise ValueError("Argument `mode` must be `batch` or `transaction`")
+        if size < 1:
+            raise ValueError("Argument `size` must be positive")
+
+        self.client = client
+        self.size = size
+        self.mode = mode
+        self._entries = []
+        # Requests of queued entries by resource object id
+        self._queued = {}
+        self._token = None
+
+    def _enter(self):
+        self._token = current_batch.set(self)
+
+    def _exit(self):
+        current_batch.reset(self._token)
+        self._token = None
+
+    def _add(self, resource, method, path, data=None):
+        request = {"request": {"method": method.upper(), "url": "/{0}".format(path)}}
+        if data is not None:
+            request["resource"] = data
+        queued = self._queued.get(id(resource))
+        if queued is not None:
+            # The resource saved or deleted again replaces its queued request,
+            # so a new resource isn't created twice
+            queued.clear()
+            queued.update(request)
+            return
+
+        self._queued[id(resource)] = request
+        self._entries.append((resource, request))
+
+    def _pop_entries(self):
+        entries, self._entries = self._entries[: self.size], self._entries[self.size :]
+        for resource, _ in entries:
+            del self._queued[id(resource)]
+
+        return entries
+
+    def _build_bundle(self, entries):
+        return {
+            "resourceType": "Bundle",
+            "type": self.mode,
+            "entry": [request for _, request in entries],
+        }
+
+    def _apply_response(self, entries, response_data):
+        errors = []
+        response_entries = (response_data or {}).get("entry", [])
+        for (resource, request), response_entry in zip(entries, response_entries):
+            status = str(response_entry.get("response", {}).get("status", "200"))
+            if not status[:1].isdigit() or int(status[:3]) >= 400:
+                errors.append(response_entry.get("response", {}).get("outcome"))
+                continue
+
+            self.client._invalidate_cached(resource)
+            data = response_entry.get("resource")
+            if data and request["request"]["method"] != "DELETE":
+                resource._update_from_response(data)
+
+        if errors:
+            outcome = errors[0]
+            if outcome and outcome.get("resourceType") == "OperationOutcome":
+                raise OperationOutcome(resource=outcome)
+            raise OperationOutcome(
+                reason="{0} of {1} batch entries failed".format(
+                    len(errors), len(entries)
+                )
+            )
+
+
+class SyncBatch(AbstractBatch):
+    def __enter__(self):
+        self._enter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._exit()
+        if exc_type is None:
+            self.flush()
+
+    def add(self, resource, method, path, data=None):
+        self._add(resource, method, path, data)
+        if len(self._entries) >= self.size:
+            self._flush_chunk()
+
+    def flush(self):
+        """
+        Sends all queued requests
+        """
+        while self._entries:
+            self._flush_chunk()
+
+    def _flush_chunk(self):
+        entries = self._pop_entries()
+        with trace_span(self.client, "batch", entries=len(entries)):
+            response_data = self.client._do_request(
+                "post", "", data=self._build_bundle(entries)
+            )
+            self._apply_response(entries, response_data)
+
+
+class AsyncBatch(AbstractBatch):
+    """
+    Up to `concurrency` Bundles are sent simultaneously
+    """
+
+    def __init__(self, client, size=500, mode="batch", concurrency=4):
+        super().__init__(client, size, mode)
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._tasks = set()
+        self._errors = []
+        # Ids of resource objects which are being created by sent Bundles
+        self._creating = set()
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._enter()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._exit()
+        if exc_type is None:
+            await self.flush()
+        else:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._errors = []
+
+    async def add(self, resource, method, path, data=None):
+        self._raise_error()
+        if id(resource) in self._creating:
+            raise ValueError(
+                "The resource is saved again while the Bundle creating it "
+                "is being sent, wait for it with `await batch.flush()`"
+            )
+        self._add(resource, method, path, data)
+        if len(self._entries) >= self.size:
+            await self._schedule_chunk()
+
+    async def flush(self):
+        """
+        Sends all queued requests and waits for all sent Bundles
+        """
+        while self._entries:
+            self._raise_error()
+            await self._schedule_chunk()
+        # Errors are collected by `_on_chunk_done()`
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._raise_error()
+
+    def _raise_error(self):
+        # Every failure of sent Bundles is raised once
+        if self._errors:
+            raise self._errors.pop(0)
+
+    def _on_chunk_done(self, task):
+        # Finished tasks are dropped to release their entries
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self._errors.append(task.exception())
+
+    async def _schedule_chunk(self):
+        # Waiting for a free slot here gives backpressure to the producer
+        await self._semaphore.acquire()
+        entries = self._pop_entries()
+        creating = {
+            id(resource)
+            for resource, request in entries
+            if request["request"]["method"] == "POST"
+        }
+        self._creating |= creating
+
+        async def flush_chunk():
+            try:
+                with trace_span(self.client, "batch", entries=len(entries)):
+                    response_data = await self.client._do_request(
+                        "post", "", data=self._build_bundle(entries)
+                    )
+                    self._apply_response(entries, response_data)
+            finally:
+                self._creating -= creating
+                self._semaphore.release()
+
+        task = asyncio.ensure_future(flush_chunk())
+        task.add_done_callback(self._on_chunk_done)
+        self._tasks.add(task)
@@ -0,0 +1,81 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ("data", "etag", "expires_at")
+
+    def __init__(self, data, etag, expires_at):
+        self.data = data
+        self.etag = etag
+        self.expires_at = expires_at
+
+    @property
+    def is_fresh(self):
+        return self.expires_at is None or time.monotonic() < self.expires_at
+
+
+class ResourceCache:
+    """
+    Identity map of resources data keyed by `resourceType/id`.
+    Keeps up to `maxsize` least recently used entries.
+    Entries older than `ttl` seconds are revalidated with `If-None-Match`
+    (`ttl=None` disables revalidation, `ttl=0` revalidates every read)
+
+    >>> cache = ResourceCache(maxsize=2)
+    >>> cache.set('Patient/1', {'id': '1'}, 'W/"1"')
+    >>> cache.set('Patient/2', {'id': '2'}, 'W/"1"')
+    >>> cache.get('Patient/1').data
+    {'id': '1'}
+    >>> cache.set('Patient/3', {'id': '3'}, 'W/"1"')
+    >>> cache.get('Patient/2') is None
+    True
+    >>> cache.invalidate('Patient/1')
+    >>> len(cache)
+    1
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get_expires_at(self):
+        return None if self.ttl is None else time.monotonic() + self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+            return entry
+
+    def set(self, key, data, etag=None):
+        with self._lock:
+            self._entries[key] = CacheEntry(data, etag, self._get_expires_at())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def touch(self, key):
+        """
+        Marks the entry as fresh after successful revalidation
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = self._get_expires_at()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
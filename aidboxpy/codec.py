@@ -0,0 +1,97 @@
+import json
+
+from fhirpy.base.utils import AttrDict
+
+
+class JSONCodec:
+    """
+    Encodes and decodes request/response bodies with the stdlib `json`.
+    `dumps()` returns bytes, `loads()` accepts bytes or str
+    and returns plain dicts/lists.
+    `loads_attrdict()` is used for responses returned to the user as is
+    (e.g. `execute()` results) where dicts must be `AttrDict`
+    """
+
+    name = "json"
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def loads(self, content):
+        return json.loads(content)
+
+    def loads_attrdict(self, content):
+        # object_hook is faster than converting decoded data afterwards
+        return json.loads(content, object_hook=AttrDict)
+
+
+class OrjsonCodec(JSONCodec):
+    name = "orjson"
+
+    def __init__(self):
+        import orjson
+
+        self._orjson = orjson
+
+    def dumps(self, data):
+        return self._orjson.dumps(data)
+
+    def loads(self, content):
+        return self._orjson.loads(content)
+
+
+class UjsonCodec(JSONCodec):
+    name = "ujson"
+
+    def __init__(self):
+        import ujson
+
+        self._ujson = ujson
+
+    def dumps(self, data):
+        return self._ujson.dumps(
+            data, ensure_ascii=False, escape_forward_slashes=False
+        ).encode()
+
+    def loads(self, content):
+        return self._ujson.loads(content)
+
+
+JSON_CODECS = {
+    "json": JSONCodec,
+    "orjson": OrjsonCodec,
+    "ujson": UjsonCodec,
+}
+
+
+def get_json_codec(json_codec=None):
+    """
+    Returns codec instance by name (`json`, `orjson`, `ujson`
+    or `auto` for the fastest installed one) or the passed codec itself
+
+    >>> get_json_codec().name
+    'json'
+
+    >>> get_json_codec('auto').name in JSON_CODECS
+    True
+    """
+    if json_codec is None:
+        return JSONCodec()
+    if not isinstance(json_codec, str):
+        return json_codec
+    if json_codec == "auto":
+        for codec_class in (OrjsonCodec, UjsonCodec):
+            try:
+                return codec_class()
+            except ImportError:
+                pass
+        return JSONCodec()
+
+    if json_codec not in JSON_CODECS:
+        raise ValueError(
+            "Unknown json codec `{0}`, expected one of: {1}, auto".format(
+                json_codec, ", ".join(JSON_CODECS)
+            )
+        )
+
+    return JSON_CODECS[json_codec]()
@@ -0,0 +1,149 @@
+from fhirpy.base.exceptions import InvalidResponse
+
+COLUMN_FORMATS = ("dict", "numpy", "pandas", "arrow")
+
+
+def normalize_path(path):
+    """
+    Returns path as a list of keys, string paths are split by dots
+    and numeric parts are converted to indexes
+
+    >>> normalize_path('name.0.family')
+    ['name', 0, 'family']
+    >>> normalize_path(['name', 0, 'family'])
+    ['name', 0, 'family']
+    """
+    if isinstance(path, str):
+        return [int(key) if key.isdigit() else key for key in path.split(".")]
+
+    return list(path)
+
+
+def get_column_name(path):
+    """
+    >>> get_column_name(['name', 0, 'family'])
+    'name.0.family'
+    """
+    return ".".join(str(key) for key in path)
+
+
+def get_path_value(data, path):
+    """
+    Returns value of the decoded resource by `path` or None if it's missing
+
+    >>> get_path_value({'name': [{'family': 'Doe'}]}, ['name', 0, 'family'])
+    'Doe'
+    >>> get_path_value({'name': []}, ['name', 0, 'family']) is None
+    True
+    """
+    for key in path:
+        try:
+            data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return data
+
+
+class ColumnBuilder:
+    """
+    Collects values of `paths` of the primary resources of search Bundles
+    into per-column buffers and builds columns in the `format`:
+    `dict` (dict of lists), `numpy` (dict of arrays), `pandas` (DataFrame)
+    or `arrow` (pyarrow RecordBatch).
+    `dtypes` maps column names to numpy/pandas dtypes
+
+    >>> builder = ColumnBuilder('Patient', ['id', 'name.0.family'])
+    >>> builder.add_bundle({'resourceType': 'Bundle', 'entry': [
+    ...     {'resource': {'resourceType': 'Patient', 'id': 'p1'}}]})
+    >>> builder.build()
+    {'id': ['p1'], 'name.0.family': [None]}
+    >>> len(builder)
+    0
+    """
+
+    def __init__(self, resource_type, paths, format="dict", dtypes=None):
+        if not paths:
+            raise ValueError("Argument `paths` must not be empty")
+        if format not in COLUMN_FORMATS:
+            raise ValueError(
+                "Unknown columns format `{0}`, expected one of: {1}".format(
+                    format, ", ".join(COLUMN_FORMATS)
+                )
+            )
+
+        self.resource_type = resource_type
+        self.paths = [normalize_path(path) for path in paths]
+        self.names = [get_column_name(path) for path in self.paths]
+        self.format = format
+        self.dtypes = dtypes or {}
+        self._buffers = [[] for _ in self.paths]
+
+    def __len__(self):
+        return len(self._buffers[0])
+
+    @property
+    def elements(self):
+        """
+        Top-level elements which are enough to fill the columns
+        """
+        return sorted({str(path[0]) for path in self.paths})
+
+    def add_bundle(self, bundle_data):
+        bundle_resource_type = bundle_data.get("resourceType", None)
+        if bundle_resource_type != "Bundle":
+            raise InvalidResponse(
+                "Expected to receive Bundle "
+                "but {0} received".format(bundle_resource_type)
+            )
+
+        columns = list(zip(self.paths, self._buffers))
+        for entry in bundle_data.get("entry", []):
+            data = entry["resource"]
+            if data.get("resourceType") != self.resource_type:
+                continue
+            for path, buffer in columns:
+                buffer.append(get_path_value(data, path))
+
+    def build(self):
+        """
+        Returns collected columns and empties the buffers
+        """
+        columns = dict(zip(self.names, self._buffers))
+        self._buffers = [[] for _ in self.paths]
+
+        if self.format == "numpy":
+            return self._build_numpy(columns)
+        if self.format == "pandas":
+            return self._build_pandas(columns)
+        if self.format == "arrow":
+            return self._build_arrow(columns)
+
+        return columns
+
+    def _build_numpy(self, columns):
+        import numpy
+
+        arrays = {}
+        for name, values in columns.items():
+            if any(isinstance(value, (dict, list)) for value in values):
+                # Nested values are kept as objects instead of extra dimensions
+                array = numpy.empty(len(values), dtype=object)
+                array[:] = values
+            else:
+                array = numpy.array(values, dtype=self.dtypes.get(name))
+            arrays[name] = array
+
+        return arrays
+
+    def _build_pandas(self, columns):
+        import pandas
+
+        data_frame = pandas.DataFrame(columns, columns=self.names)
+
+        return data_frame.astype(self.dtypes) if self.dtypes else data_frame
+
+    def _build_arrow(self, columns):
+        import pyarrow
+
+        return pyarrow.RecordBatch.from_pydict(columns)
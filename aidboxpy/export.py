@@ -0,0 +1,322 @@
+"""
+Exports resources of search sets to local gzip NDJSON or Parquet shards
+
+    python -m aidboxpy.export --url http://localhost:8080 \\
+        --output export Patient 'Observation?status=final'
+"""
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from fhirpy.base.utils import parse_pagination_url
+
+from .codec import JSON_CODECS, get_json_codec
+
+EXPORT_FORMATS = {"ndjson": ".ndjson.gz", "parquet": ".parquet"}
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+
+DEFAULT_SHARD_SIZE = 128 * 2**20
+
+
+def get_shard_path(directory, resource_type, index, format):
+    """
+    >>> get_shard_path('export', 'Patient', 2, 'ndjson')
+    'export/Patient.00002.ndjson.gz'
+    """
+    return os.path.join(
+        directory, "{0}.{1:05d}{2}".format(resource_type, index, EXPORT_FORMATS[format])
+    )
+
+
+def write_ndjson_page(path, resources, codec_name, compress):
+    """
+    Appends resources to the NDJSON file and returns the file size.
+    Compressed pages are written as separate gzip members
+    (concatenated members are read as a single gzip file)
+    """
+    codec = get_json_codec(codec_name)
+    content = b"".join(codec.dumps(resource) + b"\n" for resource in resources)
+    if compress:
+        content = gzip.compress(content)
+
+    with open(path, "ab") as fd:
+        fd.write(content)
+
+    return os.path.getsize(path)
+
+
+def flatten_resource(data):
+    """
+    Returns resource with nested values encoded as JSON strings
+
+    >>> flatten_resource({'id': 'p1', 'name': [{'family': 'Doe'}]})
+    {'id': 'p1', 'name': '[{"family":"Doe"}]'}
+    """
+    return {
+        key: (
+            json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+            if isinstance(value, (dict, list))
+            else value
+        )
+        for key, value in data.items()
+    }
+
+
+def write_parquet_shard(staged_path, path):
+    """
+    Converts the staged NDJSON file into the Parquet file with a column
+    per top-level element. Nested elements are stored as JSON strings
+    because empty objects and varying nested schemas of FHIR resources
+    can't be stored as Parquet structs
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    with open(staged_path, "rb") as fd:
+        rows = [flatten_resource(json.loads(line)) for line in fd]
+
+    columns = {}
+    for row in rows:
+        for key in row:
+            columns.setdefault(key, None)
+    table = pyarrow.table({key: [row.get(key) for row in rows] for key in columns})
+    pyarrow.parquet.write_table(table, path)
+    os.remove(staged_path)
+
+
+class Exporter:
+    """
+    Exports resources of search sets of the async `client` to `directory`
+    as `ndjson` (gzip) or `parquet` shards of about `shard_size` bytes
+    (128 MiB by default): gzip file size for NDJSON
+    and uncompressed NDJSON size for Parquet.
+    Search sets are fetched concurrently with cursor pagination,
+    encoding and compression run in a pool of `workers` processes.
+    Progress is saved after every shard to `checkpoint.json`
+    and the export is resumed from it when `resume` is True
+    """
+
+    def __init__(
+        self,
+        client,
+        directory,
+        format="ndjson",
+        shard_size=None,
+        workers=None,
+        resume=True,
+    ):
+        if shard_size is None:
+            shard_size = DEFAULT_SHARD_SIZE
+        if format not in EXPORT_FORMATS:
+            raise ValueError(
+                "Unknown export format `{0}`, expected one of: {1}".format(
+                    format, ", ".join(EXPORT_FORMATS)
+                )
+            )
+        if shard_size < 1:
+            raise ValueError("Argument `shard_size` must be positive")
+
+        self.client = client
+        self.directory = directory
+        self.format = format
+        self.shard_size = shard_size
+        self.workers = workers
+        self.resume = resume
+        codec_name = client.json_codec.name
+        self._codec_name = codec_name if codec_name in JSON_CODECS else "json"
+        self._checkpoint = {}
+
+    @property
+    def checkpoint_path(self):
+        return os.path.join(self.directory, CHECKPOINT_FILENAME)
+
+    def _load_checkpoint(self):
+        if self.resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as fd:
+                return json.load(fd)
+
+        return {}
+
+    def _save_checkpoint(self):
+        # The checkpoint is replaced atomically to survive interruptions
+        staged_path = self.checkpoint_path + ".part"
+        with open(staged_path, "w") as fd:
+            json.dump(self._checkpoint, fd)
+        os.replace(staged_path, self.checkpoint_path)
+
+    def _get_searchset(self, searchset):
+        if isinstance(searchset, str):
+            return self.client.resources(searchset)
+
+        return searchset
+
+    async def run(self, searchsets):
+        """
+        Exports all `searchsets` (search sets or resource types)
+        and returns paths of the shards by resource type
+        """
+        searchsets = [self._get_searchset(searchset) for searchset in searchsets]
+        resource_types = [searchset.resource_type for searchset in searchsets]
+        if len(set(resource_types)) != len(resource_types):
+            raise ValueError("Every resource type can be exported only once")
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._checkpoint = self._load_checkpoint()
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            tasks = [
+                asyncio.ensure_future(self._export(searchset, pool))
+                for searchset in searchsets
+            ]
+            try:
+                shards_counts = await asyncio.gather(*tasks)
+            finally:
+                # Exports of other resource types are stopped on failure,
+                # their progress is kept in the checkpoint
+                for task in tasks:
+                    task.cancel()
+
+        return {
+            resource_type: [
+                get_shard_path(self.directory, resource_type, index, self.format)
+                for index in range(shards_count)
+            ]
+            for resource_type, shards_count in zip(resource_types, shards_counts)
+        }
+
+    async def _export(self, searchset, pool):
+        resource_type = searchset.resource_type
+        state = self._checkpoint.setdefault(
+            resource_type, {"after": None, "shards": 0, "done": False}
+        )
+        if state["done"]:
+            return state["shards"]
+
+        loop = asyncio.get_event_loop()
+        shard_path = staged_path = None
+        # The page is encoded while the next one is fetched
+        pending_write = pending_token = None
+
+        async def finish_write():
+            size = await pending_write
+            if size >= self.shard_size:
+                await close_shard()
+
+        async def close_shard():
+            nonlocal shard_path
+            if self.format == "parquet":
+                await loop.run_in_executor(
+                    pool, write_parquet_shard, staged_path, shard_path
+                )
+            else:
+                os.replace(staged_path, shard_path)
+            shard_path = None
+            state["after"] = pending_token
+            state["shards"] += 1
+            self._save_checkpoint()
+
+        cursor_searchset = searchset.cursor(after=state["after"])
+        async for bundle_data, token in cursor_searchset._fetch_cursor_bundles():
+            resources = [
+                entry["resource"]
+                for entry in bundle_data.get("entry", [])
+                if entry["resource"].get("resourceType") == resource_type
+            ]
+            if not resources:
+                continue
+
+            if pending_write is not None:
+                await finish_write()
+            if shard_path is None:
+                shard_path = get_shard_path(
+                    self.directory, resource_type, state["shards"], self.format
+                )
+                staged_path = shard_path + ".part"
+                # Left by the interrupted export
+                if os.path.exists(staged_path):
+                    os.remove(staged_path)
+
+            pending_write = loop.run_in_executor(
+                pool,
+                write_ndjson_page,
+                staged_path,
+                resources,
+                self._codec_name,
+                self.format == "ndjson",
+            )
+            pending_token = token
+
+        if pending_write is not None:
+            await finish_write()
+        if shard_path is not None:
+            await close_shard()
+        state["done"] = True
+        self._save_checkpoint()
+
+        return state["shards"]
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m aidboxpy.export",
+        description="Exports Aidbox resources to gzip NDJSON or Parquet shards",
+    )
+    parser.add_argument(
+        "searches",
+        nargs="+",
+        help="resource types with optional search params, e.g. Patient?active=true",
+    )
+    parser.add_argument("--url", required=True, help="Aidbox base url")
+    parser.add_argument("--authorization", help="Authorization header value")
+    parser.add_argument("--output", default=".", help="output directory")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--shard-size", type=int, default=DEFAULT_SHARD_SIZE)
+    parser.add_argument("--page-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, help="number of encoding processes")
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="ignore the checkpoint of the previous export",
+    )
+
+    return parser.parse_args(args)
+
+
+def get_searchset(client, search, page_size):
+    """
+    Returns the search set of the `ResourceType?param=value` string
+    """
+    resource_type, params = parse_pagination_url(search)
+    searchset = client.resources(resource_type).limit(page_size)
+
+    return searchset.clone(override=True, **(params or {}))
+
+
+async def export(args):
+    from . import AsyncAidboxClient
+
+    async with AsyncAidboxClient(args.url, authorization=args.authorization) as client:
+        shards = await client.export(
+            [get_searchset(client, search, args.page_size) for search in args.searches],
+            args.output,
+            format=args.format,
+            shard_size=args.shard_size,
+            workers=args.workers,
+            resume=args.resume,
+        )
+
+    for resource_type, paths in shards.items():
+        print("{0}: {1} shards".format(resource_type, len(paths)))
+
+
+def main(args=None):
+    asyncio.run(export(parse_args(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import time
+from urllib.parse import urlparse
+
+import aiohttp
+
+from .utils import RawResponse
+
+
+class RequestHooks:
+    """
+    Base class of request lifecycle hooks passed to the clients via `hooks`.
+    Hooks are called for every sent request (retries and hedged
+    duplicates included) with `RequestInfo` of the request:
+    `on_request_start()` before sending, `on_response()` when the response
+    is received and decoded, `on_error()` when sending or decoding fails
+    """
+
+    def on_request_start(self, request):
+        pass
+
+    def on_response(self, request, response):
+        pass
+
+    def on_error(self, request, error):
+        pass
+
+
+class RequestTimings:
+    """
+    Durations in seconds of the request phases: `connect` (opening
+    a new connection, None for reused connections or when it can't be
+    measured), `ttfb` (until response headers, connect included),
+    `body` (reading the body) and `parse` (decoding JSON, None if
+    the body isn't decoded)
+    """
+
+    __slots__ = ("connect", "ttfb", "body", "parse")
+
+    def __init__(self):
+        self.connect = None
+        self.ttfb = None
+        self.body = None
+        self.parse = None
+
+    @property
+    def total(self):
+        return sum(
+            timing
+            for timing in (self.ttfb, self.body, self.parse)
+            if timing is not None
+        )
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def get_request_path(base_url, url):
+    """
+    Returns path of the `url` relative to the `base_url`
+
+    >>> get_request_path('http://aidbox/fhir', 'http://aidbox/fhir/Patient/1?a=b')
+    'Patient/1'
+    """
+    path = urlparse(url).path
+    base_path = urlparse(base_url).path.rstrip("/")
+    if base_path and path.startswith(base_path):
+        path = path[len(base_path) :]
+
+    return path.strip("/")
+
+
+def get_endpoint(method, path):
+    """
+    Returns endpoint of the request (path with ids replaced by placeholders)
+    and resource type of the request or None
+
+    >>> get_endpoint('get', 'Patient/p1/_history/2')
+    ('GET Patient/{id}/_history/{vid}', 'Patient')
+    >>> get_endpoint('post', '$query/patients')
+    ('POST $query/{name}', None)
+    >>> get_endpoint('post', '')
+    ('POST /', None)
+    """
+    segments = path.split("/") if path else []
+    resource_type = None
+    if segments and segments[0][:1].isupper():
+        resource_type = segments[0]
+        if len(segments) > 1 and segments[1][:1] not in ("$", "_"):
+            segments[1] = "{id}"
+        if len(segments) > 3 and segments[2] == "_history":
+            segments[3] = "{vid}"
+    elif len(segments) > 1 and segments[0].startswith("$"):
+        segments[1:] = ["{name}"]
+
+    return "{0} {1}".format(method.upper(), "/".join(segments) or "/"), resource_type
+
+
+class RequestInfo:
+    """
+    Request passed to the hooks. `status`, `bytes` (body size)
+    and `timings` (`RequestTimings`) are set when the response is received
+    """
+
+    __slots__ = (
+        "method",
+        "url",
+        "endpoint",
+        "resource_type",
+        "status",
+        "bytes",
+        "timings",
+        "started_at",
+        "_hooks",
+        "_finished",
+    )
+
+    def __init__(self, hooks, method, url, path):
+        self.method = method.upper()
+        self.url = url
+        self.endpoint, self.resource_type = get_endpoint(method, path)
+        self.status = None
+        self.bytes = None
+        self.timings = RequestTimings()
+        self.started_at = time.perf_counter()
+        self._hooks = hooks
+        self._finished = False
+        for hook in hooks:
+            hook.on_request_start(self)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started_at
+
+    def receive(self, status, size):
+        """
+        Records the received response with the body of `size` bytes,
+        the time since the start (without time to the headers)
+        is the body reading time
+        """
+        self.status = status
+        self.bytes = size
+        self.timings.body = self.elapsed() - self.timings.ttfb
+
+    def finish(self, response, parse=None):
+        # The response of coalesced requests is decoded by every caller
+        if self._finished:
+            return
+        self._finished = True
+        self.timings.parse = parse
+        for hook in self._hooks:
+            hook.on_response(self, response)
+
+    def fail(self, error):
+        if self._finished:
+            return
+        self._finished = True
+        for hook in self._hooks:
+            hook.on_error(self, error)
+
+
+def start_request(hooks, base_url, method, url):
+    """
+    Returns `RequestInfo` of the request calling `on_request_start` hooks
+    or None if there are no hooks
+    """
+    if not hooks:
+        return None
+
+    return RequestInfo(hooks, method, url, get_request_path(base_url, url))
+
+
+async def on_connection_create_start(session, trace_config_ctx, params):
+    trace_config_ctx.connect_started_at = time.perf_counter()
+
+
+async def on_connection_create_end(session, trace_config_ctx, params):
+    timings = trace_config_ctx.trace_request_ctx
+    if timings is not None:
+        timings.connect = time.perf_counter() - trace_config_ctx.connect_started_at
+
+
+def get_trace_config():
+    """
+    Returns aiohttp `TraceConfig` recording connect time
+    to `RequestTimings` passed as `trace_request_ctx`
+    """
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+
+    return trace_config
+
+
+def receive_response(request, status, headers, content):
+    """
+    Returns `RawResponse` of the request. Hooks are called at once
+    for unsuccessful responses, successful ones are reported
+    by `get_response_data()` after decoding
+    """
+    request.receive(status, len(content))
+    response = RawResponse(status, headers, content, request)
+    if not 200 <= status < 300:
+        request.finish(response)
+
+    return response
+
+
+def finish_stream(request, status, headers, size):
+    """
+    Reports the consumed (or closed) streamed response of `size` bytes
+    to the hooks, the body isn't kept, so `RawResponse.content` is None
+    """
+    request.receive(status, size)
+    request.finish(RawResponse(status, headers, None, request))
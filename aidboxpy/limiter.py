@@ -0,0 +1,150 @@
+import asyncio
+import time
+from collections import deque
+
+# Statuses the server responds with when it's overloaded
+OVERLOAD_STATUSES = frozenset([429, 503])
+
+
+class AdaptiveLimiter:
+    """
+    Limits the number of in-flight requests adjusting the limit with AIMD:
+    every successful request increases the limit by `1 / limit`
+    (so it grows by one per `limit` requests) up to `max_limit`,
+    overload (429/503 responses or timeouts) multiplies it
+    by `backoff` down to `min_limit`.
+    If `latency_tolerance` is set, latency more than `latency_tolerance`
+    times the minimal latency of the last `latency_window` requests
+    to the same endpoint is an overload too.
+    Requests over the limit wait in FIFO order
+
+    >>> limiter = AdaptiveLimiter(initial_limit=4, max_limit=5)
+    >>> limiter.limit
+    4
+    >>> for _ in range(5):
+    ...     limiter.on_response(0.1, overloaded=False)
+    >>> limiter.limit
+    5
+    >>> limiter.on_response(0.1, overloaded=True)
+    >>> limiter.limit
+    2
+    """
+
+    def __init__(
+        self,
+        initial_limit=10,
+        min_limit=1,
+        max_limit=100,
+        backoff=0.5,
+        latency_tolerance=None,
+        latency_window=100,
+    ):
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError(
+                "Limits must satisfy 1 <= min_limit <= initial_limit <= max_limit"
+            )
+        if not 0 < backoff < 1:
+            raise ValueError("Argument `backoff` must be between 0 and 1")
+        if latency_window < 1:
+            raise ValueError("Argument `latency_window` must be positive")
+
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latency_window = latency_window
+        self.in_flight = 0
+        self._limit = float(initial_limit)
+        self._latencies = {}
+        self._decreased_at = None
+        self._waiters = deque()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def queue_depth(self):
+        return len(self._waiters)
+
+    def get_metrics(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+        }
+
+    async def acquire(self):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was already given to this waiter
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _get_min_latency(self, endpoint, latency):
+        """
+        Records the `latency` and returns the minimal latency
+        of the last `latency_window` requests to the `endpoint`
+        """
+        # Increasing latencies with their sequence numbers, the first one
+        # is the minimum of the window
+        window = self._latencies.get(endpoint)
+        if window is None:
+            window = self._latencies[endpoint] = [deque(), 0]
+        latencies, count = window
+        while latencies and latencies[-1][1] >= latency:
+            latencies.pop()
+        latencies.append((count, latency))
+        if latencies[0][0] <= count - self.latency_window:
+            latencies.popleft()
+        window[1] = count + 1
+
+        return latencies[0][1]
+
+    def on_response(self, latency, overloaded, endpoint=None):
+        """
+        Adjusts the limit with the `latency` (in seconds) of the finished
+        request to the `endpoint` and whether the server was `overloaded`
+
+        >>> limiter = AdaptiveLimiter(latency_tolerance=2.0, latency_window=2)
+        >>> for latency in [0.01, 0.1, 0.1]:
+        ...     limiter.on_response(latency, overloaded=False)
+        >>> limiter.limit
+        5
+        >>> limiter.on_response(0.1, overloaded=False)
+        >>> limiter.limit
+        5
+        """
+        if not overloaded and self.latency_tolerance is not None:
+            min_latency = self._get_min_latency(endpoint, latency)
+            overloaded = latency > min_latency * self.latency_tolerance
+
+        if not overloaded:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            return
+
+        # Requests sent before the decrease report the same overload,
+        # so the limit is decreased at most once per request latency
+        now = time.monotonic()
+        if self._decreased_at is not None and now - self._decreased_at < latency:
+            return
+        self._decreased_at = now
+        self._limit = max(self.min_limit, self._limit * self.backoff)
@@ -0,0 +1,289 @@
+import math
+import threading
+
+from .hooks import RequestHooks
+
+TIMING_PHASES = ("connect", "ttfb", "body", "parse")
+
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+
+class LatencyHistogram:
+    """
+    HDR-style histogram of latencies in seconds recorded with microsecond
+    resolution: values below 128 µs are counted exactly, larger ones
+    in log-linear buckets (64 buckets per power of two), so percentiles
+    are within 1.6% of the recorded values with constant memory
+
+    >>> histogram = LatencyHistogram()
+    >>> for latency in [0.001, 0.002, 0.003, 0.004, 0.1]:
+    ...     histogram.record(latency)
+    >>> histogram.count, histogram.max
+    (5, 0.1)
+    >>> abs(histogram.percentile(50) - 0.003) < 0.003 * 0.016
+    True
+    """
+
+    sub_bucket_bits = 6
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self._counts = {}
+
+    def _get_bucket(self, microseconds):
+        shift = max(0, microseconds.bit_length() - self.sub_bucket_bits - 1)
+        if not shift:
+            return microseconds
+
+        return (shift << (self.sub_bucket_bits + 1)) + (microseconds >> shift)
+
+    def _get_bucket_value(self, bucket):
+        shift = bucket >> (self.sub_bucket_bits + 1)
+        if not shift:
+            return bucket / 1e6
+
+        mantissa = bucket - (shift << (self.sub_bucket_bits + 1))
+        # The middle of the bucket
+        return ((mantissa << shift) + (1 << shift) / 2) / 1e6
+
+    def record(self, latency):
+        bucket = self._get_bucket(max(0, int(latency * 1e6)))
+        self._counts[bucket] = self._counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += latency
+        self.min = latency if self.min is None else min(self.min, latency)
+        self.max = latency if self.max is None else max(self.max, latency)
+
+    def percentile(self, percentile):
+        """
+        Returns the latency below which `percentile` of values fall
+        or None if nothing is recorded
+        """
+        if not self.count:
+            return None
+
+        rank = max(1, math.ceil(self.count * percentile / 100))
+        seen = 0
+        for bucket in sorted(self._counts):
+            seen += self._counts[bucket]
+            if seen >= rank:
+                return min(self.max, max(self.min, self._get_bucket_value(bucket)))
+
+        return self.max
+
+    def as_dict(self, percentiles=DEFAULT_PERCENTILES):
+        data = {
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.sum / self.count if self.count else None,
+        }
+        for percentile in percentiles:
+            data["p{0}".format(percentile)] = self.percentile(percentile)
+
+        return data
+
+
+class EndpointMetrics:
+    def __init__(self, resource_type):
+        self.resource_type = resource_type
+        self.requests = 0
+        self.errors = {}
+        self.statuses = {}
+        self.bytes = 0
+        self.latency = LatencyHistogram()
+        self.timings = {phase: 0.0 for phase in TIMING_PHASES}
+
+    def as_dict(self, percentiles):
+        return {
+            "resource_type": self.resource_type,
+            "requests": self.requests,
+            "errors": dict(self.errors),
+            "statuses": dict(self.statuses),
+            "bytes": self.bytes,
+            "latency": self.latency.as_dict(percentiles),
+            "timings": dict(self.timings),
+        }
+
+
+class MetricsCollector(RequestHooks):
+    """
+    Hooks which collect per-endpoint (`GET Patient/{id}`) and
+    per-resource-type request counters, statuses, errors, response bytes,
+    sums of request phase timings and latency histograms.
+    Metrics are returned by `get_metrics()` as a dict
+    or by `to_prometheus()` in Prometheus text format
+    """
+
+    def __init__(self, percentiles=DEFAULT_PERCENTILES):
+        self.percentiles = percentiles
+        self.in_flight = 0
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def _get_endpoint(self, request):
+        metrics = self._endpoints.get(request.endpoint)
+        if metrics is None:
+            metrics = self._endpoints[request.endpoint] = EndpointMetrics(
+                request.resource_type
+            )
+
+        return metrics
+
+    def on_request_start(self, request):
+        with self._lock:
+            self.in_flight += 1
+            self._get_endpoint(request).requests += 1
+
+    def on_response(self, request, response):
+        timings = request.timings
+        with self._lock:
+            self.in_flight -= 1
+            metrics = self._get_endpoint(request)
+            status = str(request.status)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.bytes += request.bytes
+            metrics.latency.record(timings.total)
+            for phase in TIMING_PHASES:
+                metrics.timings[phase] += getattr(timings, phase) or 0.0
+
+    def on_error(self, request, error):
+        error_type = type(error).__name__
+        with self._lock:
+            self.in_flight -= 1
+            metrics = self._get_endpoint(request)
+            metrics.errors[error_type] = metrics.errors.get(error_type, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def get_metrics(self):
+        """
+        Returns metrics by endpoint and totals by resource type
+        """
+        with self._lock:
+            endpoints = {
+                endpoint: metrics.as_dict(self.percentiles)
+                for endpoint, metrics in self._endpoints.items()
+            }
+            in_flight = self.in_flight
+
+        resource_types = {}
+        for metrics in endpoints.values():
+            totals = resource_types.setdefault(
+                metrics["resource_type"] or "", {"requests": 0, "errors": 0, "bytes": 0}
+            )
+            totals["requests"] += metrics["requests"]
+            totals["errors"] += sum(metrics["errors"].values())
+            totals["bytes"] += metrics["bytes"]
+
+        return {
+            "in_flight": in_flight,
+            "endpoints": endpoints,
+            "resource_types": resource_types,
+        }
+
+    def to_prometheus(self, prefix="aidbox_client"):
+        """
+        Returns metrics in Prometheus text exposition format,
+        latency histograms are exported as summaries
+        """
+        metrics = self.get_metrics()
+        lines = []
+
+        def add(name, metric_type, samples):
+            lines.append("# TYPE {0}_{1} {2}".format(prefix, name, metric_type))
+            for suffix, labels, value in samples:
+                lines.append(
+                    "{0}_{1}{2}{{{3}}} {4}".format(
+                        prefix,
+                        name,
+                        suffix,
+                        ",".join(
+                            '{0}="{1}"'.format(key, format_label(label))
+                            for key, label in labels
+                        ),
+                        value,
+                    )
+                )
+
+        endpoints = sorted(metrics["endpoints"].items())
+
+        def get_labels(endpoint, data, *extra):
+            return (
+                ("endpoint", endpoint),
+                ("resource_type", data["resource_type"] or ""),
+            ) + extra
+
+        add(
+            "requests_total",
+            "counter",
+            [("", get_labels(*item), item[1]["requests"]) for item in endpoints],
+        )
+        add(
+            "responses_total",
+            "counter",
+            [
+                ("", get_labels(endpoint, data, ("status", status)), count)
+                for endpoint, data in endpoints
+                for status, count in sorted(data["statuses"].items())
+            ],
+        )
+        add(
+            "errors_total",
+            "counter",
+            [
+                ("", get_labels(endpoint, data, ("error", error)), count)
+                for endpoint, data in endpoints
+                for error, count in sorted(data["errors"].items())
+            ],
+        )
+        add(
+            "response_bytes_total",
+            "counter",
+            [("", get_labels(*item), item[1]["bytes"]) for item in endpoints],
+        )
+        add(
+            "phase_seconds_total",
+            "counter",
+            [
+                (
+                    "",
+                    get_labels(endpoint, data, ("phase", phase)),
+                    data["timings"][phase],
+                )
+                for endpoint, data in endpoints
+                for phase in TIMING_PHASES
+            ],
+        )
+
+        samples = []
+        for endpoint, data in endpoints:
+            latency = data["latency"]
+            for percentile in self.percentiles:
+                value = latency["p{0}".format(percentile)]
+                if value is not None:
+                    labels = get_labels(
+                        endpoint, data, ("quantile", str(percentile / 100))
+                    )
+                    samples.append(("", labels, value))
+            samples.append(("_sum", get_labels(endpoint, data), latency["sum"]))
+            samples.append(("_count", get_labels(endpoint, data), latency["count"]))
+        add("request_duration_seconds", "summary", samples)
+        lines.append("# TYPE {0}_in_flight gauge".format(prefix))
+        lines.append("{0}_in_flight {1}".format(prefix, metrics["in_flight"]))
+
+        return "\n".join(lines) + "\n"
+
+
+def format_label(value):
+    """
+    >>> format_label('a"b')
+    'a\\\\"b'
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
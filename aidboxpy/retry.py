@@ -0,0 +1,218 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+class RetryBudget:
+    """
+    Token bucket limiting additional requests (retries and hedges)
+    to `ratio` of the original requests.
+    The bucket holds up to `max_tokens` tokens (and starts full),
+    every original request deposits `ratio` tokens
+    and every additional request withdraws one token
+
+    >>> budget = RetryBudget(ratio=0.5, max_tokens=1)
+    >>> budget.withdraw(), budget.withdraw()
+    (True, False)
+    >>> budget.deposit()
+    >>> budget.deposit()
+    >>> budget.withdraw()
+    True
+    """
+
+    def __init__(self, ratio=0.1, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(max_tokens)
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+
+            return True
+
+
+class RetryPolicy:
+    """
+    Retries idempotent requests (`methods`) failed with connection errors
+    or `statuses` up to `attempts` attempts in total.
+    Delays grow exponentially from `backoff` seconds up to `max_backoff`
+    with full jitter (`Retry-After` header is respected).
+    Retries are limited by the `budget` (`RetryBudget` instance)
+    """
+
+    def __init__(
+        self,
+        attempts=3,
+        backoff=0.1,
+        max_backoff=5.0,
+        methods=IDEMPOTENT_METHODS,
+        statuses=RETRY_STATUSES,
+        budget=None,
+    ):
+        if attempts < 1:
+            raise ValueError("Argument `attempts` must be positive")
+
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.methods = frozenset(method.upper() for method in methods)
+        self.statuses = frozenset(statuses)
+        self.budget = budget if budget is not None else RetryBudget()
+
+    def get_delay(self, attempt, response=None):
+        """
+        Returns delay in seconds before the retry after `attempt` (from 0)
+
+        >>> policy = RetryPolicy(backoff=1, max_backoff=3)
+        >>> 0 <= policy.get_delay(5) <= 3
+        True
+        """
+        retry_after = response.headers.get("Retry-After") if response else None
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def _can_retry(self, method, attempt):
+        return (
+            method.upper() in self.methods
+            and attempt + 1 < self.attempts
+            and self.budget.withdraw()
+        )
+
+    def _should_retry_response(self, method, attempt, response):
+        return response.status in self.statuses and self._can_retry(method, attempt)
+
+    def call(self, method, send, exceptions):
+        """
+        Calls `send()` retrying it on `exceptions` and retryable statuses
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = send()
+            except exceptions:
+                if not self._can_retry(method, attempt):
+                    raise
+            else:
+                if not self._should_retry_response(method, attempt, response):
+                    return response
+
+            time.sleep(self.get_delay(attempt, response))
+            attempt += 1
+
+    async def call_async(self, method, send, exceptions):
+        """
+        Awaits `send()` retrying it on `exceptions` and retryable statuses
+        """
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = await send()
+            except exceptions:
+                if not self._can_retry(method, attempt):
+                    raise
+            else:
+                if not self._should_retry_response(method, attempt, response):
+                    return response
+
+            await asyncio.sleep(self.get_delay(attempt, response))
+            attempt += 1
+
+
+class HedgingPolicy:
+    """
+    Sends a duplicate of the read request if it takes longer than
+    `percentile` of the latencies of the last `window` reads
+    and returns the response which arrives first.
+    Hedging starts after `min_samples` latencies are collected,
+    duplicates are limited by the `budget` (`RetryBudget` instance)
+    """
+
+    def __init__(self, percentile=95, window=1000, min_samples=20, budget=None):
+        if not 0 < percentile < 100:
+            raise ValueError("Argument `percentile` must be between 0 and 100")
+
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.budget = budget if budget is not None else RetryBudget()
+        self._latencies = deque(maxlen=window)
+
+    def get_delay(self):
+        """
+        Returns the latency after which the request is hedged
+        or None if there are not enough samples
+
+        >>> policy = HedgingPolicy(percentile=50, min_samples=3)
+        >>> for latency in [0.3, 0.1, 0.2]:
+        ...     policy.record(latency)
+        >>> policy.get_delay()
+        0.2
+        """
+        if len(self._latencies) < self.min_samples:
+            return None
+
+        latencies = sorted(self._latencies)
+
+        return latencies[int(len(latencies) * self.percentile / 100)]
+
+    def record(self, latency):
+        self._latencies.append(latency)
+
+    async def _timed(self, send):
+        started_at = time.monotonic()
+        response = await send()
+        self.record(time.monotonic() - started_at)
+
+        return response
+
+    async def call(self, send):
+        """
+        Awaits `send()` hedging it with the second `send()` if it's slow
+        """
+        self.budget.deposit()
+        delay = self.get_delay()
+        tasks = {asyncio.ensure_future(self._timed(send))}
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if not done and self.budget.withdraw():
+                    tasks.add(asyncio.ensure_future(self._timed(send)))
+
+            while True:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                successful = [task for task in done if task.exception() is None]
+                if successful:
+                    return successful[0].result()
+                if not tasks:
+                    return done.pop().result()
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from .hooks import RequestHooks
+
+current_tracer = ContextVar("current_tracer", default=None)
+
+# Whether spans of the current root span are recorded
+current_sampled = ContextVar("current_sampled", default=None)
+
+NULL_SPAN = nullcontext()
+
+
+def trace_span(client, name, **args):
+    """
+    Returns span context manager of the tracer opened for the `client`
+    in the current context or a no-op context manager
+    """
+    tracer = current_tracer.get()
+    if tracer is None or tracer.client is not client:
+        return NULL_SPAN
+
+    return Span(tracer, name, "client", args)
+
+
+def bind_trace(fn):
+    """
+    Returns `fn` which runs in another thread with the tracer
+    of the current context (threads don't inherit context variables)
+    """
+    tracer = current_tracer.get()
+    if tracer is None:
+        return fn
+    sampled = current_sampled.get()
+
+    def bound_fn(*args, **kwargs):
+        tracer_token = current_tracer.set(tracer)
+        sampled_token = current_sampled.set(sampled)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            current_sampled.reset(sampled_token)
+            current_tracer.reset(tracer_token)
+
+    return bound_fn
+
+
+class Span:
+    __slots__ = ("tracer", "name", "category", "args", "started_at", "_token")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started_at = None
+        self._token = None
+
+    def __enter__(self):
+        sampled = current_sampled.get()
+        if sampled is None:
+            # The sampling is decided once for the whole tree of spans
+            self._token = current_sampled.set(self.tracer.sample())
+        self.started_at = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if current_sampled.get():
+            args = self.args
+            if exc_type is not None:
+                args = {**args, "error": exc_type.__name__}
+            self.tracer.add_span(
+                self.name, self.category, self.started_at, time.perf_counter(), args
+            )
+        if self._token is not None:
+            current_sampled.reset(self._token)
+
+
+class Tracer(RequestHooks):
+    """
+    Records spans of the client operations and HTTP requests made
+    in the context of `with client.trace(path)` and writes them to `path`
+    in Chrome trace event format (opened by Perfetto or chrome://tracing).
+    Every thread and asyncio task is a separate track.
+    Only `sample_rate` share of root operations (with all their spans)
+    is recorded, at most `max_events` events are kept
+    """
+
+    def __init__(self, client, path=None, sample_rate=1.0, max_events=1000000):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("Argument `sample_rate` must be between 0 and 1")
+
+        self.client = client
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_events = max_events
+        self.events = []
+        self.dropped_events = 0
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._tracks = {}
+        self._requests = {}
+        self._token = None
+
+    def __enter__(self):
+        self._token = current_tracer.set(self)
+        self.client.hooks.append(self)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.client.hooks.remove(self)
+        current_tracer.reset(self._token)
+        if self.path is not None:
+            self.dump(self.path)
+
+    def sample(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def _get_track(self):
+        try:
+            task = asyncio.current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            # Task names are available from python 3.8
+            key = id(task)
+            name = getattr(task, "get_name", lambda: "Task-{0}".format(key))()
+        else:
+            key, name = threading.get_ident(), threading.current_thread().name
+
+        track = self._tracks.get(key)
+        if track is None:
+            track = self._tracks[key] = len(self._tracks) + 1
+            self._add_event(
+                {
+                    "ph": "M",
+                    "name": "thread_name",
+                    "pid": self._pid,
+                    "tid": track,
+                    "args": {"name": name},
+                }
+            )
+
+        return track
+
+    def _add_event(self, event):
+        if len(self.events) >= self.max_events:
+            self.dropped_events += 1
+            return
+        self.events.append(event)
+
+    def add_span(self, name, category, started_at, finished_at, args, track=None):
+        self._add_event(
+            {
+                "ph": "X",
+                "name": name,
+                "cat": category,
+                "ts": (started_at - self._origin) * 1e6,
+                "dur": (finished_at - started_at) * 1e6,
+                "pid": self._pid,
+                "tid": track or self._get_track(),
+                "args": args,
+            }
+        )
+
+    def on_request_start(self, request):
+        if current_tracer.get() is not self:
+            return
+
+        sampled = current_sampled.get()
+        if sampled is None:
+            sampled = self.sample()
+        if sampled:
+            self._requests[request] = self._get_track()
+
+    def on_response(self, request, response):
+        track = self._requests.pop(request, None)
+        if track is None:
+            return
+
+        finished_at = time.perf_counter()
+        timings = request.timings
+        self.add_span(
+            request.endpoint,
+            "http",
+            request.started_at,
+            finished_at,
+            {"url": request.url, "status": request.status, "bytes": request.bytes},
+            track,
+        )
+        phases_at = request.started_at
+        for phase in ("ttfb", "body"):
+            duration = getattr(timings, phase)
+            self.add_span(phase, "http", phases_at, phases_at + duration, {}, track)
+            phases_at += duration
+        if timings.connect is not None:
+            self.add_span(
+                "connect",
+                "http",
+                request.started_at,
+                request.started_at + timings.connect,
+                {},
+                track,
+            )
+        if timings.parse is not None:
+            self.add_span(
+                "parse", "http", finished_at - timings.parse, finished_at, {}, track
+            )
+
+    def on_error(self, request, error):
+        track = self._requests.pop(request, None)
+        if track is None:
+            return
+
+        self.add_span(
+            request.endpoint,
+            "http",
+            request.started_at,
+            time.perf_counter(),
+            {"url": request.url, "error": type(error).__name__},
+            track,
+        )
+
+    def dump(self, path):
+        """
+        Writes recorded events to `path` as Chrome trace JSON
+        """
+        with open(path, "w") as fd:
+            json.dump(
+                {
+                    "traceEvents": self.events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"dropped_events": self.dropped_events},
+                },
+                fd,
+            )
@@ -0,0 +1,434 @@
+import datetime
+import json
+import re
+import time
+import zlib
+from collections import namedtuple
+from json import JSONDecodeError
+from urllib.parse import parse_qsl, urlencode
+
+from fhirpy.base.exceptions import ResourceNotFound, OperationOutcome
+from fhirpy.base.resource import BaseReference, BaseResource
+from fhirpy.base.utils import chunks, get_by_path, unique_everseen
+
+# `request` is `RequestInfo` of the request if the client has hooks
+RawResponse = namedtuple(
+    "RawResponse", ["status", "headers", "content", "request"], defaults=[None]
+)
+
+# Primary resources of the search and all Bundle resources by reference
+ResourceGraph = namedtuple("ResourceGraph", ["resources", "index"])
+
+PRIMITIVE_TYPES = frozenset([str, int, float, bool, type(None)])
+
+
+def raise_for_response(status, content):
+    """
+    Raises fhirpy exception for the failed response with text `content`
+
+    >>> raise_for_response(404, 'Not found')
+    Traceback (most recent call last):
+    ...
+    fhirpy.base.exceptions.ResourceNotFound: Not found
+    """
+    if status == 404 or status == 410:
+        raise ResourceNotFound(content)
+
+    try:
+        parsed_data = json.loads(content)
+        if parsed_data["resourceType"] == "OperationOutcome":
+            raise OperationOutcome(resource=parsed_data)
+        raise OperationOutcome(reason=content)
+    except (KeyError, TypeError, JSONDecodeError):
+        raise OperationOutcome(reason=content)
+
+
+def get_response_data(response, loads):
+    """
+    Returns data of the successful `RawResponse` decoded with `loads`
+    or raises fhirpy exception
+    """
+    if 200 <= response.status < 300:
+        if response.request is None:
+            return loads(response.content) if response.content else None
+
+        try:
+            started_at = time.perf_counter()
+            data = loads(response.content) if response.content else None
+        except Exception as exc:
+            response.request.fail(exc)
+            raise
+        response.request.finish(response, time.perf_counter() - started_at)
+
+        return data
+
+    raise_for_response(response.status, response.content.decode())
+
+
+def get_etag(response, data):
+    """
+    Returns ETag of the resource response (built from `meta.versionId`
+    if the server doesn't send the header)
+
+    >>> get_etag(RawResponse(200, {}, b''), {'meta': {'versionId': '2'}})
+    'W/"2"'
+    """
+    etag = response.headers.get("ETag")
+    if etag:
+        return etag
+
+    version_id = get_by_path(data or {}, ["meta", "versionId"])
+    if version_id:
+        return 'W/"{0}"'.format(version_id)
+
+    return None
+
+
+def get_request_key(method, url, headers):
+    """
+    Returns the key of the request with normalized (sorted) query params
+    and headers which change the response
+
+    >>> get_request_key('get', 'http://a/Patient?name=b&_count=1', {}) == (
+    ...     get_request_key('GET', 'http://a/Patient?_count=1&name=b', {}))
+    True
+    """
+    path, _, query = url.partition("?")
+    normalized_query = urlencode(sorted(parse_qsl(query, keep_blank_values=True)))
+
+    return (
+        method.upper(),
+        "{0}?{1}".format(path, normalized_query),
+        headers.get("If-None-Match"),
+    )
+
+
+DATE_TIME_RE = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?"
+    r"(Z|[+-]\d{2}:\d{2})?$"
+)
+
+
+def parse_date_time(value):
+    """
+    Parses FHIR instant (e.g. `meta.lastUpdated`) into aware datetime
+
+    >>> parse_date_time('2021-02-03T04:05:06.123Z')
+    datetime.datetime(2021, 2, 3, 4, 5, 6, 123000, tzinfo=datetime.timezone.utc)
+
+    >>> parse_date_time('2021-02-03T04:05:06+03:00')
+    datetime.datetime(2021, 2, 3, 1, 5, 6, tzinfo=datetime.timezone.utc)
+    """
+    match = DATE_TIME_RE.match(value)
+    if not match:
+        raise ValueError("Invalid instant {0}".format(value))
+
+    *parts, fraction, tz = match.groups()
+    microsecond = int((fraction or "0")[:6].ljust(6, "0"))
+    offset = datetime.timedelta()
+    if tz and tz != "Z":
+        sign = -1 if tz[0] == "-" else 1
+        offset = sign * datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6]))
+
+    return (
+        datetime.datetime(*map(int, parts), microsecond, tzinfo=datetime.timezone.utc)
+        - offset
+    )
+
+
+def format_date_time(value):
+    """
+    Formats aware datetime as FHIR instant with microseconds
+
+    >>> format_date_time(parse_date_time('2021-02-03T04:05:06.123Z'))
+    '2021-02-03T04:05:06.123000Z'
+    """
+    return value.astimezone(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def split_date_time_range(start, end, parts):
+    """
+    Returns `parts - 1` inner boundaries splitting [start, end] evenly
+
+    >>> start = parse_date_time('2021-01-01T00:00:00Z')
+    >>> end = parse_date_time('2021-01-01T00:00:03Z')
+    >>> [format_date_time(b) for b in split_date_time_range(start, end, 3)]
+    ['2021-01-01T00:00:01.000000Z', '2021-01-01T00:00:02.000000Z']
+    """
+    step = (end - start) / parts
+    boundaries = [start + step * index for index in range(1, parts)]
+
+    return unique_everseen(
+        [boundary for boundary in boundaries if start < boundary <= end]
+    )
+
+
+def format_cursor_token(after):
+    """
+    Formats cursor position (the last seen instant and the number
+    of seen resources updated at this instant, 0 if all of them are seen)
+    as a token
+
+    >>> after = (parse_date_time('2021-02-03T04:05:06.123Z'), 2)
+    >>> format_cursor_token(after)
+    '2021-02-03T04:05:06.123000Z|2'
+    >>> parse_cursor_token(format_cursor_token(after)) == after
+    True
+    """
+    if after is None:
+        return None
+
+    return "{0}|{1}".format(format_date_time(after[0]), after[1])
+
+
+def parse_cursor_token(token):
+    if not token:
+        return None
+
+    last_updated, count = token.split("|", 1)
+
+    return parse_date_time(last_updated), int(count)
+
+
+BULK_LOAD_HEADERS = {
+    "Content-Type": "application/x-ndjson",
+    "Content-Encoding": "gzip",
+}
+
+
+def get_bulk_load_path(resource_type):
+    """
+    >>> get_bulk_load_path('Patient')
+    'Patient/$load'
+
+    >>> get_bulk_load_path(None)
+    '$load'
+    """
+    if resource_type:
+        return "{0}/$load".format(resource_type)
+
+    return "$load"
+
+
+class GzipNDJSONEncoder:
+    """
+    Incrementally encodes items into gzip-compressed NDJSON.
+    Items are resources, dicts or already encoded lines (bytes/str).
+    Dicts are encoded with `dumps` which must return bytes.
+    `encode()` returns compressed bytes once at least `chunk_size`
+    bytes of NDJSON are buffered (otherwise an empty bytes string)
+
+    >>> encoder = GzipNDJSONEncoder()
+    >>> body = encoder.encode({'id': '1'}) + encoder.encode(b'{"id": "2"}')
+    >>> body += encoder.close()
+    >>> zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    b'{"id": "1"}\\n{"id": "2"}\\n'
+    >>> encoder.count
+    2
+    """
+
+    def __init__(self, chunk_size=64 * 1024, dumps=None):
+        self.chunk_size = chunk_size
+        self.dumps = dumps or (lambda data: json.dumps(data).encode())
+        self.count = 0
+        self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+        self._buffer = []
+        self._buffer_size = 0
+
+    def encode(self, item):
+        if isinstance(item, str):
+            item = item.encode()
+        elif not isinstance(item, bytes):
+            if hasattr(item, "serialize"):
+                item = item.serialize()
+            item = self.dumps(item)
+        if not item.endswith(b"\n"):
+            item += b"\n"
+
+        self.count += 1
+        self._buffer.append(item)
+        self._buffer_size += len(item)
+        if self._buffer_size < self.chunk_size:
+            return b""
+
+        return self._compress()
+
+    def close(self):
+        return self._compress() + self._compressor.flush()
+
+    def _compress(self):
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffer_size = 0
+
+        return self._compressor.compress(data)
+
+
+def get_query_path(name):
+    """
+    >>> get_query_path('patients-by-org')
+    '$query/patients-by-org'
+    """
+    return "$query/{0}".format(name)
+
+
+def get_query_definition(name, sql, params=None, count_query=None):
+    """
+    Returns `AidboxQuery` resource data
+
+    >>> get_query_definition('q', 'SELECT 1', {'org': {'type': 'string'}})
+    {'id': 'q', 'query': 'SELECT 1', 'params': {'org': {'type': 'string'}}}
+    """
+    definition = {"id": name, "query": sql}
+    if params:
+        definition["params"] = params
+    if count_query:
+        definition["count-query"] = count_query
+
+    return definition
+
+
+def get_sql_body(query, params=None):
+    """
+    Returns `$sql` request body with parameterised query
+
+    >>> get_sql_body('SELECT id FROM patient WHERE id = ?', ['p1'])
+    ['SELECT id FROM patient WHERE id = ?', 'p1']
+    """
+    return [query, *(params or [])]
+
+
+def get_sql_chunk_body(query, params, key, chunk_size, after=None):
+    """
+    Returns `$sql` request body fetching the chunk of `query` rows
+    ordered by unique `key` column which go after the `after` key value
+
+    >>> get_sql_chunk_body('SELECT id FROM t', [], 'id', 2, 'p1')
+    ['SELECT * FROM (SELECT id FROM t) AS chunk WHERE id > ? ORDER BY id LIMIT 2', 'p1']
+    """
+    params = list(params or [])
+    condition = ""
+    if after is not None:
+        condition = " WHERE {0} > ?".format(key)
+        params.append(after)
+    chunk_query = "SELECT * FROM ({0}) AS chunk{1} ORDER BY {2} LIMIT {3}".format(
+        query, condition, key, int(chunk_size)
+    )
+
+    return get_sql_body(chunk_query, params)
+
+
+def iter_path_values(items, paths):
+    """
+    Yields values of `items` by `paths` flattening lists
+
+    >>> from fhirpy.base.utils import AttrDict
+    >>> items = [AttrDict(a=1, b=[2, 3]), AttrDict(a=4)]
+    >>> list(iter_path_values(items, ['a', 'b']))
+    [1, 2, 3, 4]
+    """
+    for item in items:
+        for path in paths:
+            value = item.get_by_path(path)
+            if isinstance(value, list):
+                yield from value
+            elif value is not None:
+                yield value
+
+
+def iter_references(resources):
+    """
+    Yields all references nested in `resources` (walking them iteratively)
+    """
+    primitive_types = PRIMITIVE_TYPES
+    stack = list(resources)
+    while stack:
+        value = stack.pop()
+        if isinstance(value, BaseReference):
+            yield value
+        elif isinstance(value, dict):
+            stack.extend(
+                item for item in value.values() if type(item) not in primitive_types
+            )
+        elif isinstance(value, list):
+            stack.extend(item for item in value if type(item) not in primitive_types)
+
+
+def group_references(references):
+    """
+    Returns local references grouped by reference string
+    skipping external references and other values
+    """
+    grouped = {}
+    for reference in references:
+        if getattr(reference, "is_local", False) and reference.id:
+            grouped.setdefault(reference.reference, []).append(reference)
+
+    return grouped
+
+
+def iter_reference_chunks(grouped_references, chunk_size):
+    """
+    Yields (resource type, ids) chunks of grouped references
+    """
+    ids_by_type = {}
+    for references in grouped_references.values():
+        ids_by_type.setdefault(references[0].resource_type, []).append(references[0].id)
+
+    for resource_type, ids in ids_by_type.items():
+        for ids_chunk in chunks(ids, chunk_size):
+            yield resource_type, ids_chunk
+
+
+def attach_resolved_resources(grouped_references, resources):
+    """
+    Attaches resources to the references so `to_resource()`
+    returns them without requests
+    """
+    for key, references in grouped_references.items():
+        resource = resources.get(key)
+        if resource is not None:
+            for reference in references:
+                reference._resolved = resource
+
+
+def serialize_data(data, dict_class=dict, list_class=list):
+    """
+    Returns a copy of the resource `data` made of `dict_class` dicts
+    and `list_class` lists where nested resources are replaced
+    with references.
+    The tree is walked iteratively (without recursion) and primitive
+    values are copied without further checks
+
+    >>> serialize_data({'a': [1, {'b': 'c'}], 'd': None})
+    {'a': [1, {'b': 'c'}], 'd': None}
+    """
+    primitive_types = PRIMITIVE_TYPES
+    result = dict_class()
+    stack = [(data.items(), result, True)]
+    while stack:
+        source, target, is_dict = stack.pop()
+        for item in source:
+            if is_dict:
+                key, value = item
+            else:
+                value = item
+
+            if type(value) not in primitive_types:
+                if isinstance(value, BaseResource):
+                    value = value.to_reference()
+                if isinstance(value, dict):
+                    copied = dict_class()
+                    stack.append((value.items(), copied, True))
+                    value = copied
+                elif isinstance(value, list):
+                    copied = list_class()
+                    stack.append((value, copied, False))
+                    value = copied
+
+            if is_dict:
+                target[key] = value
+            else:
+                target.append(value)
+
+    return result
@@ -0,0 +1,68 @@
+"""
+Compares peak memory and time of reading two fields of every resource
+of a large search Bundle with regular and lazy resources
+
+    python benchmarks/bench_lazy.py
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Benchmarks run from the checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aidboxpy import SyncAidboxClient  # noqa: E402
+
+
+def make_bundle_content(entries=20000):
+    return json.dumps(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [
+                {
+                    "resource": {
+                        "resourceType": "Observation",
+                        "id": "o{0}".format(index),
+                        "meta": {"lastUpdated": "2021-01-01T00:00:00Z"},
+                        "status": "final",
+                        "subject": {"resourceType": "Patient", "id": "p1"},
+                        "code": {"coding": [{"system": "loinc", "code": "8867-4"}]},
+                        "value": {"Quantity": {"value": index, "unit": "bpm"}},
+                        "component": [
+                            {"code": {"text": "c{0}".format(component)}}
+                            for component in range(5)
+                        ],
+                    }
+                }
+                for index in range(entries)
+            ],
+        }
+    ).encode()
+
+
+def bench(name, searchset, content):
+    tracemalloc.start()
+    started_at = time.perf_counter()
+    bundle_data = searchset.client.json_codec.loads(content)
+    resources = searchset._get_bundle_resources(bundle_data)
+    del bundle_data
+    values = [(resource.id, resource.value.Quantity.value) for resource in resources]
+    duration = time.perf_counter() - started_at
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        "{0:<8} {1} resources  peak {2:7.1f} MiB  {3:7.1f} ms".format(
+            name, len(values), peak / 2**20, duration * 1000
+        )
+    )
+
+
+if __name__ == "__main__":
+    client = SyncAidboxClient("http://localhost:8080")
+    content = make_bundle_content()
+    bench("regular", client.resources("Observation"), content)
+    bench("lazy", client.resources("Observation").lazy(), content)
@@ -0,0 +1,90 @@
+"""
+Compares `serialize()` of aidboxpy resources with the recursive
+fhirpy implementation on a large Questionnaire and a big Bundle
+
+    python benchmarks/bench_serialize.py
+"""
+
+import os
+import sys
+import timeit
+
+from fhirpy.base.resource import AbstractResource
+
+# Benchmarks run from the checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aidboxpy import SyncAidboxClient  # noqa: E402
+
+
+def make_questionnaire(client, groups=50, items=20):
+    return client.resource(
+        "Questionnaire",
+        id="q1",
+        status="active",
+        item=[
+            {
+                "linkId": "group-{0}".format(group),
+                "type": "group",
+                "item": [
+                    {
+                        "linkId": "item-{0}-{1}".format(group, item),
+                        "text": "Question {0}".format(item),
+                        "type": "choice",
+                        "required": item % 2 == 0,
+                        "answerOption": [
+                            {"value": {"Coding": {"code": str(code)}}}
+                            for code in range(5)
+                        ],
+                    }
+                    for item in range(items)
+                ],
+            }
+            for group in range(groups)
+        ],
+    )
+
+
+def make_bundle(client, entries=2000):
+    return client.resource(
+        "Bundle",
+        type="transaction",
+        entry=[
+            {
+                "request": {"method": "PUT", "url": "/Observation/o{0}".format(index)},
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": "o{0}".format(index),
+                    "status": "final",
+                    "subject": {"resourceType": "Patient", "id": "p1"},
+                    "code": {"coding": [{"system": "loinc", "code": "8867-4"}]},
+                    "value": {"Quantity": {"value": index, "unit": "bpm"}},
+                },
+            }
+            for index in range(entries)
+        ],
+    )
+
+
+def bench(name, resource, number=20):
+    recursive = timeit.timeit(
+        lambda: AbstractResource.serialize(resource), number=number
+    )
+    iterative = timeit.timeit(resource.serialize, number=number)
+    encoded = timeit.timeit(lambda: resource.serialize(encode=True), number=number)
+    print(
+        "{0:<14} recursive {1:7.2f} ms  iterative {2:7.2f} ms ({3:.1f}x)  "
+        "encoded {4:7.2f} ms".format(
+            name,
+            recursive / number * 1000,
+            iterative / number * 1000,
+            recursive / iterative,
+            encoded / number * 1000,
+        )
+    )
+
+
+if __name__ == "__main__":
+    client = SyncAidboxClient("http://localhost:8080")
+    bench("Questionnaire", make_questionnaire(client))
+    bench("Bundle", make_bundle(client))
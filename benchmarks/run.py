@@ -0,0 +1,453 @@
+"""
+Runs throughput and latency benchmarks of both clients against
+the in-process stand-in server (`benchmarks/server.py`), saves results
+to JSON and compares them with saved baseline results
+
+    python benchmarks/run.py --output baseline.json
+    python benchmarks/run.py --compare baseline.json --threshold 0.1
+
+The command exits with status 1 if ops/s of any benchmark dropped
+by more than `threshold` compared with the baseline
+"""
+
+import argparse
+import asyncio
+import datetime
+import fnmatch
+import json
+import os
+import platform
+import sys
+import time
+
+# Benchmarks run from the checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import StandInServer, generate_patients  # noqa: E402
+
+from aidboxpy import VERSION, AsyncAidboxClient, SyncAidboxClient  # noqa: E402
+from aidboxpy.codec import JSON_CODECS, get_json_codec  # noqa: E402
+from aidboxpy.metrics import LatencyHistogram  # noqa: E402
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers the benchmark function. The function gets `Context`
+    and returns a callable running one round and a callable closing
+    the client or None. The round returns the number of processed
+    resources and the latencies of its operations (requests, Bundles
+    or whole passes over the resources)
+    """
+
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+
+    return decorator
+
+
+class Context:
+    def __init__(self, url, resources, page_size, saves, concurrency):
+        self.url = url
+        self.resources = resources
+        self.page_size = page_size
+        self.saves = saves
+        self.concurrency = concurrency
+
+
+def timed(fn, *args):
+    started_at = time.perf_counter()
+    fn(*args)
+
+    return time.perf_counter() - started_at
+
+
+async def async_timed(fn, *args):
+    started_at = time.perf_counter()
+    await fn(*args)
+
+    return time.perf_counter() - started_at
+
+
+def make_patient(client, index):
+    return client.resource(
+        "Patient",
+        id="bench-{0}".format(index),
+        active=True,
+        name=[{"family": "Doe", "given": ["John"]}],
+        managingOrganization={"resourceType": "Organization", "id": "organization-1"},
+    )
+
+
+@benchmark("sync.fetch_all")
+def bench_sync_fetch_all(context):
+    client = SyncAidboxClient(context.url)
+    searchset = client.resources("Patient").limit(context.page_size)
+
+    def run():
+        return context.resources, [timed(searchset.fetch_all)]
+
+    return run, client.close
+
+
+@benchmark("sync.save")
+def bench_sync_save(context):
+    client = SyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    def run():
+        return len(patients), [timed(patient.save) for patient in patients]
+
+    return run, client.close
+
+
+@benchmark("sync.batch")
+def bench_sync_batch(context):
+    client = SyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    def save_all():
+        with client.batch(size=100):
+            for patient in patients:
+                patient.save()
+
+    def run():
+        return len(patients), [timed(save_all)]
+
+    return run, client.close
+
+
+@benchmark("sync.bulk_load")
+def bench_sync_bulk_load(context):
+    client = SyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    def run():
+        return len(patients), [timed(client.bulk_load, "Patient", patients)]
+
+    return run, client.close
+
+
+@benchmark("async.fetch_all")
+def bench_async_fetch_all(context):
+    client = AsyncAidboxClient(context.url)
+    searchset = client.resources("Patient").limit(context.page_size)
+
+    async def fetch_all():
+        # Every round runs in a new event loop with a new session
+        async with client:
+            return await async_timed(searchset.fetch_all)
+
+    def run():
+        return context.resources, [asyncio.run(fetch_all())]
+
+    return run, None
+
+
+@benchmark("async.save")
+def bench_async_save(context):
+    client = AsyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    async def save_all():
+        async with client:
+            return [await async_timed(patient.save) for patient in patients]
+
+    def run():
+        return len(patients), asyncio.run(save_all())
+
+    return run, None
+
+
+@benchmark("async.save_concurrent")
+def bench_async_save_concurrent(context):
+    client = AsyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    async def save_all():
+        semaphore = asyncio.Semaphore(context.concurrency)
+
+        async def save(patient):
+            async with semaphore:
+                return await async_timed(patient.save)
+
+        async with client:
+            return await asyncio.gather(*[save(patient) for patient in patients])
+
+    def run():
+        return len(patients), asyncio.run(save_all())
+
+    return run, None
+
+
+@benchmark("async.batch")
+def bench_async_batch(context):
+    client = AsyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    async def save_all():
+        async with client:
+            async with client.batch(size=100):
+                for patient in patients:
+                    await patient.save()
+
+    def run():
+        return len(patients), [asyncio.run(async_timed(save_all))]
+
+    return run, None
+
+
+@benchmark("async.bulk_load")
+def bench_async_bulk_load(context):
+    client = AsyncAidboxClient(context.url)
+    patients = [make_patient(client, index) for index in range(context.saves)]
+
+    async def bulk_load():
+        async with client:
+            return await async_timed(client.bulk_load, "Patient", patients)
+
+    def run():
+        return len(patients), [asyncio.run(bulk_load())]
+
+    return run, None
+
+
+@benchmark("serialize")
+def bench_serialize(context):
+    client = SyncAidboxClient(context.url)
+    patients = client.resources("Patient").limit(context.page_size).fetch_all()
+
+    def serialize_all():
+        for patient in patients:
+            patient.serialize()
+
+    def run():
+        return len(patients), [timed(serialize_all)]
+
+    return run, client.close
+
+
+@benchmark("reference")
+def bench_reference(context):
+    client = SyncAidboxClient(context.url)
+    patients = client.resources("Patient").limit(context.page_size).fetch_all()
+
+    def reference_all():
+        for patient in patients:
+            client.reference("Patient", patient.id)
+            patient.to_reference()
+
+    def run():
+        return len(patients) * 2, [timed(reference_all)]
+
+    return run, client.close
+
+
+def make_decode_benchmark(codec_name):
+    def bench_decode(context):
+        client = SyncAidboxClient(context.url)
+        content = client.session.get(
+            "{0}/Patient".format(context.url), params={"_count": context.page_size}
+        ).content
+        codec = get_json_codec(codec_name)
+        pages = max(1, context.resources // context.page_size)
+
+        def run():
+            return pages * context.page_size, [
+                timed(codec.loads, content) for _ in range(pages)
+            ]
+
+        return run, client.close
+
+    return bench_decode
+
+
+for codec_name in JSON_CODECS:
+    try:
+        get_json_codec(codec_name)
+    except ImportError:
+        continue
+    benchmark("decode.{0}".format(codec_name))(make_decode_benchmark(codec_name))
+
+
+def run_benchmark(name, context, repeat):
+    """
+    Runs the warm-up round and `repeat` measured rounds of the benchmark
+    and returns its results
+    """
+    run, close = BENCHMARKS[name](context)
+    try:
+        run()
+        histogram = LatencyHistogram()
+        operations = 0
+        duration = 0.0
+        for _ in range(repeat):
+            # Throughput is measured by the wall time of the round
+            # because operations of async rounds overlap
+            started_at = time.perf_counter()
+            round_operations, latencies = run()
+            duration += time.perf_counter() - started_at
+            operations += round_operations
+            for latency in latencies:
+                histogram.record(latency)
+    finally:
+        if close is not None:
+            close()
+
+    latency = histogram.as_dict()
+
+    return {
+        "operations": operations,
+        "duration": duration,
+        "ops_per_second": operations / duration,
+        "latency": {
+            key: latency[key] for key in ("count", "mean", "p50", "p95", "p99", "max")
+        },
+    }
+
+
+def get_metadata(args):
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "aidboxpy": VERSION,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "resources": args.resources,
+        "page_size": args.page_size,
+        "saves": args.saves,
+        "concurrency": args.concurrency,
+        "latency": args.latency,
+        "repeat": args.repeat,
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints changes of ops/s compared with the `baseline`
+    and returns names of the regressed benchmarks
+    """
+    regressions = []
+    print()
+    for key in ("resources", "page_size", "saves", "concurrency", "latency"):
+        if results["metadata"][key] != baseline["metadata"].get(key):
+            print(
+                "Warning: `{0}` differs from the baseline ({1} != {2})".format(
+                    key, results["metadata"][key], baseline["metadata"].get(key)
+                )
+            )
+    print("{0:<24} {1:>14} {2:>14} {3:>8}".format("", "baseline", "current", ""))
+    for name, result in results["benchmarks"].items():
+        baseline_result = baseline["benchmarks"].get(name)
+        if baseline_result is None:
+            print(
+                "{0:<24} {1:>14} {2:>14.1f}".format(name, "-", result["ops_per_second"])
+            )
+            continue
+
+        change = result["ops_per_second"] / baseline_result["ops_per_second"] - 1
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print(
+            "{0:<24} {1:>14.1f} {2:>14.1f} {3:>+7.1%}{4}".format(
+                name,
+                baseline_result["ops_per_second"],
+                result["ops_per_second"],
+                change,
+                "  REGRESSION" if regressed else "",
+            )
+        )
+
+    return regressions
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="python benchmarks/run.py",
+        description="Benchmarks aidboxpy clients against the stand-in server",
+    )
+    parser.add_argument(
+        "--filter",
+        action="append",
+        help="run benchmarks matching the pattern, e.g. 'async.*' (repeatable)",
+    )
+    parser.add_argument("--list", action="store_true", help="list benchmarks")
+    parser.add_argument("--output", help="file to save results to")
+    parser.add_argument("--compare", help="baseline results file to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="ops/s drop considered a regression (default 0.1 which is 10%%)",
+    )
+    parser.add_argument("--resources", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=500)
+    parser.add_argument("--saves", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="server latency in seconds"
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+    names = [
+        name
+        for name in BENCHMARKS
+        if not args.filter
+        or any(fnmatch.fnmatch(name, pattern) for pattern in args.filter)
+    ]
+    if args.list:
+        print("\n".join(names))
+        return 0
+
+    server = StandInServer(latency=args.latency)
+    server.add_resources(generate_patients(args.resources, args.seed))
+    url = server.start()
+    context = Context(url, args.resources, args.page_size, args.saves, args.concurrency)
+    results = {"metadata": get_metadata(args), "benchmarks": {}}
+    try:
+        print(
+            "{0:<24} {1:>14} {2:>10} {3:>10} {4:>10}".format(
+                "", "ops/s", "p50 ms", "p95 ms", "p99 ms"
+            )
+        )
+        for name in names:
+            result = results["benchmarks"][name] = run_benchmark(
+                name, context, args.repeat
+            )
+            latency = result["latency"]
+            print(
+                "{0:<24} {1:>14.1f} {2:>10.3f} {3:>10.3f} {4:>10.3f}".format(
+                    name,
+                    result["ops_per_second"],
+                    latency["p50"] * 1000,
+                    latency["p95"] * 1000,
+                    latency["p99"] * 1000,
+                )
+            )
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(results, fd, indent=2)
+
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        if compare(results, baseline, args.threshold):
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
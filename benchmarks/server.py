@@ -0,0 +1,356 @@
+"""
+In-process Aidbox stand-in server for benchmarks.
+Implements CRUD with versions and ETags, search with paging
+(`_count`, `page`, `_sort`, `_id`, `_lastUpdated`, `_elements`,
+`_total`), batch/transaction Bundles, `$dump` and `$load`
+over generated data kept in memory.
+
+The server runs in a background thread of the benchmark process,
+so resources are kept pre-encoded to spend as little CPU as possible
+
+    server = StandInServer(latency=0.001)
+    server.add_resources(generate_patients(1000))
+    url = server.start()
+"""
+
+import asyncio
+import datetime
+import json
+import random
+import threading
+import uuid
+from urllib.parse import urlencode
+
+from aiohttp import web
+
+FIRST_NAMES = ["Ivan", "Maria", "John", "Anna", "Peter", "Olga", "Alex", "Kate"]
+
+LAST_NAMES = ["Ivanov", "Petrova", "Smith", "Doe", "Brown", "Sidorova", "Lee"]
+
+
+def generate_patients(count, seed=0):
+    """
+    Returns `count` Patient resources of about 1 KB
+    """
+    rnd = random.Random(seed)
+
+    return [
+        {
+            "resourceType": "Patient",
+            "id": "patient-{0}".format(index),
+            "active": rnd.random() > 0.1,
+            "gender": rnd.choice(["male", "female"]),
+            "birthDate": "{0}-{1:02d}-{2:02d}".format(
+                rnd.randint(1930, 2020), rnd.randint(1, 12), rnd.randint(1, 28)
+            ),
+            "name": [
+                {
+                    "use": "official",
+                    "family": rnd.choice(LAST_NAMES),
+                    "given": [rnd.choice(FIRST_NAMES), rnd.choice(FIRST_NAMES)],
+                }
+            ],
+            "identifier": [
+                {
+                    "system": "http://hl7.org/fhir/sid/us-ssn",
+                    "value": "{0:09d}".format(rnd.randint(0, 10**9 - 1)),
+                }
+            ],
+            "telecom": [
+                {"system": "phone", "value": "+1-555-{0:04d}".format(index % 10000)},
+                {"system": "email", "value": "patient{0}@example.com".format(index)},
+            ],
+            "address": [
+                {
+                    "line": ["{0} Main St".format(rnd.randint(1, 999))],
+                    "city": "Springfield",
+                    "postalCode": "{0:05d}".format(rnd.randint(0, 99999)),
+                }
+            ],
+            "managingOrganization": {
+                "resourceType": "Organization",
+                "id": "organization-{0}".format(index % 10),
+            },
+        }
+        for index in range(count)
+    ]
+
+
+def encode(data):
+    return json.dumps(data, separators=(",", ":")).encode()
+
+
+class StandInServer:
+    """
+    Stand-in server answering every request after `latency` seconds
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests_count = 0
+        # Resources by type and id as (data, encoded data)
+        self._resources = {}
+        self._counter = 0
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def _get_last_updated(self):
+        self._counter += 1
+        instant = datetime.datetime(2021, 1, 1) + datetime.timedelta(
+            milliseconds=self._counter
+        )
+
+        return instant.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+    def save(self, resource_type, data, id=None):
+        data = dict(data, resourceType=resource_type)
+        data["id"] = id or data.get("id") or str(uuid.uuid4())
+        resources = self._resources.setdefault(resource_type, {})
+        previous = resources.get(data["id"])
+        version = int(previous[0]["meta"]["versionId"]) + 1 if previous else 1
+        data["meta"] = {
+            "versionId": str(version),
+            "lastUpdated": self._get_last_updated(),
+        }
+        # The latest versions are kept at the end like `_lastUpdated` order
+        resources.pop(data["id"], None)
+        resources[data["id"]] = (data, encode(data))
+
+        return data, previous is None
+
+    def add_resources(self, resources):
+        for data in resources:
+            self.save(data["resourceType"], data)
+
+    def _search(self, resource_type, query):
+        items = list(self._resources.get(resource_type, {}).values())
+        ids = {id for value in query.getall("_id", []) for id in value.split(",")}
+        if ids:
+            items = [item for item in items if item[0]["id"] in ids]
+        for value in query.getall("_lastUpdated", []):
+            prefix, instant = value[:2], value[2:]
+            items = [
+                item
+                for item in items
+                if compare(item[0]["meta"]["lastUpdated"], prefix, instant)
+            ]
+        for key in reversed(query.get("_sort", "").split(",")):
+            if key:
+                items.sort(key=get_sort_key(key.lstrip("-")), reverse=key[0] == "-")
+
+        return items
+
+    def _get_entry_content(self, item, elements):
+        if not elements:
+            return item[1]
+
+        data = {key: value for key, value in item[0].items() if key in elements}
+
+        return encode(data)
+
+    async def _respond(self, request):
+        self.requests_count += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def search(self, request):
+        await self._respond(request)
+        resource_type = request.match_info["resource_type"]
+        query = request.query
+        items = self._search(resource_type, query)
+        count = int(query.get("_count", 100))
+        page = int(query.get("page", 1))
+        elements = set(query.get("_elements", "").split(",")) - {""}
+        page_items = items[(page - 1) * count : page * count]
+
+        bundle = {"resourceType": "Bundle", "type": "searchset", "link": []}
+        if query.get("_total") != "none":
+            bundle["total"] = len(items)
+        if page * count < len(items):
+            params = [(key, value) for key, value in query.items() if key != "page"]
+            bundle["link"].append(
+                {
+                    "relation": "next",
+                    "url": "/{0}?{1}".format(
+                        resource_type, urlencode(params + [("page", str(page + 1))])
+                    ),
+                }
+            )
+        # Entries are joined as bytes to avoid encoding every resource again
+        content = b"".join(
+            [
+                encode(bundle)[:-1],
+                b',"entry":[',
+                b",".join(
+                    b'{"resource":' + self._get_entry_content(item, elements) + b"}"
+                    for item in page_items
+                ),
+                b"]}",
+            ]
+        )
+
+        return web.Response(body=content, content_type="application/json")
+
+    async def read(self, request):
+        await self._respond(request)
+        item = self._resources.get(request.match_info["resource_type"], {}).get(
+            request.match_info["id"]
+        )
+        if item is None:
+            return web.json_response({"resourceType": "OperationOutcome"}, status=404)
+
+        etag = 'W/"{0}"'.format(item[0]["meta"]["versionId"])
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+
+        return web.Response(
+            body=item[1], content_type="application/json", headers={"ETag": etag}
+        )
+
+    async def create(self, request):
+        await self._respond(request)
+        data, _ = self.save(request.match_info["resource_type"], await request.json())
+
+        return web.json_response(data, status=201)
+
+    async def update(self, request):
+        await self._respond(request)
+        data, created = self.save(
+            request.match_info["resource_type"],
+            await request.json(),
+            request.match_info["id"],
+        )
+
+        return web.json_response(data, status=201 if created else 200)
+
+    async def delete(self, request):
+        await self._respond(request)
+        item = self._resources.get(request.match_info["resource_type"], {}).pop(
+            request.match_info["id"], None
+        )
+        if item is None:
+            return web.json_response({"resourceType": "OperationOutcome"}, status=404)
+
+        return web.json_response(item[0])
+
+    async def bundle(self, request):
+        await self._respond(request)
+        data = await request.json()
+        entries = []
+        for entry in data.get("entry", []):
+            method = entry["request"]["method"]
+            path = entry["request"]["url"].strip("/").split("/")
+            if method == "DELETE":
+                self._resources.get(path[0], {}).pop(path[1], None)
+                entries.append({"response": {"status": "204"}})
+            else:
+                resource, created = self.save(
+                    path[0], entry["resource"], path[1] if len(path) > 1 else None
+                )
+                status = "201" if created else "200"
+                entries.append({"resource": resource, "response": {"status": status}})
+
+        return web.json_response(
+            {
+                "resourceType": "Bundle",
+                "type": "{0}-response".format(data.get("type", "batch")),
+                "entry": entries,
+            }
+        )
+
+    async def dump(self, request):
+        await self._respond(request)
+        response = web.StreamResponse(headers={"Content-Type": "application/ndjson"})
+        await response.prepare(request)
+        items = self._resources.get(request.match_info["resource_type"], {})
+        for item in list(items.values()):
+            await response.write(item[1] + b"\n")
+        await response.write_eof()
+
+        return response
+
+    async def load(self, request):
+        await self._respond(request)
+        # aiohttp decompresses gzip-encoded request bodies
+        content = await request.read()
+        counts = {}
+        for line in content.splitlines():
+            if line.strip():
+                data = json.loads(line)
+                resource_type = request.match_info.get(
+                    "resource_type", data.get("resourceType")
+                )
+                self.save(resource_type, data)
+                counts[resource_type] = counts.get(resource_type, 0) + 1
+
+        return web.json_response(counts)
+
+    def make_app(self):
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_post("/", self.bundle)
+        app.router.add_post("/$load", self.load)
+        app.router.add_post("/{resource_type}/$load", self.load)
+        app.router.add_get("/{resource_type}/$dump", self.dump)
+        app.router.add_get("/{resource_type}", self.search)
+        app.router.add_post("/{resource_type}", self.create)
+        app.router.add_get("/{resource_type}/{id}", self.read)
+        app.router.add_put("/{resource_type}/{id}", self.update)
+        app.router.add_delete("/{resource_type}/{id}", self.delete)
+
+        return app
+
+    def start(self, host="127.0.0.1", port=0):
+        """
+        Starts the server in a background thread and returns its url
+        """
+        started = threading.Event()
+        address = []
+
+        async def serve():
+            self._runner = web.AppRunner(self.make_app(), access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, host, port)
+            await site.start()
+            address.extend(site._server.sockets[0].getsockname()[:2])
+            started.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        started.wait()
+
+        return "http://{0}:{1}".format(*address)
+
+    def stop(self):
+        future = asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop)
+        future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+
+def compare(value, prefix, instant):
+    if prefix == "ge":
+        return value >= instant
+    if prefix == "gt":
+        return value > instant
+    if prefix == "le":
+        return value <= instant
+    if prefix == "lt":
+        return value < instant
+
+    return value.startswith(instant)
+
+
+def get_sort_key(key):
+    if key == "_lastUpdated":
+        return lambda item: item[0]["meta"]["lastUpdated"]
+    if key in ("_id", "id"):
+        return lambda item: item[0]["id"]
+
+    return lambda item: str(item[0].get(key, ""))
@@ -36,9 +36,17 @@ setup(
     install_requires=[
         'fhirpy>=1.1.0'
     ],
+    extras_require={
+        'orjson': ['orjson>=3.0.0'],
+        'ujson': ['ujson>=4.0.0'],
+        'numpy': ['numpy>=1.17.0'],
+        'pandas': ['pandas>=1.0.0'],
+        'arrow': ['pyarrow>=1.0.0'],
+    },
     tests_require=[
         'pytest>=3.6.1', 'pytest-asyncio>=0.10.0', 'unittest2>=1.1.0'
     ],
+    python_requires='>=3.7',
     zip_safe=False,
     classifiers=[
         'Development Status :: 4 - Beta',
@@ -47,9 +55,7 @@ setup(
         'Operating System :: OS Independent',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ]
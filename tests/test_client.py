@@ -0,0 +1,1729 @@
+import asyncio
+import gzip
+import json
+import time
+from contextlib import asynccontextmanager
+
+import pytest
+import requests
+from aiohttp import web
+from fhirpy.base.exceptions import OperationOutcome, ResourceNotFound
+from fhirpy.base.resource import AbstractResource
+
+from aidboxpy import (
+    AdaptiveLimiter,
+    AsyncAidboxClient,
+    AsyncAidboxLazyResource,
+    HedgingPolicy,
+    MetricsCollector,
+    RequestHooks,
+    ResourceCache,
+    RetryBudget,
+    RetryPolicy,
+    SyncAidboxClient,
+    SyncAidboxLazyResource,
+    SyncAidboxResource,
+)
+from aidboxpy.codec import get_json_codec
+from aidboxpy.export import Exporter, get_searchset, parse_args
+from aidboxpy.hooks import start_request
+from aidboxpy.metrics import LatencyHistogram
+from aidboxpy.trace import trace_span
+from aidboxpy.utils import RawResponse, parse_date_time
+
+
+@asynccontextmanager
+async def serve_patients():
+    """
+    Runs local server answering Patient searches and yields its url
+    """
+
+    async def search_patients(request):
+        return web.json_response(
+            {
+                "resourceType": "Bundle",
+                "entry": [{"resource": {"resourceType": "Patient", "id": "p1"}}],
+            }
+        )
+
+    app = web.Application()
+    app.router.add_get("/Patient", search_patients)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield "http://127.0.0.1:{0}".format(site._server.sockets[0].getsockname()[1])
+    finally:
+        await runner.cleanup()
+
+
+class TestSyncClientSession(object):
+    def test_session_is_pooled(self):
+        client = SyncAidboxClient("mock", pool_size=4)
+        adapter = client.session.get_adapter("http://mock")
+        assert adapter._pool_maxsize == 4
+
+        client = SyncAidboxClient("mock", pool_size=4, limit_per_host=2)
+        adapter = client.session.get_adapter("http://mock")
+        assert adapter._pool_maxsize == 2
+
+    def test_external_session_is_not_closed(self):
+        class Session(requests.Session):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        session = Session()
+        with SyncAidboxClient("mock", session=session) as client:
+            assert client.session is session
+        assert not session.closed
+
+        with SyncAidboxClient("mock") as client:
+            client.session = Session()
+            client.close()
+            assert client.session.closed
+
+    def test_keep_alive_disabled(self):
+        client = SyncAidboxClient("mock", keep_alive=False)
+        assert client._build_request_headers()["Connection"] == "close"
+
+
+class TestAsyncClientSession(object):
+    @pytest.mark.asyncio
+    async def test_session_is_reused(self):
+        async with AsyncAidboxClient("mock", pool_size=5) as client:
+            session = client.session
+            assert client.session is session
+            assert session.connector.limit == 5
+        assert session.closed
+
+    @pytest.mark.asyncio
+    async def test_closed_session_is_recreated(self):
+        client = AsyncAidboxClient("mock")
+        session = client.session
+        await client.close()
+        assert client.session is not session
+        await client.close()
+
+    def test_session_of_another_loop_is_closed(self):
+        client = AsyncAidboxClient("mock")
+
+        async def get_session():
+            return client.session
+
+        async def recreate_session():
+            session = client.session
+            await client.close()
+            return session
+
+        loop = asyncio.new_event_loop()
+        stale_session = loop.run_until_complete(get_session())
+        loop.close()
+
+        session = asyncio.run(recreate_session())
+        assert session is not stale_session
+        assert stale_session.closed
+        assert stale_session.connector is None
+
+
+class TestAdaptiveLimiter(object):
+    @staticmethod
+    def make_send_request(state, status=200):
+        async def send_request(method, url, headers, **kwargs):
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+            state["max_queue_depth"] = max(
+                state["max_queue_depth"], state["limiter"].queue_depth
+            )
+            await asyncio.sleep(0.01)
+            state["in_flight"] -= 1
+            return RawResponse(status, {}, b"{}")
+
+        return send_request
+
+    @pytest.mark.asyncio
+    async def test_in_flight_requests_are_limited(self, monkeypatch):
+        limiter = AdaptiveLimiter(initial_limit=2, max_limit=2)
+        client = AsyncAidboxClient("mock", limiter=limiter)
+        state = {"limiter": limiter, "in_flight": 0, "max_in_flight": 0}
+        state["max_queue_depth"] = 0
+        monkeypatch.setattr(client, "_send_request", self.make_send_request(state))
+
+        await asyncio.gather(*[client.execute("Patient") for _ in range(10)])
+        assert state["max_in_flight"] == 2
+        assert state["max_queue_depth"] > 0
+        assert limiter.get_metrics() == {"limit": 2, "in_flight": 0, "queue_depth": 0}
+
+    @pytest.mark.asyncio
+    async def test_limit_is_decreased_on_overload(self, monkeypatch):
+        limiter = AdaptiveLimiter(initial_limit=8)
+        client = AsyncAidboxClient("mock", limiter=limiter)
+        state = {"limiter": limiter, "in_flight": 0, "max_in_flight": 0}
+        state["max_queue_depth"] = 0
+        monkeypatch.setattr(
+            client, "_send_request", self.make_send_request(state, status=503)
+        )
+
+        with pytest.raises(OperationOutcome):
+            await client.execute("Patient")
+        assert limiter.limit == 4
+
+    @pytest.mark.asyncio
+    async def test_cancelled_waiter_is_removed(self):
+        limiter = AdaptiveLimiter(initial_limit=1)
+        await limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        assert limiter.queue_depth == 1
+
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert limiter.queue_depth == 0
+        limiter.release()
+        assert limiter.in_flight == 0
+
+    @pytest.mark.asyncio
+    async def test_mixed_latencies_are_not_overload(self, monkeypatch):
+        limiter = AdaptiveLimiter(initial_limit=20, latency_tolerance=2.0)
+        client = AsyncAidboxClient("mock", limiter=limiter)
+
+        async def send_request(method, url, headers, **kwargs):
+            # Reads by id are much faster than searches
+            await asyncio.sleep(0.002 if "Patient/p1" in url else 0.02)
+            return RawResponse(200, {}, b"{}")
+
+        monkeypatch.setattr(client, "_send_request", send_request)
+
+        await client.execute("Patient/p1", method="get")
+        await asyncio.gather(
+            *[client.execute("Patient", method="get") for _ in range(100)]
+        )
+        assert limiter.limit >= 20
+
+    def test_latency_baseline_decays(self):
+        limiter = AdaptiveLimiter(
+            initial_limit=20, latency_tolerance=2.0, latency_window=10
+        )
+        limiter.on_response(0.002, overloaded=False)
+        limiter.on_response(0.03, overloaded=False)
+        assert limiter.limit == 10
+
+        # The fast request leaves the window, slow ones are the new baseline
+        for _ in range(100):
+            limiter.on_response(0.03, overloaded=False)
+        assert limiter.limit > 10
+
+    @pytest.mark.asyncio
+    async def test_cancelled_request_is_not_sampled(self, monkeypatch):
+        limiter = AdaptiveLimiter(initial_limit=2)
+        client = AsyncAidboxClient("mock", limiter=limiter)
+        samples = []
+        monkeypatch.setattr(limiter, "on_response", lambda *args: samples.append(args))
+
+        async def send_request(method, url, headers, **kwargs):
+            await asyncio.sleep(1)
+
+        monkeypatch.setattr(client, "_send_request", send_request)
+
+        task = asyncio.ensure_future(client.execute("Patient"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert samples == []
+        assert limiter.in_flight == 0
+
+    def test_invalid_limits(self):
+        with pytest.raises(ValueError):
+            AdaptiveLimiter(initial_limit=10, max_limit=5)
+
+
+class TestRetry(object):
+    @staticmethod
+    def make_client(monkeypatch, responses, **policy_kwargs):
+        client = SyncAidboxClient(
+            "mock", retry_policy=RetryPolicy(backoff=0, **policy_kwargs)
+        )
+        client.calls = []
+
+        def send_request(method, url, headers, **kwargs):
+            client.calls.append(method)
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return RawResponse(response, {}, b"{}")
+
+        monkeypatch.setattr(client, "_send_request", send_request)
+
+        return client
+
+    def test_idempotent_request_is_retried(self, monkeypatch):
+        client = self.make_client(
+            monkeypatch, [requests.ConnectionError(), 503, 200], attempts=3
+        )
+        assert client.execute("Patient/p1", method="get") == {}
+        assert client.calls == ["get", "get", "get"]
+
+    def test_attempts_are_limited(self, monkeypatch):
+        client = self.make_client(monkeypatch, [503, 503, 200], attempts=2)
+        with pytest.raises(OperationOutcome):
+            client.execute("Patient/p1", method="put")
+        assert client.calls == ["put", "put"]
+
+    def test_post_is_not_retried(self, monkeypatch):
+        client = self.make_client(monkeypatch, [503, 200])
+        with pytest.raises(OperationOutcome):
+            client.execute("Patient", method="post")
+        assert client.calls == ["post"]
+
+    def test_retries_are_limited_by_budget(self, monkeypatch):
+        client = self.make_client(
+            monkeypatch, [503, 200], budget=RetryBudget(max_tokens=0)
+        )
+        with pytest.raises(OperationOutcome):
+            client.execute("Patient", method="get")
+        assert client.calls == ["get"]
+
+    @pytest.mark.asyncio
+    async def test_slow_read_is_hedged(self, monkeypatch):
+        hedging_policy = HedgingPolicy(percentile=50, min_samples=1)
+        hedging_policy.record(0.01)
+        client = AsyncAidboxClient("mock", hedging_policy=hedging_policy)
+        delays = [1, 0]
+
+        async def send_request(method, url, headers, **kwargs):
+            await asyncio.sleep(delays.pop(0))
+            return RawResponse(200, {}, b'{"id": "p1"}')
+
+        monkeypatch.setattr(client, "_send_request", send_request)
+
+        started_at = time.monotonic()
+        assert await client.execute("Patient/p1", method="get") == {"id": "p1"}
+        assert time.monotonic() - started_at < 0.5
+        assert delays == []
+
+
+class TestCoalesceReads(object):
+    @staticmethod
+    def make_client(monkeypatch, coalesce_reads=True):
+        client = AsyncAidboxClient("mock", coalesce_reads=coalesce_reads)
+        client.calls = []
+
+        async def send_request(method, url, headers, **kwargs):
+            client.calls.append((method, url))
+            await asyncio.sleep(0.01)
+            return RawResponse(200, {}, b'{"resourceType": "Patient", "id": "p1"}')
+
+        monkeypatch.setattr(client, "_send_request", send_request)
+
+        return client
+
+    @pytest.mark.asyncio
+    async def test_identical_reads_are_coalesced(self, monkeypatch):
+        client = self.make_client(monkeypatch)
+
+        patients = await asyncio.gather(
+            *[client.resources("Patient").search(_id="p1").fetch_raw()]
+            + [client.execute("Patient/p1", method="get") for _ in range(3)]
+            + [client.execute("Patient/p1", method="put", data={})]
+        )
+        assert len(client.calls) == 3
+        patients[1].name = "Ivan"
+        assert "name" not in patients[2]
+
+        await client.execute("Patient/p1", method="get")
+        assert len(client.calls) == 4
+
+    @pytest.mark.asyncio
+    async def test_cancelled_caller_does_not_cancel_request(self, monkeypatch):
+        client = self.make_client(monkeypatch)
+
+        first = asyncio.ensure_future(client.execute("Patient/p1", method="get"))
+        second = asyncio.ensure_future(client.execute("Patient/p1", method="get"))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert (await second).id == "p1"
+        assert len(client.calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_reads_are_not_coalesced_by_default(self, monkeypatch):
+        client = self.make_client(monkeypatch, coalesce_reads=False)
+
+        await asyncio.gather(
+            *[client.execute("Patient/p1", method="get") for _ in range(3)]
+        )
+        assert len(client.calls) == 3
+
+
+class TestThreadPoolHelpers(object):
+    def test_imap_keeps_order(self):
+        client = SyncAidboxClient("mock")
+
+        def fn(delay):
+            time.sleep(delay)
+            return delay
+
+        delays = [0.03, 0.01, 0.02, 0]
+        assert list(client.imap(fn, delays, workers=4)) == delays
+
+    def test_imap_is_bounded(self):
+        client = SyncAidboxClient("mock")
+        taken = []
+
+        def items():
+            for index in range(100):
+                taken.append(index)
+                yield index
+
+        results = client.imap(lambda item: item, items(), workers=2)
+        assert next(results) == 0
+        assert len(taken) == 4
+        results.close()
+
+    def test_map_fetch_captures_errors(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+
+        def fetch_bundle(path, params=None):
+            if params["name"] == ["error"]:
+                raise OperationOutcome(reason="error")
+            return {
+                "resourceType": "Bundle",
+                "entry": [
+                    {"resource": {"resourceType": path, "id": params["name"][0]}}
+                ],
+            }
+
+        monkeypatch.setattr(client, "_fetch_bundle", fetch_bundle)
+        searchsets = [
+            client.resources("Patient").search(name=name)
+            for name in ["p1", "error", "p2"]
+        ]
+
+        results = client.map_fetch(searchsets, workers=2, return_exceptions=True)
+        assert [patient.id for patient in results[0]] == ["p1"]
+        assert isinstance(results[1], OperationOutcome)
+        assert [patient.id for patient in results[2]] == ["p2"]
+
+        with pytest.raises(OperationOutcome):
+            client.map_fetch(searchsets, workers=2)
+
+    def test_map_save(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(
+            client,
+            "_do_request",
+            lambda method, path, data=None, params=None: {**data, "id": "new"},
+        )
+
+        resources = [client.resource("Patient", active=True) for _ in range(3)]
+        assert client.map_save(resources, workers=2) == resources
+        assert [resource.id for resource in resources] == ["new"] * 3
+
+
+class RecordingHooks(RequestHooks):
+    def __init__(self):
+        self.events = []
+
+    def on_request_start(self, request):
+        self.events.append(("start", request.endpoint))
+
+    def on_response(self, request, response):
+        self.events.append(("response", request.status, request.timings.as_dict()))
+
+    def on_error(self, request, error):
+        self.events.append(("error", type(error).__name__))
+
+
+class TestHooks(object):
+    class Response:
+        def __init__(self, status_code, content):
+            self.status_code = status_code
+            self.headers = {}
+            self.content = content
+
+    def test_sync_hooks(self, monkeypatch):
+        hooks = RecordingHooks()
+        metrics = MetricsCollector()
+        client = SyncAidboxClient("http://aidbox/fhir", hooks=[hooks, metrics])
+        responses = [
+            self.Response(200, b'{"resourceType": "Bundle", "entry": []}'),
+            self.Response(404, b"Not found"),
+            requests.ConnectionError("Connection refused"),
+        ]
+
+        def request(method, url, **kwargs):
+            assert kwargs["stream"] is True
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        monkeypatch.setattr(client.session, "request", request)
+
+        assert client.resources("Patient").search(name="Ivan").fetch() == []
+        with pytest.raises(ResourceNotFound):
+            client._do_request("get", "Patient/p1")
+        with pytest.raises(requests.ConnectionError):
+            client.resources("Patient").fetch()
+
+        assert [event[:2] for event in hooks.events] == [
+            ("start", "GET Patient"),
+            ("response", 200),
+            ("start", "GET Patient/{id}"),
+            ("response", 404),
+            ("start", "GET Patient"),
+            ("error", "ConnectionError"),
+        ]
+        timings = hooks.events[1][2]
+        assert timings["connect"] is None
+        assert timings["ttfb"] >= 0 and timings["body"] >= 0
+        assert timings["parse"] >= 0
+        assert hooks.events[3][2]["parse"] is None
+
+        data = metrics.get_metrics()
+        assert data["in_flight"] == 0
+        assert data["endpoints"]["GET Patient"]["requests"] == 2
+        assert data["endpoints"]["GET Patient"]["errors"] == {"ConnectionError": 1}
+        assert data["endpoints"]["GET Patient/{id}"]["statuses"] == {"404": 1}
+        assert data["endpoints"]["GET Patient"]["latency"]["count"] == 1
+        assert data["resource_types"]["Patient"] == {
+            "requests": 3,
+            "errors": 1,
+            "bytes": 48,
+        }
+
+    @pytest.mark.asyncio
+    async def test_async_hooks(self):
+        hooks = RecordingHooks()
+        async with serve_patients() as url:
+            async with AsyncAidboxClient(url, hooks=[hooks]) as client:
+                for _ in range(2):
+                    patients = await client.resources("Patient").fetch()
+                    assert patients[0].id == "p1"
+
+        responses = [event for event in hooks.events if event[0] == "response"]
+        assert [event[1] for event in responses] == [200, 200]
+        assert responses[0][2]["connect"] is not None
+        # The pooled connection is reused
+        assert responses[1][2]["connect"] is None
+        assert responses[1][2]["parse"] is not None
+
+    def test_sync_stream_hooks(self, monkeypatch):
+        hooks = RecordingHooks()
+        metrics = MetricsCollector()
+        client = SyncAidboxClient("http://aidbox", hooks=[hooks, metrics])
+        chunks = [
+            b'{"resourceType": "Patient", "id": "p1"}\n{"resourceType"',
+            b': "Patient", "id": "p2"}\n',
+        ]
+
+        class StreamResponse(self.Response):
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def iter_content(self, chunk_size):
+                return iter(chunks)
+
+        responses = [
+            StreamResponse(200, None),
+            StreamResponse(200, None),
+            StreamResponse(500, b"Internal error"),
+        ]
+
+        def get(url, **kwargs):
+            assert kwargs["stream"] is True
+            return responses.pop(0)
+
+        monkeypatch.setattr(client.session, "get", get)
+
+        patients = list(client.resources("Patient").stream())
+        assert [patient.id for patient in patients] == ["p1", "p2"]
+        # The stream closed by the caller is reported as received
+        stream = client.resources("Patient").stream()
+        assert next(stream).id == "p1"
+        stream.close()
+        with pytest.raises(OperationOutcome):
+            list(client.resources("Patient").stream())
+
+        assert [event[:2] for event in hooks.events] == [
+            ("start", "GET Patient/$dump"),
+            ("response", 200),
+            ("start", "GET Patient/$dump"),
+            ("response", 200),
+            ("start", "GET Patient/$dump"),
+            ("response", 500),
+        ]
+        assert hooks.events[1][2]["ttfb"] >= 0 and hooks.events[1][2]["body"] >= 0
+        data = metrics.get_metrics()
+        assert data["in_flight"] == 0
+        # Only the first chunk of the closed stream is read
+        assert data["endpoints"]["GET Patient/$dump"]["bytes"] == sum(
+            map(len, chunks + chunks[:1])
+        ) + len(b"Internal error")
+
+    @pytest.mark.asyncio
+    async def test_async_stream_hooks(self):
+        hooks = RecordingHooks()
+        metrics = MetricsCollector()
+
+        line = '{{"resourceType": "Patient", "id": "p{0}"}}\n'
+
+        async def dump(request):
+            response = web.StreamResponse()
+            await response.prepare(request)
+            for index in range(3):
+                await response.write(line.format(index).encode())
+            await response.write_eof()
+            return response
+
+        app = web.Application()
+        app.router.add_get("/Patient/$dump", dump)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = "http://127.0.0.1:{0}".format(site._server.sockets[0].getsockname()[1])
+        try:
+            async with AsyncAidboxClient(url, hooks=[hooks, metrics]) as client:
+                patients = [
+                    patient async for patient in client.resources("Patient").stream()
+                ]
+                assert [patient.id for patient in patients] == ["p0", "p1", "p2"]
+                with pytest.raises(ResourceNotFound):
+                    async for _ in client.resources("Observation").stream():
+                        pass
+        finally:
+            await runner.cleanup()
+
+        assert [event[:2] for event in hooks.events] == [
+            ("start", "GET Patient/$dump"),
+            ("response", 200),
+            ("start", "GET Observation/$dump"),
+            ("response", 404),
+        ]
+        assert hooks.events[1][2]["connect"] is not None
+        data = metrics.get_metrics()
+        assert data["endpoints"]["GET Patient/$dump"]["bytes"] == 3 * len(
+            line.format(0)
+        )
+
+    def test_prometheus(self):
+        metrics = MetricsCollector()
+        client = SyncAidboxClient("http://aidbox", hooks=[metrics])
+        request = start_request(
+            client.hooks, client.url, "get", "http://aidbox/Patient"
+        )
+        request.timings.ttfb = 0.01
+        request.receive(200, 2)
+        request.finish(RawResponse(200, {}, b"{}", request), 0.001)
+
+        text = metrics.to_prometheus()
+
+        labels = 'endpoint="GET Patient",resource_type="Patient"'
+        assert "# TYPE aidbox_client_requests_total counter" in text
+        assert "aidbox_client_requests_total{%s} 1" % labels in text
+        assert 'aidbox_client_responses_total{%s,status="200"} 1' % labels in text
+        assert "aidbox_client_request_duration_seconds_count{%s} 1" % labels in text
+        assert 'quantile="0.99"' in text
+        assert text.endswith("aidbox_client_in_flight 0\n")
+
+    def test_histogram_precision(self):
+        histogram = LatencyHistogram()
+        latencies = [index / 10000 for index in range(1, 10001)]
+        for latency in latencies:
+            histogram.record(latency)
+
+        for percentile in (50, 95, 99):
+            expected = latencies[int(len(latencies) * percentile / 100) - 1]
+            assert abs(histogram.percentile(percentile) - expected) <= expected * 0.016
+        assert histogram.percentile(100) == 1.0
+
+
+class TestTrace(object):
+    @staticmethod
+    def get_spans(events):
+        return [event for event in events if event["ph"] == "X"]
+
+    @staticmethod
+    def contains(outer, inner):
+        return (
+            outer["tid"] == inner["tid"]
+            and outer["ts"] <= inner["ts"]
+            and inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"] + 1
+        )
+
+    def test_sync_trace(self, monkeypatch, tmp_path):
+        client = SyncAidboxClient("http://aidbox")
+        contents = [
+            b'{"resourceType": "Bundle", "entry": '
+            b'[{"resource": {"resourceType": "Patient", "id": "p1"}}]}',
+            b'{"resourceType": "Patient", "id": "p1", "active": true}',
+        ]
+
+        def request(method, url, **kwargs):
+            return TestHooks.Response(200, contents.pop(0))
+
+        monkeypatch.setattr(client.session, "request", request)
+        path = str(tmp_path / "trace.json")
+
+        with client.trace(path):
+            patient = client.resources("Patient").fetch_all()[0]
+            patient.active = True
+            patient.save()
+        assert client.hooks == []
+
+        with open(path) as fd:
+            spans = self.get_spans(json.load(fd)["traceEvents"])
+        by_name = {}
+        for span in spans:
+            by_name.setdefault(span["name"], span)
+        assert set(by_name) >= {
+            "fetch_all",
+            "build_query",
+            "GET Patient",
+            "ttfb",
+            "body",
+            "parse",
+            "wrap_resources",
+            "save",
+            "serialize",
+            "encode",
+            "PUT Patient/{id}",
+        }
+        assert by_name["GET Patient"]["args"]["status"] == 200
+        assert self.contains(by_name["fetch_all"], by_name["GET Patient"])
+        assert self.contains(by_name["GET Patient"], by_name["parse"])
+        assert self.contains(by_name["fetch_all"], by_name["wrap_resources"])
+        assert self.contains(by_name["save"], by_name["PUT Patient/{id}"])
+
+    def test_sampling(self, monkeypatch):
+        client = SyncAidboxClient("http://aidbox")
+        monkeypatch.setattr(
+            client.session,
+            "request",
+            lambda method, url, **kwargs: TestHooks.Response(
+                200, b'{"resourceType": "Bundle", "entry": []}'
+            ),
+        )
+
+        with client.trace(sample_rate=0) as tracer:
+            client.resources("Patient").fetch()
+        assert self.get_spans(tracer.events) == []
+
+        with client.trace() as tracer:
+            pass
+        client.resources("Patient").fetch()
+        assert tracer.events == []
+
+    @pytest.mark.asyncio
+    async def test_async_trace(self):
+        async with serve_patients() as url:
+            async with AsyncAidboxClient(url) as client:
+                with client.trace() as tracer:
+                    await asyncio.gather(
+                        client.resources("Patient").fetch(),
+                        client.resources("Patient").fetch(),
+                    )
+
+        spans = self.get_spans(tracer.events)
+        fetches = [span for span in spans if span["name"] == "fetch"]
+        requests = [span for span in spans if span["name"] == "GET Patient"]
+        assert len(fetches) == 2 and len(requests) == 2
+        # Concurrent tasks are recorded on separate tracks
+        assert fetches[0]["tid"] != fetches[1]["tid"]
+        for fetch in fetches:
+            assert any(self.contains(fetch, request) for request in requests)
+
+    @pytest.mark.asyncio
+    async def test_task_without_name(self, monkeypatch):
+        # Tasks of python 3.7 have no names
+        class Task:
+            pass
+
+        task = Task()
+        monkeypatch.setattr(asyncio, "current_task", lambda: task)
+        client = AsyncAidboxClient("mock")
+
+        with client.trace() as tracer:
+            with trace_span(client, "fetch"):
+                pass
+
+        names = [event["args"]["name"] for event in tracer.events if event["ph"] == "M"]
+        assert names == ["Task-{0}".format(id(task))]
+
+
+class TestBatch(object):
+    def test_sync_batch_queues_requests(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        bundles = []
+
+        def do_request(method, path, data=None, params=None):
+            bundles.append(data)
+            return {
+                "entry": [
+                    {"resource": {**entry.get("resource", {}), "id": "new"}}
+                    for entry in data["entry"]
+                ]
+            }
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        patient = client.resource("Patient", active=True)
+        with client.batch(size=2, mode="transaction"):
+            patient.save()
+            client.resource("Patient", id="p1").save()
+            client.resource("Patient", id="p2").delete()
+            assert len(bundles) == 1
+            assert patient.id == "new"
+
+        assert [bundle["type"] for bundle in bundles] == ["transaction"] * 2
+        assert [entry["request"] for entry in bundles[0]["entry"]] == [
+            {"method": "POST", "url": "/Patient"},
+            {"method": "PUT", "url": "/Patient/p1"},
+        ]
+        assert bundles[1]["entry"] == [
+            {"request": {"method": "DELETE", "url": "/Patient/p2"}}
+        ]
+
+    def test_batch_of_another_client_is_ignored(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        other_client = SyncAidboxClient("mock")
+        requests_log = []
+        monkeypatch.setattr(
+            other_client,
+            "_do_request",
+            lambda method, path, data=None, params=None: requests_log.append(method),
+        )
+        with client.batch():
+            other_client.resource("Patient").save()
+        assert requests_log == ["post"]
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            SyncAidboxClient("mock").batch(mode="bulk")
+
+    def test_resource_saved_twice_is_queued_once(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        bundles = []
+
+        def do_request(method, path, data=None, params=None):
+            bundles.append(data)
+            return {
+                "entry": [
+                    {"resource": {**entry["resource"], "id": "new"}}
+                    for entry in data["entry"]
+                ]
+            }
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        patient = client.resource("Patient", active=True)
+        with client.batch():
+            patient.save()
+            patient.active = False
+            patient.save()
+
+        assert len(bundles) == 1
+        assert [entry["request"] for entry in bundles[0]["entry"]] == [
+            {"method": "POST", "url": "/Patient"}
+        ]
+        assert bundles[0]["entry"][0]["resource"]["active"] is False
+        assert patient.id == "new"
+
+    @pytest.mark.asyncio
+    async def test_async_resource_saved_while_created(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+        sent = asyncio.Event()
+
+        async def do_request(method, path, data=None, params=None):
+            sent.set()
+            await asyncio.sleep(0.01)
+            return {"entry": [{"resource": {"id": "new"}} for _ in data["entry"]]}
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        patient = client.resource("Patient")
+        async with client.batch(size=1) as batch:
+            await patient.save()
+            await sent.wait()
+            with pytest.raises(ValueError):
+                await patient.save()
+            await batch.flush()
+            await patient.save()
+        assert patient.id == "new"
+
+    @pytest.mark.asyncio
+    async def test_async_batch_releases_sent_chunks(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+
+        async def do_request(method, path, data=None, params=None):
+            await asyncio.sleep(0)
+            return {"entry": [{"resource": {"id": "new"}} for _ in data["entry"]]}
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        async with client.batch(size=10, concurrency=2) as batch:
+            for _ in range(1000):
+                await client.resource("Patient").save()
+                # Done callbacks of finished chunks run on the next loop step
+                assert len(batch._tasks) <= 4
+        assert not batch._tasks
+
+    @pytest.mark.asyncio
+    async def test_async_batch_raises_failed_chunk(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+        sent = []
+
+        async def do_request(method, path, data=None, params=None):
+            sent.append(data)
+            raise OperationOutcome(reason="failed")
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        saved = 0
+        with pytest.raises(OperationOutcome):
+            async with client.batch(size=10, concurrency=2):
+                for _ in range(1000):
+                    await client.resource("Patient").save()
+                    saved += 1
+        # The producer is stopped soon after the first failure
+        assert saved < 100
+        assert len(sent) < 10
+
+
+class TestResolve(object):
+    def test_resolve_groups_references(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        searches = []
+
+        def fetch_bundle(path, params=None):
+            ids = params["_id"][0].split(",")
+            searches.append((path, ids))
+            return {
+                "resourceType": "Bundle",
+                "entry": [{"resource": {"resourceType": path, "id": id}} for id in ids],
+            }
+
+        monkeypatch.setattr(client, "_fetch_bundle", fetch_bundle)
+        references = [
+            client.reference("Patient", "p1"),
+            client.reference("Patient", "p2"),
+            client.reference("Patient", "p1"),
+            client.reference("Patient", "p3"),
+            client.reference("Organization", "o1"),
+            client.reference(reference="http://external.com/Patient/p1"),
+            None,
+        ]
+        resources = client.resolve(references, chunk_size=2)
+
+        assert searches == [
+            ("Patient", ["p1", "p2"]),
+            ("Patient", ["p3"]),
+            ("Organization", ["o1"]),
+        ]
+        assert set(resources) == {
+            "Patient/p1",
+            "Patient/p2",
+            "Patient/p3",
+            "Organization/o1",
+        }
+        assert references[0].to_resource() is resources["Patient/p1"]
+        assert references[2].to_resource() is resources["Patient/p1"]
+
+
+class TestGraph(object):
+    bundle_data = {
+        "resourceType": "Bundle",
+        "entry": [
+            {
+                "resource": {
+                    "resourceType": "Patient",
+                    "id": "p1",
+                    "generalPractitioner": [
+                        {"resourceType": "Practitioner", "id": "pr1"},
+                        {"resourceType": "Practitioner", "id": "pr2"},
+                    ],
+                }
+            },
+            {
+                "resource": {
+                    "resourceType": "Practitioner",
+                    "id": "pr1",
+                    "active": True,
+                    "extension": [
+                        {
+                            "value": {
+                                "Reference": {"resourceType": "Patient", "id": "p1"}
+                            }
+                        }
+                    ],
+                }
+            },
+        ],
+    }
+
+    def test_fetch_graph(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(
+            client, "_fetch_bundle", lambda path, params=None: self.bundle_data
+        )
+
+        patients, index = (
+            client.resources("Patient").include("Patient", "general-practitioner")
+        ).fetch_graph()
+        assert [patient.id for patient in patients] == ["p1"]
+        assert set(index) == {"Patient/p1", "Practitioner/pr1"}
+
+        practitioner = patients[0].generalPractitioner[0].to_resource()
+        assert practitioner is index["Practitioner/pr1"]
+        reference = practitioner.get_by_path(["extension", 0, "value", "Reference"])
+        assert reference.to_resource() is patients[0]
+        assert patients[0].generalPractitioner[1]._resolved is None
+
+    @pytest.mark.asyncio
+    async def test_async_fetch_graph(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+
+        async def fetch_bundle(path, params=None):
+            return self.bundle_data
+
+        monkeypatch.setattr(client, "_fetch_bundle", fetch_bundle)
+
+        graph = await client.resources("Patient").fetch_graph()
+        practitioner = await graph.resources[0].generalPractitioner[0].to_resource()
+        assert practitioner is graph.index["Practitioner/pr1"]
+
+
+def make_cursor_fetch_bundle(searches, patients):
+    """
+    Returns `_fetch_bundle` searching `patients` by `_lastUpdated`
+    with `_sort` and `page`
+    """
+
+    def fetch_bundle(path, params=None):
+        searches.append(params)
+        found = patients
+        for value in params.get("_lastUpdated", []):
+            prefix, instant = value[:2], parse_date_time(value[2:])
+            found = [
+                patient
+                for patient in found
+                if compare(
+                    parse_date_time(patient["meta"]["lastUpdated"]), prefix, instant
+                )
+            ]
+        keys = params["_sort"][0].split(",")
+        found = sorted(
+            found,
+            key=lambda patient: [
+                (
+                    patient["meta"]["lastUpdated"]
+                    if key == "_lastUpdated"
+                    else patient["id"]
+                )
+                for key in keys
+            ],
+        )
+        count = params["_count"][0]
+        offset = (params.get("page", [1])[0] - 1) * count
+        return {
+            "resourceType": "Bundle",
+            "entry": [
+                {"resource": patient} for patient in found[offset : offset + count]
+            ],
+        }
+
+    def compare(value, prefix, instant):
+        return {
+            "eq": value == instant,
+            "ge": value >= instant,
+            "gt": value > instant,
+        }[prefix]
+
+    return fetch_bundle
+
+
+class TestCursor(object):
+    @pytest.fixture
+    def client(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        # p3-p6 are updated at the same instant
+        instants = [1, 2, 3, 3, 3, 3, 4]
+        patients = [
+            {
+                "resourceType": "Patient",
+                "id": "p{0}".format(index),
+                "meta": {"lastUpdated": "2021-01-01T00:00:0{0}Z".format(instant)},
+            }
+            for index, instant in enumerate(instants)
+        ]
+        client.searches = []
+        monkeypatch.setattr(
+            client, "_fetch_bundle", make_cursor_fetch_bundle(client.searches, patients)
+        )
+
+        return client
+
+    def test_cursor_iteration(self, client):
+        searchset = client.resources("Patient").limit(2).cursor()
+
+        assert [patient.id for patient in searchset] == [
+            "p0",
+            "p1",
+            "p2",
+            "p3",
+            "p4",
+            "p5",
+            "p6",
+        ]
+        assert {params["_count"][0] for params in client.searches} == {2}
+        assert client.searches[1]["_sort"] == ["_lastUpdated,_id"]
+        assert client.searches[1]["_lastUpdated"] == ["ge2021-01-01T00:00:02.000000Z"]
+        # The whole page of p2-p3 is at the same instant, the rest of it
+        # is paged within the instant
+        assert client.searches[3]["_lastUpdated"] == ["eq2021-01-01T00:00:03.000000Z"]
+        assert client.searches[3]["_sort"] == ["_id"]
+        assert client.searches[-1]["_lastUpdated"] == ["gt2021-01-01T00:00:03.000000Z"]
+
+    def test_cursor_resume(self, client):
+        searchset = client.resources("Patient").limit(2).cursor()
+        pages = list(searchset.iter_pages())
+        assert [[patient.id for patient in page] for page, _ in pages] == [
+            ["p0", "p1"],
+            ["p2"],
+            ["p3"],
+            ["p4", "p5"],
+            ["p6"],
+        ]
+
+        token = pages[2][1]
+        assert token == "2021-01-01T00:00:03.000000Z|2"
+        resumed = client.resources("Patient").limit(2).cursor(after=token)
+        assert [patient.id for patient in resumed] == ["p4", "p5", "p6"]
+
+    def test_cursor_tied_instant(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        patients = [
+            {
+                "resourceType": "Patient",
+                "id": "p{0:04d}".format(index),
+                "meta": {"lastUpdated": "2021-01-01T00:00:00Z"},
+            }
+            for index in range(1000)
+        ]
+        searches = []
+        fetch_bundle = make_cursor_fetch_bundle(searches, patients)
+        transferred = []
+
+        def counting_fetch_bundle(path, params=None):
+            bundle_data = fetch_bundle(path, params)
+            transferred.extend(bundle_data["entry"])
+            return bundle_data
+
+        monkeypatch.setattr(client, "_fetch_bundle", counting_fetch_bundle)
+
+        ids = [
+            patient.id for patient in client.resources("Patient").limit(100).cursor()
+        ]
+        assert ids == [patient["id"] for patient in patients]
+        assert {params["_count"][0] for params in searches} == {100}
+        assert len(searches) == 12
+        assert len(transferred) == 1000
+
+    def test_cursor_with_sort(self, client):
+        with pytest.raises(TypeError):
+            client.resources("Patient").sort("name").cursor()
+
+
+class TestColumns(object):
+    patients = [
+        {
+            "resourceType": "Patient",
+            "id": "p1",
+            "birthDate": "1990-01-01",
+            "name": [{"family": "Doe", "given": ["John"]}],
+        },
+        {"resourceType": "Patient", "id": "p2", "name": []},
+        {"resourceType": "Patient", "id": "p3", "birthDate": "2000-02-02"},
+    ]
+    paths = ["id", "birthDate", ["name", 0, "family"]]
+
+    def make_fetch_bundle(self, searches):
+        def fetch_bundle(path, params=None):
+            searches.append(params)
+            page = int(params.get("page", ["1"])[0])
+            bundle = {
+                "resourceType": "Bundle",
+                "entry": [
+                    {"resource": patient}
+                    for patient in self.patients[(page - 1) * 2 : page * 2]
+                ],
+            }
+            if page * 2 < len(self.patients):
+                # Included resources are skipped
+                bundle["entry"].append(
+                    {"resource": {"resourceType": "Organization", "id": "o1"}}
+                )
+                bundle["link"] = [
+                    {"relation": "next", "url": "Patient?page={0}".format(page + 1)}
+                ]
+            return bundle
+
+        return fetch_bundle
+
+    def test_to_columns(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        searches = []
+        monkeypatch.setattr(client, "_fetch_bundle", self.make_fetch_bundle(searches))
+
+        columns = client.resources("Patient").elements("gender").to_columns(self.paths)
+
+        assert columns == {
+            "id": ["p1", "p2", "p3"],
+            "birthDate": ["1990-01-01", None, "2000-02-02"],
+            "name.0.family": ["Doe", None, None],
+        }
+        assert sorted(searches[0]["_elements"][0].split(",")) == [
+            "birthDate",
+            "gender",
+            "id",
+            "name",
+            "resourceType",
+        ]
+        assert len(searches) == 2
+
+    def test_iter_columns(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(client, "_fetch_bundle", self.make_fetch_bundle([]))
+        searchset = client.resources("Patient")
+
+        assert [batch["id"] for batch in searchset.iter_columns(["id"])] == [
+            ["p1", "p2"],
+            ["p3"],
+        ]
+        assert [
+            batch["id"] for batch in searchset.iter_columns(["id"], batch_size=3)
+        ] == [["p1", "p2", "p3"]]
+
+    @pytest.mark.asyncio
+    async def test_async_iter_columns(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+        fetch_bundle = self.make_fetch_bundle([])
+
+        async def async_fetch_bundle(path, params=None):
+            return fetch_bundle(path, params)
+
+        monkeypatch.setattr(client, "_fetch_bundle", async_fetch_bundle)
+        searchset = client.resources("Patient")
+
+        batches = [batch async for batch in searchset.iter_columns(["id"])]
+        assert [batch["id"] for batch in batches] == [["p1", "p2"], ["p3"]]
+        columns = await searchset.to_columns(["name.0.given.0"])
+        assert columns == {"name.0.given.0": ["John", None, None]}
+
+    def test_numpy(self, monkeypatch):
+        numpy = pytest.importorskip("numpy")
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(client, "_fetch_bundle", self.make_fetch_bundle([]))
+
+        columns = client.resources("Patient").to_columns(
+            ["id", "birthDate", "name"],
+            format="numpy",
+            dtypes={"birthDate": "datetime64[D]"},
+        )
+
+        assert columns["id"].tolist() == ["p1", "p2", "p3"]
+        assert columns["birthDate"].dtype == numpy.dtype("datetime64[D]")
+        assert numpy.isnat(columns["birthDate"][1])
+        assert columns["name"].dtype == object
+        assert columns["name"].shape == (3,)
+
+    def test_pandas(self, monkeypatch):
+        pytest.importorskip("pandas")
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(client, "_fetch_bundle", self.make_fetch_bundle([]))
+
+        data_frame = client.resources("Patient").to_columns(self.paths, format="pandas")
+
+        assert list(data_frame.columns) == ["id", "birthDate", "name.0.family"]
+        assert data_frame["name.0.family"].tolist()[0] == "Doe"
+
+    def test_arrow(self, monkeypatch):
+        pytest.importorskip("pyarrow")
+        client = SyncAidboxClient("mock")
+        monkeypatch.setattr(client, "_fetch_bundle", self.make_fetch_bundle([]))
+
+        batches = list(
+            client.resources("Patient").iter_columns(self.paths, format="arrow")
+        )
+
+        assert [batch.num_rows for batch in batches] == [2, 1]
+        assert batches[0].column("name.0.family").to_pylist() == ["Doe", None]
+
+    def test_unknown_format(self):
+        client = SyncAidboxClient("mock")
+
+        with pytest.raises(ValueError):
+            client.resources("Patient").to_columns(["id"], format="csv")
+
+
+class TestExport(object):
+    @staticmethod
+    def make_client(monkeypatch, counts, fail_after=None):
+        client = AsyncAidboxClient("mock")
+        resources = {
+            resource_type: [
+                {
+                    "resourceType": resource_type,
+                    "id": "{0}{1}".format(resource_type[0].lower(), index),
+                    "meta": {"lastUpdated": "2021-01-01T00:00:{0:02d}Z".format(index)},
+                    "name": [{"family": "Doe"}] if index % 2 else [],
+                }
+                for index in range(count)
+            ]
+            for resource_type, count in counts.items()
+        }
+        client.searches = []
+
+        async def fetch_bundle(path, params=None):
+            if fail_after is not None and len(client.searches) >= fail_after:
+                raise OperationOutcome(reason="Server is down")
+            client.searches.append((path, params))
+            found = [
+                resource
+                for resource in resources[path]
+                if all(
+                    resource["meta"]["lastUpdated"] >= value[2:21] + "Z"
+                    for value in params.get("_lastUpdated", [])
+                )
+            ]
+            return {
+                "resourceType": "Bundle",
+                "entry": [
+                    {"resource": resource} for resource in found[: params["_count"][0]]
+                ],
+            }
+
+        monkeypatch.setattr(client, "_fetch_bundle", fetch_bundle)
+
+        return client
+
+    @staticmethod
+    def read_ids(paths):
+        ids = []
+        for path in paths:
+            with gzip.open(path) as fd:
+                ids.extend(json.loads(line)["id"] for line in fd)
+
+        return ids
+
+    @pytest.mark.asyncio
+    async def test_export_ndjson(self, monkeypatch, tmp_path):
+        client = self.make_client(monkeypatch, {"Patient": 7, "Practitioner": 2})
+
+        shards = await client.export(
+            [client.resources("Patient").limit(2), "Practitioner"],
+            str(tmp_path),
+            shard_size=1,
+            workers=2,
+        )
+
+        # The last seen resource is requested again with the next page
+        assert len(shards["Patient"]) == 6
+        assert self.read_ids(shards["Patient"]) == ["p{0}".format(i) for i in range(7)]
+        assert self.read_ids(shards["Practitioner"]) == ["p0", "p1"]
+        with open(str(tmp_path / "checkpoint.json")) as fd:
+            checkpoint = json.load(fd)
+        assert checkpoint["Patient"]["done"] is True
+        assert checkpoint["Patient"]["shards"] == 6
+
+    @pytest.mark.asyncio
+    async def test_export_resume(self, monkeypatch, tmp_path):
+        client = self.make_client(monkeypatch, {"Patient": 7}, fail_after=3)
+        searchset = client.resources("Patient").limit(2)
+
+        with pytest.raises(OperationOutcome):
+            await client.export([searchset], str(tmp_path), shard_size=1)
+        assert len(list(tmp_path.glob("*.ndjson.gz"))) == 2
+
+        client = self.make_client(monkeypatch, {"Patient": 7})
+        shards = await client.export(
+            [client.resources("Patient").limit(2)], str(tmp_path), shard_size=1
+        )
+
+        assert self.read_ids(shards["Patient"]) == ["p{0}".format(i) for i in range(7)]
+        assert client.searches[0][1]["_lastUpdated"] == [
+            "ge2021-01-01T00:00:02.000000Z"
+        ]
+        assert not list(tmp_path.glob("*.part"))
+
+    @pytest.mark.asyncio
+    async def test_export_parquet(self, monkeypatch, tmp_path):
+        parquet = pytest.importorskip("pyarrow.parquet")
+        client = self.make_client(monkeypatch, {"Patient": 3})
+
+        shards = await client.export(["Patient"], str(tmp_path), format="parquet")
+
+        table = parquet.read_table(shards["Patient"][0])
+        assert table.column("id").to_pylist() == ["p0", "p1", "p2"]
+        assert json.loads(table.column("name").to_pylist()[1]) == [{"family": "Doe"}]
+
+    def test_unknown_format(self):
+        client = AsyncAidboxClient("mock")
+
+        with pytest.raises(ValueError):
+            Exporter(client, "export", format="csv")
+
+    def test_parse_args(self):
+        client = AsyncAidboxClient("mock")
+        args = parse_args(["--url", "http://aidbox", "Patient?active=true&_count=5"])
+        searchset = get_searchset(client, args.searches[0], args.page_size)
+
+        assert args.format == "ndjson"
+        assert args.resume is True
+        assert searchset.resource_type == "Patient"
+        assert searchset.params["active"] == ["true"]
+        assert searchset.params["_count"] == ["5"]
+
+
+class TestQuery(object):
+    @staticmethod
+    def make_do_request(requests_log, rows_count):
+        def do_request(method, path, data=None, params=None):
+            requests_log.append((method, path, data, params))
+            if path != "$query/patients":
+                return data
+            offset = params["offset"]
+            rows = [{"id": str(index)} for index in range(rows_count)]
+            return {"data": rows[offset : offset + params["limit"]]}
+
+        return do_request
+
+    def test_define_query(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        requests_log = []
+        monkeypatch.setattr(
+            client, "_do_request", self.make_do_request(requests_log, 0)
+        )
+
+        client.define_query(
+            "patients", "SELECT id FROM patient", {"limit": {"type": "integer"}}
+        )
+        assert requests_log == [
+            (
+                "put",
+                "AidboxQuery/patients",
+                {
+                    "resourceType": "AidboxQuery",
+                    "id": "patients",
+                    "query": "SELECT id FROM patient",
+                    "params": {"limit": {"type": "integer"}},
+                },
+                None,
+            )
+        ]
+
+    def test_iter_query_by_pages(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        requests_log = []
+        monkeypatch.setattr(
+            client, "_do_request", self.make_do_request(requests_log, 5)
+        )
+
+        rows = list(client.iter_query("patients", page_size=2, org="o1"))
+        assert [row["id"] for row in rows] == ["0", "1", "2", "3", "4"]
+        assert [params for _, _, _, params in requests_log] == [
+            {"limit": 2, "offset": 0, "org": "o1"},
+            {"limit": 2, "offset": 2, "org": "o1"},
+            {"limit": 2, "offset": 4, "org": "o1"},
+        ]
+
+    @pytest.mark.asyncio
+    async def test_async_iter_query_by_pages(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+        requests_log = []
+        do_request = self.make_do_request(requests_log, 4)
+
+        async def async_do_request(*args, **kwargs):
+            return do_request(*args, **kwargs)
+
+        monkeypatch.setattr(client, "_do_request", async_do_request)
+
+        rows = [row async for row in client.iter_query("patients", page_size=2)]
+        assert len(rows) == 4
+        assert len(requests_log) == 3
+
+
+class TestSQL(object):
+    @staticmethod
+    def make_do_request(requests_log, ids):
+        def do_request(method, path, data=None, params=None):
+            requests_log.append(data)
+            query, *params = data
+            after = params[-1] if "WHERE id > ?" in query else ""
+            limit = int(query.rsplit(" ", 1)[1]) if "LIMIT" in query else None
+            return [
+                {"id": id, "resource": {"active": True}} for id in ids if id > after
+            ][:limit]
+
+        return do_request
+
+    def test_sql(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        requests_log = []
+        monkeypatch.setattr(
+            client, "_do_request", self.make_do_request(requests_log, ["p1"])
+        )
+
+        patients = client.sql(
+            "SELECT id, resource FROM patient WHERE id = ?",
+            ["p1"],
+            resource_type="Patient",
+        )
+        assert requests_log == [["SELECT id, resource FROM patient WHERE id = ?", "p1"]]
+        assert patients[0].reference == "Patient/p1"
+        assert patients[0]["active"] is True
+
+    def test_iter_sql_by_chunks(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        requests_log = []
+        monkeypatch.setattr(
+            client,
+            "_do_request",
+            self.make_do_request(requests_log, ["p1", "p2", "p3", "p4"]),
+        )
+
+        rows = list(
+            client.iter_sql(
+                "SELECT id FROM patient WHERE active = ?", [True], chunk_size=2
+            )
+        )
+        assert [row["id"] for row in rows] == ["p1", "p2", "p3", "p4"]
+        assert [params for _, *params in requests_log] == [
+            [True],
+            [True, "p2"],
+            [True, "p4"],
+        ]
+
+    @pytest.mark.asyncio
+    async def test_async_iter_sql_by_chunks(self, monkeypatch):
+        client = AsyncAidboxClient("mock")
+        requests_log = []
+        do_request = self.make_do_request(requests_log, ["p1", "p2", "p3"])
+
+        async def async_do_request(*args, **kwargs):
+            return do_request(*args, **kwargs)
+
+        monkeypatch.setattr(client, "_do_request", async_do_request)
+
+        patients = [
+            patient
+            async for patient in client.iter_sql(
+                "SELECT id, resource FROM patient",
+                chunk_size=2,
+                resource_type="Patient",
+            )
+        ]
+        assert [patient.id for patient in patients] == ["p1", "p2", "p3"]
+        assert len(requests_log) == 2
+
+
+class TestCache(object):
+    @pytest.fixture
+    def client(self, monkeypatch):
+        client = SyncAidboxClient("mock", cache=ResourceCache(ttl=0))
+        client.sent = []
+
+        def send(method, url, headers, **kwargs):
+            client.sent.append((method, url, headers.get("If-None-Match")))
+            if headers.get("If-None-Match") == 'W/"1"':
+                return RawResponse(304, {}, b"")
+            return RawResponse(
+                200,
+                {},
+                b'{"resourceType": "Patient", "id": "p1", "meta": {"versionId": "1"}}',
+            )
+
+        monkeypatch.setattr(client, "_send", send)
+        return client
+
+    def test_read_is_revalidated(self, client):
+        patient = client.reference("Patient", "p1").to_resource()
+        patient["active"] = True
+        cached_patient = client.resources("Patient").search(_id="p1").get()
+
+        assert cached_patient.id == "p1"
+        assert "active" not in cached_patient
+        assert client.sent == [
+            ("get", "mock/Patient/p1?", None),
+            ("get", "mock/Patient/p1?", 'W/"1"'),
+        ]
+
+    def test_fresh_entry_is_not_revalidated(self, client):
+        client.cache.ttl = 60
+        client.reference("Patient", "p1").to_resource()
+        client.reference("Patient", "p1").to_resource()
+        assert len(client.sent) == 1
+
+    def test_entry_is_invalidated_on_delete(self, client, monkeypatch):
+        monkeypatch.setattr(
+            client, "_do_request", lambda method, path, data=None, params=None: None
+        )
+        patient = client.reference("Patient", "p1").to_resource()
+        assert len(client.cache) == 1
+        patient.delete()
+        assert len(client.cache) == 0
+
+
+@pytest.mark.parametrize("name", ["json", "orjson", "ujson"])
+class TestJSONCodec(object):
+    def test_roundtrip(self, name):
+        if name != "json":
+            pytest.importorskip(name)
+        codec = get_json_codec(name)
+        client = SyncAidboxClient("mock", json_codec=codec)
+        patient = client.resource(
+            "Patient",
+            id="p1",
+            name=[{"text": "Иван"}],
+            managingOrganization=client.reference("Organization", "o1"),
+        )
+
+        content = codec.dumps(patient.serialize())
+        assert isinstance(content, bytes)
+        assert codec.loads(content) == patient.serialize()
+        data = codec.loads_attrdict(content)
+        assert data.managingOrganization.id == "o1"
+
+
+class TestSerialize(object):
+    def test_serialize_matches_recursive_implementation(self):
+        client = SyncAidboxClient("mock")
+        patient = client.resource("Patient", id="p1")
+        observation = client.resource(
+            "Observation",
+            subject=patient,
+            performer=[patient.to_reference(display="Patient")],
+            component=[
+                {"value": {"Reference": {"resourceType": "Patient", "id": "p2"}}}
+            ],
+            note=[{"text": "a"}, {"text": "b"}],
+        )
+
+        data = observation.serialize()
+        assert data == AbstractResource.serialize(observation)
+        assert data["subject"] == {"resourceType": "Patient", "id": "p1"}
+        assert data.component[0].value.Reference.id == "p2"
+        assert data.note.get_by_path([1, "text"]) == "b"
+
+    def test_serialize_encoded(self):
+        client = SyncAidboxClient("mock")
+        patient = client.resource("Patient", id="p1", name=[{"text": "Ivan"}])
+
+        content = patient.serialize(encode=True)
+        assert isinstance(content, bytes)
+        assert client.json_codec.loads(content) == patient.serialize()
+
+    def test_overridden_serialize_is_saved(self, monkeypatch):
+        class Patient(SyncAidboxResource):
+            def serialize(self, encode=False):
+                data = super().serialize(encode)
+                data.pop("secret", None)
+                return data
+
+        client = SyncAidboxClient("mock")
+        requests_data = []
+
+        def do_request(method, path, data=None, params=None):
+            requests_data.append(data)
+            return {**data, "id": "p1"}
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        patient = Patient(client, resource_type="Patient", active=True, secret="x")
+        patient.save()
+        client.resource("Patient", active=True, secret="x").save()
+
+        assert requests_data == [
+            {"resourceType": "Patient", "active": True},
+            {"resourceType": "Patient", "active": True, "secret": "x"},
+        ]
+
+    def test_is_reference(self):
+        client = SyncAidboxClient("mock")
+        resource = client.resource("Patient")
+
+        assert resource.is_reference({"resourceType": "Patient", "id": "p1"})
+        assert not resource.is_reference({"resourceType": "Patient", "url": "x"})
+        assert not resource.is_reference(
+            {"resourceType": "Patient", "id": "p1", "active": True}
+        )
+
+
+class TestLazyResource(object):
+    data = {
+        "resourceType": "Patient",
+        "id": "p1",
+        "name": [{"given": ["Ivan"]}],
+        "managingOrganization": {"resourceType": "Organization", "id": "o1"},
+    }
+
+    def test_values_are_converted_on_access(self):
+        client = SyncAidboxClient("mock")
+        searchset = client.resources("Patient").lazy()
+        resource = searchset._perform_resource(dict(self.data))
+
+        assert isinstance(resource, SyncAidboxLazyResource)
+        assert type(dict.__getitem__(resource, "name")) is list
+        assert resource.name[0].given == ["Ivan"]
+        assert type(dict.__getitem__(resource, "name")) is not list
+        assert resource.get("managingOrganization").id == "o1"
+        assert resource.get_by_path(["name", 0, "given", 0]) == "Ivan"
+        assert resource.get("gender", "unknown") == "unknown"
+        assert resource.reference == "Patient/p1"
+
+    def test_serialize_matches_regular_resource(self):
+        client = SyncAidboxClient("mock")
+        lazy = client.resources("Patient").lazy()._perform_resource(dict(self.data))
+        regular = client.resources("Patient")._perform_resource(dict(self.data))
+
+        assert type(regular) is not SyncAidboxLazyResource
+        assert lazy.serialize() == regular.serialize()
+        lazy.name
+        assert lazy.serialize() == regular.serialize()
+
+    def test_save(self, monkeypatch):
+        client = SyncAidboxClient("mock")
+        resource = client.resources("Patient").lazy()._perform_resource(dict(self.data))
+        sent = []
+
+        def do_request(method, path, data=None, params=None, **kwargs):
+            sent.append((method, path, data))
+            return {**data, "meta": {"versionId": "2"}}
+
+        monkeypatch.setattr(client, "_do_request", do_request)
+        resource.active = True
+        resource.save()
+
+        assert sent[0][:2] == ("put", "Patient/p1")
+        assert sent[0][2]["active"] is True
+        assert resource.meta.versionId == "2"
+        assert resource.resourceType == "Patient"
+
+    def test_option_is_cloned(self):
+        client = AsyncAidboxClient("mock")
+        searchset = client.resources("Patient").lazy().search(name="Ivan")
+
+        assert searchset.options["lazy"] is True
+        assert isinstance(
+            searchset._perform_resource(dict(self.data)), AsyncAidboxLazyResource
+        )
+        assert not isinstance(
+            searchset.lazy(False)._perform_resource(dict(self.data)),
+            AsyncAidboxLazyResource,
+        )
+
+
+def test_unknown_json_codec():
+    with pytest.raises(ValueError):
+        SyncAidboxClient("mock", json_codec="simplejson")
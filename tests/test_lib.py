@@ -1,7 +1,7 @@
 from unittest2 import TestCase
 from requests.auth import _basic_auth_str
 
-from aidboxpy import SyncAidboxClient
+from aidboxpy import SyncAidboxClient, ResourceCache
 from aidboxpy import SyncAidboxReference, SyncAidboxResource
 from fhirpy.base.exceptions import (
     ResourceNotFound,
@@ -73,6 +73,8 @@ class LibTestCase(TestCase):
         )
 
         self.assertEqual(search_set.count(), 1)
+        self.assertIsInstance(search_set.count(method="estimate"), int)
+        self.assertNotIn("total", search_set.total("none").fetch_raw())
 
     def test_create_without_id(self):
         patient = self.create_resource("Patient")
@@ -86,6 +88,57 @@ class LibTestCase(TestCase):
         with self.assertRaises(ResourceNotFound):
             self.get_search_set("Patient").search(id="patient").get()
 
+    def test_fetch_all_parallel(self):
+        for i in range(5):
+            self.create_resource("Patient", id="patient{0}".format(i))
+
+        search_set = self.get_search_set("Patient").limit(2)
+        self.assertEqual(len(list(search_set.iter_partitions(3))), 3)
+        patients = search_set.fetch_all(parallel=3)
+        self.assertEqual(
+            sorted(p.id for p in patients), ["patient{0}".format(i) for i in range(5)]
+        )
+
+    def test_stream(self):
+        for i in range(3):
+            self.create_resource("Patient", id="patient{0}".format(i))
+
+        patients = {p.id: p for p in self.client.resources("Patient").stream()}
+        self.assertTrue({"patient0", "patient1", "patient2"} <= set(patients))
+        self.assertIsInstance(patients["patient0"], SyncAidboxResource)
+
+        raw_patient = next(self.client.resources("Patient").stream(raw=True))
+        self.assertNotIsInstance(raw_patient, SyncAidboxResource)
+
+        with self.assertRaises(TypeError):
+            next(self.get_search_set("Patient").stream())
+
+    def test_bulk_load(self):
+        resources = (
+            {"id": "patient{0}".format(i), "identifier": self.identifier}
+            for i in range(10)
+        )
+        self.client.bulk_load("Patient", resources)
+
+        self.assertEqual(self.get_search_set("Patient").count(), 10)
+
+    def test_batch(self):
+        patients = [
+            self.client.resource("Patient", identifier=self.identifier)
+            for _ in range(5)
+        ]
+        with self.client.batch(size=2):
+            for patient in patients:
+                patient.save()
+            self.assertTrue(all(patient.id is None for patient in patients))
+        self.assertTrue(all(patient.id for patient in patients))
+        self.assertEqual(self.get_search_set("Patient").count(), 5)
+
+        with self.client.batch(size=2, mode="transaction"):
+            for patient in patients[:3]:
+                patient.delete()
+        self.assertEqual(self.get_search_set("Patient").count(), 2)
+
     def test_get_not_existing_id(self):
         with self.assertRaises(ResourceNotFound):
             self.client.resources("Patient").search(id="FHIRPypy_not_existing_id").get()
@@ -205,6 +258,39 @@ class LibTestCase(TestCase):
             result, {"resourceType": "Patient", "id": "p1", "name": [{"text": "Name"}]}
         )
 
+    def test_resolve(self):
+        patient = self.create_resource("Patient", id="p1")
+        practitioner = self.create_resource("Practitioner", id="pr1")
+        references = [
+            patient.to_reference(),
+            practitioner.to_reference(),
+            self.client.reference("Patient", "p1"),
+        ]
+
+        resources = self.client.resolve(references)
+        self.assertEqual(set(resources), {"Patient/p1", "Practitioner/pr1"})
+        self.assertIs(references[2].to_resource(), resources["Patient/p1"])
+
+    def test_cache(self):
+        client = SyncAidboxClient(
+            self.URL,
+            authorization=_basic_auth_str("root", "secret"),
+            cache=ResourceCache(ttl=0),
+        )
+        self.create_resource("Patient", id="p1", active=False)
+
+        cached_patient = client.reference("Patient", "p1").to_resource()
+        cached_patient["active"] = True
+        self.assertFalse(client.reference("Patient", "p1").to_resource().active)
+        self.assertFalse(client.resources("Patient").search(id="p1").get().active)
+
+        cached_patient.save()
+        self.assertTrue(client.reference("Patient", "p1").to_resource().active)
+
+        cached_patient.delete()
+        with self.assertRaises(ResourceNotFound):
+            client.reference("Patient", "p1").to_resource()
+
     def test_to_resource_for_external_reference(self):
         reference = self.client.reference(reference="http://external.com/Patient/p1")
 
@@ -448,3 +534,70 @@ class LibTestCase(TestCase):
             "resourceType": "Patient",
             "name": [{"given": ["John"], "family": "Smith"}],
         }
+
+    def test_query(self):
+        self.create_resource("Patient", id="p1")
+        self.create_resource("Patient", id="p2")
+        self.create_resource("Patient", id="p3")
+        self.client.define_query(
+            "fhirpy-patients",
+            "SELECT id FROM patient "
+            "WHERE resource#>>'{identifier,0,value}' = {{params.value}} "
+            "ORDER BY id LIMIT {{params.limit}} OFFSET {{params.offset}}",
+            {
+                "value": {"type": "string"},
+                "limit": {"type": "integer", "default": 100},
+                "offset": {"type": "integer", "default": 0},
+            },
+        )
+
+        rows = self.client.query("fhirpy-patients", value="fhirpy")
+        self.assertEqual([row.id for row in rows], ["p1", "p2", "p3"])
+        rows = self.client.iter_query("fhirpy-patients", page_size=2, value="fhirpy")
+        self.assertEqual([row.id for row in rows], ["p1", "p2", "p3"])
+
+    def test_sql(self):
+        for id in ["p1", "p2", "p3"]:
+            self.create_resource("Patient", id=id)
+        query = "SELECT id, resource FROM patient WHERE resource#>>'{identifier,0,value}' = ?"
+
+        rows = self.client.sql(query + " ORDER BY id", ["fhirpy"])
+        self.assertEqual([row.id for row in rows], ["p1", "p2", "p3"])
+        patients = self.client.iter_sql(
+            query, ["fhirpy"], chunk_size=2, resource_type="Patient"
+        )
+        self.assertEqual(
+            [patient.reference for patient in patients],
+            ["Patient/p1", "Patient/p2", "Patient/p3"],
+        )
+
+    def test_fetch_graph(self):
+        practitioner = self.create_resource("Practitioner", id="pr1")
+        self.create_resource(
+            "Patient", id="p1", generalPractitioner=[practitioner.to_reference()]
+        )
+
+        patients, index = (
+            self.get_search_set("Patient")
+            .include("Patient", "general-practitioner")
+            .fetch_graph()
+        )
+        self.assertEqual([patient.id for patient in patients], ["p1"])
+        self.assertIn("Practitioner/pr1", index)
+        self.assertIs(
+            patients[0].generalPractitioner[0].to_resource(),
+            index["Practitioner/pr1"],
+        )
+
+    def test_cursor(self):
+        for index in range(5):
+            self.create_resource("Patient", id="p{0}".format(index))
+
+        searchset = self.get_search_set("Patient").limit(2).cursor()
+        self.assertEqual(
+            [patient.id for patient in searchset], ["p0", "p1", "p2", "p3", "p4"]
+        )
+        pages = list(searchset.iter_pages())
+        self.assertEqual([len(resources) for resources, _ in pages], [2, 1, 1, 1])
+        resumed = self.get_search_set("Patient").limit(2).cursor(after=pages[0][1])
+        self.assertEqual([patient.id for patient in resumed], ["p2", "p3", "p4"])
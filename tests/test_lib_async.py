@@ -1,7 +1,9 @@
+import asyncio
+
 import pytest
 from aiohttp import BasicAuth
 
-from aidboxpy import AsyncAidboxClient
+from aidboxpy import AsyncAidboxClient, ResourceCache
 from aidboxpy import AsyncAidboxReference, AsyncAidboxResource
 from fhirpy.base.exceptions import (
     ResourceNotFound,
@@ -77,6 +79,8 @@ class TestLibAsyncCase(object):
         )
 
         assert await search_set.count() == 1
+        assert isinstance(await search_set.count(method="estimate"), int)
+        assert "total" not in await search_set.total("none").fetch_raw()
 
     @pytest.mark.asyncio
     async def test_create_without_id(self):
@@ -92,6 +96,75 @@ class TestLibAsyncCase(object):
         with pytest.raises(ResourceNotFound):
             await self.get_search_set("Patient").search(id="patient").get()
 
+    @pytest.mark.asyncio
+    async def test_fetch_all_with_prefetch(self):
+        for i in range(5):
+            await self.create_resource("Patient", id="patient{0}".format(i))
+
+        search_set = self.get_search_set("Patient").limit(2).sort("id")
+        patients = await search_set.prefetch(depth=2).fetch_all()
+        assert [p.id for p in patients] == ["patient{0}".format(i) for i in range(5)]
+
+        ids = [p.id async for p in search_set.prefetch(depth=1)]
+        assert ids == [p.id for p in patients]
+
+    @pytest.mark.asyncio
+    async def test_fetch_all_parallel(self):
+        for i in range(5):
+            await self.create_resource("Patient", id="patient{0}".format(i))
+
+        search_set = self.get_search_set("Patient").limit(2)
+        partitions = [p async for p in search_set.iter_partitions(3)]
+        assert len(partitions) == 3
+        patients = await search_set.fetch_all(parallel=3)
+        assert sorted(p.id for p in patients) == [
+            "patient{0}".format(i) for i in range(5)
+        ]
+
+    @pytest.mark.asyncio
+    async def test_stream(self):
+        for i in range(3):
+            await self.create_resource("Patient", id="patient{0}".format(i))
+
+        patients = {p.id: p async for p in self.client.resources("Patient").stream()}
+        assert {"patient0", "patient1", "patient2"} <= set(patients)
+        assert isinstance(patients["patient0"], AsyncAidboxResource)
+
+        async for raw_patient in self.client.resources("Patient").stream(raw=True):
+            assert not isinstance(raw_patient, AsyncAidboxResource)
+
+        with pytest.raises(TypeError):
+            async for _ in self.get_search_set("Patient").stream():
+                pass
+
+    @pytest.mark.asyncio
+    async def test_bulk_load(self):
+        async def iter_resources():
+            for i in range(10):
+                yield self.client.resource(
+                    "Patient", id="patient{0}".format(i), identifier=self.identifier
+                )
+
+        await self.client.bulk_load("Patient", iter_resources())
+
+        assert await self.get_search_set("Patient").count() == 10
+
+    @pytest.mark.asyncio
+    async def test_batch(self):
+        patients = [
+            self.client.resource("Patient", identifier=self.identifier)
+            for _ in range(5)
+        ]
+        async with self.client.batch(size=2):
+            await asyncio.gather(*[patient.save() for patient in patients])
+        assert all(patient.id for patient in patients)
+        assert await self.get_search_set("Patient").count() == 5
+
+        async with self.client.batch(size=2, mode="transaction"):
+            for patient in patients[:3]:
+                await patient.delete()
+        assert await self.get_search_set("Patient").count() == 2
+
     @pytest.mark.asyncio
     async def test_get_not_existing_id(self):
         with pytest.raises(ResourceNotFound):
@@ -218,6 +291,42 @@ class TestLibAsyncCase(object):
             "name": [{"text": "Name"}],
         }
 
+    @pytest.mark.asyncio
+    async def test_resolve(self):
+        patient = await self.create_resource("Patient", id="p1")
+        practitioner = await self.create_resource("Practitioner", id="pr1")
+        references = [
+            patient.to_reference(),
+            practitioner.to_reference(),
+            self.client.reference("Patient", "p1"),
+        ]
+
+        resources = await self.client.resolve(references)
+        assert set(resources) == {"Patient/p1", "Practitioner/pr1"}
+        assert await references[2].to_resource() is resources["Patient/p1"]
+
+    @pytest.mark.asyncio
+    async def test_cache(self):
+        client = AsyncAidboxClient(
+            self.URL,
+            authorization=BasicAuth("root", "secret").encode(),
+            cache=ResourceCache(ttl=0),
+        )
+        await self.create_resource("Patient", id="p1", active=False)
+
+        cached_patient = await client.reference("Patient", "p1").to_resource()
+        cached_patient["active"] = True
+        assert (await client.reference("Patient", "p1").to_resource()).active is False
+        assert (await client.resources("Patient").search(id="p1").get()).active is False
+
+        await cached_patient.save()
+        assert (await client.reference("Patient", "p1").to_resource()).active is True
+
+        await cached_patient.delete()
+        with pytest.raises(ResourceNotFound):
+            await client.reference("Patient", "p1").to_resource()
+        await client.close()
+
     @pytest.mark.asyncio
     async def test_to_resource_for_external_reference(self):
         reference = self.client.reference(reference="http://external.com/Patient/p1")
@@ -462,3 +571,86 @@ class TestLibAsyncCase(object):
             "resourceType": "Patient",
             "name": [{"given": ["John"], "family": "Smith"}],
         }
+
+    @pytest.mark.asyncio
+    async def test_query(self):
+        for id in ["p1", "p2", "p3"]:
+            await self.create_resource("Patient", id=id)
+        await self.client.define_query(
+            "fhirpy-patients",
+            "SELECT id FROM patient "
+            "WHERE resource#>>'{identifier,0,value}' = {{params.value}} "
+            "ORDER BY id LIMIT {{params.limit}} OFFSET {{params.offset}}",
+            {
+                "value": {"type": "string"},
+                "limit": {"type": "integer", "default": 100},
+                "offset": {"type": "integer", "default": 0},
+            },
+        )
+
+        rows = await self.client.query("fhirpy-patients", value="fhirpy")
+        assert [row.id for row in rows] == ["p1", "p2", "p3"]
+        rows = [
+            row
+            async for row in self.client.iter_query(
+                "fhirpy-patients", page_size=2, value="fhirpy"
+            )
+        ]
+        assert [row.id for row in rows] == ["p1", "p2", "p3"]
+
+    @pytest.mark.asyncio
+    async def test_sql(self):
+        for id in ["p1", "p2", "p3"]:
+            await self.create_resource("Patient", id=id)
+        query = "SELECT id, resource FROM patient WHERE resource#>>'{identifier,0,value}' = ?"
+
+        rows = await self.client.sql(query + " ORDER BY id", ["fhirpy"])
+        assert [row.id for row in rows] == ["p1", "p2", "p3"]
+        patients = [
+            patient
+            async for patient in self.client.iter_sql(
+                query, ["fhirpy"], chunk_size=2, resource_type="Patient"
+            )
+        ]
+        assert [patient.reference for patient in patients] == [
+            "Patient/p1",
+            "Patient/p2",
+            "Patient/p3",
+        ]
+
+    @pytest.mark.asyncio
+    async def test_fetch_graph(self):
+        practitioner = await self.create_resource("Practitioner", id="pr1")
+        await self.create_resource(
+            "Patient", id="p1", generalPractitioner=[practitioner.to_reference()]
+        )
+
+        patients, index = await (
+            self.get_search_set("Patient")
+            .include("Patient", "general-practitioner")
+            .fetch_graph()
+        )
+        assert [patient.id for patient in patients] == ["p1"]
+        assert "Practitioner/pr1" in index
+        assert (
+            await patients[0].generalPractitioner[0].to_resource()
+            is index["Practitioner/pr1"]
+        )
+
+    @pytest.mark.asyncio
+    async def test_cursor(self):
+        for index in range(5):
+            await self.create_resource("Patient", id="p{0}".format(index))
+
+        searchset = self.get_search_set("Patient").limit(2).cursor()
+        assert [patient.id async for patient in searchset] == [
+            "p0",
+            "p1",
+            "p2",
+            "p3",
+            "p4",
+        ]
+        pages = [page async for page in searchset.iter_pages()]
+        assert [len(resources) for resources, _ in pages] == [2, 1, 1, 1]
+        resumed = self.get_search_set("Patient").limit(2).cursor(after=pages[0][1])
+        assert [patient.id async for patient in resumed] == ["p2", "p3", "p4"]
@@ -114,6 +114,31 @@ class TestSearchSet(object):
         with pytest.raises(TypeError):
             search_set = client.resources("Patient").include("Patient")
 
+    def test_partitions(self, client):
+        search_set = client.resources("Patient").search(active=True)
+        oldest = client.resource(
+            "Patient", meta={"lastUpdated": "2021-01-01T00:00:00Z"}
+        )
+        newest = client.resource(
+            "Patient", meta={"lastUpdated": "2021-01-01T00:00:03Z"}
+        )
+        partitions = search_set._get_partitions(oldest, newest, 3)
+        assert [dict(p.params) for p in partitions] == [
+            {"active": ["true"], "_lastUpdated": ["lt2021-01-01T00:00:01.000000Z"]},
+            {
+                "active": ["true"],
+                "_lastUpdated": [
+                    "ge2021-01-01T00:00:01.000000Z",
+                    "lt2021-01-01T00:00:02.000000Z",
+                ],
+            },
+            {"active": ["true"], "_lastUpdated": ["ge2021-01-01T00:00:02.000000Z"]},
+        ]
+
+    def test_partitions_of_empty_search_set(self, client):
+        search_set = client.resources("Patient")
+        assert search_set._get_partitions(None, None, 3) == [search_set]
+
     def test_assoc(self, client):
         search_set = client.resources("EpisodeOfCare").assoc("patient")
         assert search_set.params == {"_assoc": ["patient"]}
@@ -128,3 +153,41 @@ class TestSearchSet(object):
 
         search_set = client.resources("EpisodeOfCare").assoc(["careManager", "account"])
         assert search_set.params == {"_assoc": ["careManager", "account"]}
+
+    def test_total(self, client):
+        search_set = client.resources("Patient").total("exact").total("none")
+        assert search_set.params == {"_total": ["none"]}
+
+        search_set = search_set.total("estimate")
+        assert search_set.params == {"_totalMethod": ["estimate"]}
+
+        with pytest.raises(ValueError):
+            search_set.total("fast")
+
+    def test_count_params(self, client):
+        search_set = client.resources("Patient").search(name="John").total("none")
+        assert search_set._get_count_params("estimate") == {
+            "name": ["John"],
+            "_totalMethod": ["estimate"],
+            "_count": [0],
+        }
+
+    def test_iteration_params_suppress_total(self, client):
+        search_set = client.resources("Patient").limit(10)
+        assert search_set._get_iteration_params() == {
+            "_count": [10],
+            "_total": ["none"],
+        }
+
+        search_set = search_set.total("exact")
+        assert search_set._get_iteration_params() == search_set.params
+
+
+def test_prefetch_is_client_side_option():
+    search_set = AsyncAidboxClient("mock").resources("Patient").prefetch(3)
+    assert search_set.params == {}
+    assert search_set.options == {"prefetch": 3}
+
+    cloned = search_set.search(name="John").limit(10)
+    assert cloned.options == {"prefetch": 3}
+    assert search_set.prefetch(0).options == {"prefetch": 0}